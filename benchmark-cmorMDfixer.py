@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# Benchmark the cmorMDfixer on a synthetic CMIP6 tree.
+#
+# A DRS conformant tree with nfiles files is generated, in which a chosen fraction of the files needs a metadata fix.
+# The cmorMDfixer is timed on a fresh copy of this tree in the dry, apply and no-op (apply on the already fixed tree)
+# modes for each of the given --npp values. The throughput (files/s) of each run is reported together with the per
+# file latency percentiles, which are measured in-process. After each run the data variables (and in the dry mode the
+# entire files) are checked to be byte identical with the generated ones.
+#
+# Example:
+#  ./benchmark-cmorMDfixer.py --nfiles 2000 --format NETCDF3_64BIT_OFFSET --fixfraction 0.1 --npp 1 4 8 --json bench.json
+#  ./benchmark-cmorMDfixer.py --nfiles 500 --npp 4 --fixerargs --inplace-only --chunksize 64
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import netCDF4
+import numpy
+
+import cmorMDfixer
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+benchmark_metadata = {
+    "parent_experiment_id": "piControl",
+    "branch_time_in_parent": "149384.0D"
+}
+
+experiments = ["piControl", "historical", "ssp126", "ssp245", "ssp585"]
+variables   = ["tas", "pr", "psl", "uas", "vas", "huss", "clt", "rsds"]
+
+
+def drs_directory(root, dataset, depth):
+    """Return the DRS directory of dataset number dataset, below depth extra directory levels."""
+    experiment = experiments[dataset % len(experiments)]
+    variable   = variables[(dataset // len(experiments)) % len(variables)]
+    member     = "r%di1p1f1" % (dataset // (len(experiments) * len(variables)) + 1)
+    levels     = ["set-%02d" % ((dataset >> (2 * i)) % 4) for i in range(depth)]
+    return os.path.join(root, *levels), experiment, variable, member
+
+
+def write_file(path, fmt, attributes, nvalues, seed):
+    with netCDF4.Dataset(path, "w", format=fmt) as ds:
+        ds.createDimension("time", None)
+        ds.createDimension("lat", nvalues)
+        ds.createDimension("bnds", 2)
+        time_var = ds.createVariable("time", "f8", ("time",))
+        time_var.units = "days since 1850-01-01"
+        time_var.calendar = "proleptic_gregorian"
+        bnds = ds.createVariable("time_bnds", "f8", ("time", "bnds"))
+        var = ds.createVariable(attributes["variable_id"], "f4", ("time", "lat"), fill_value=numpy.float32(1.e20))
+        var.units = "1"
+        rng = numpy.random.default_rng(seed)
+        time_var[:] = numpy.arange(12) * 30.5 + seed
+        bnds[:] = numpy.stack([time_var[:] - 15., time_var[:] + 15.], axis=1)
+        var[:] = rng.random((12, nvalues), dtype=numpy.float32)
+        ds.setncatts(attributes)
+
+
+def generate_tree(root, nfiles, files_per_dataset=4, depth=0, fmt="NETCDF4_CLASSIC", header_size=0, fix_fraction=0.5,
+                  nvalues=64, seed=1):
+    """Generate nfiles synthetic CMIP6 files below root and return their paths."""
+    rng = numpy.random.default_rng(seed)
+    paths = []
+    for i in range(nfiles):
+        dataset, year = divmod(i, files_per_dataset)
+        base, experiment, variable, member = drs_directory(root, dataset, depth)
+        odir = os.path.join(base, "CMIP6", "CMIP", "Bench-Institute", "Bench-Model", experiment, member, "Amon",
+                            variable, "gn", "v20250101")
+        os.makedirs(odir, exist_ok=True)
+        path = os.path.join(odir, "%s_Amon_Bench-Model_%s_%s_gn_%d01-%d12.nc" % (variable, experiment, member,
+                                                                                  1850 + year, 1850 + year))
+        attributes = {
+            "Conventions": "CF-1.7 CMIP-6.2", "activity_id": "CMIP", "experiment_id": experiment,
+            "frequency": "mon", "grid_label": "gn", "institution_id": "Bench-Institute", "mip_era": "CMIP6",
+            "source_id": "Bench-Model", "table_id": "Amon", "variable_id": variable, "variant_label": member,
+            "history": "2025-01-01T00:00:00Z ; CMOR rewrote data to be consistent with CMIP6.",
+            "tracking_id": "hdl:21.14100/00000000-0000-0000-0000-%012d" % i
+        }
+        attributes.update(benchmark_metadata)
+        if rng.random() < fix_fraction:
+            attributes["parent_experiment_id"] = "piControl-spinup"
+        if header_size > 0:
+            attributes["benchmark_padding"] = "x" * header_size
+        write_file(path, fmt, attributes, nvalues, i)
+        paths.append(path)
+    return paths
+
+
+def file_checksum(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def data_checksums(path):
+    """Return the sha1 of the raw bytes of each variable in the file."""
+    with netCDF4.Dataset(path, "r") as ds:
+        ds.set_auto_maskandscale(False)
+        return {name: hashlib.sha1(var[:].tobytes()).hexdigest() for name, var in ds.variables.items()}
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    values = numpy.percentile(latencies, [50, 90, 99])
+    return {"p50": values[0], "p90": values[1], "p99": values[2], "max": max(latencies)}
+
+
+def measure_latencies(paths, write):
+    """Process the files one by one in-process and return the latency of each file in seconds."""
+    latencies = []
+    for path in paths:
+        start = time.perf_counter()
+        cmorMDfixer.process_file(path, write=write, metadata=benchmark_metadata)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_fixer(tree, logdir, npp, write, extra_args):
+    command = [sys.executable, os.path.join(script_dir, "cmorMDfixer.py"), "--olist", logdir, "--npp", str(npp)]
+    if not write:
+        command.append("--dry")
+    command += extra_args + [os.path.join(logdir, "metadata.json"), tree]
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def relocate(paths, source, target):
+    return [os.path.join(target, os.path.relpath(path, source)) for path in paths]
+
+
+def check_identical(mode, paths, reference_paths, reference_data):
+    """Return the number of files of which the data (in the dry mode the entire file) differs from the reference."""
+    failures = 0
+    for path, reference in zip(paths, reference_paths):
+        if mode == "dry":
+            identical = file_checksum(path) == file_checksum(reference)
+        else:
+            identical = data_checksums(path) == reference_data[reference]
+        if not identical:
+            print(" Data of %s is not identical after the %s run" % (path, mode), file=sys.stderr)
+            failures += 1
+    return failures
+
+
+def benchmark(args, workdir):
+    pristine = os.path.join(workdir, "pristine")
+    start = time.perf_counter()
+    paths = generate_tree(pristine, args.nfiles, args.filesperdataset, args.depth, args.format, args.headersize,
+                          args.fixfraction, args.nvalues, args.seed)
+    print(" Generated %d %s files in %.1f s" % (len(paths), args.format, time.perf_counter() - start))
+    reference_data = {path: data_checksums(path) for path in paths}
+    logdir = os.path.join(workdir, "log-dir")
+    os.makedirs(logdir)
+    with open(os.path.join(logdir, "metadata.json"), "w") as f:
+        json.dump(benchmark_metadata, f, indent=4)
+
+    results = []
+    for mode in ["dry", "apply", "noop"]:
+        # The per file latencies, measured on a separate copy with a single process:
+        tree = os.path.join(workdir, "latency")
+        shutil.copytree(pristine, tree)
+        tree_paths = relocate(paths, pristine, tree)
+        if mode == "noop":
+            measure_latencies(tree_paths, True)
+        latency = percentiles(measure_latencies(tree_paths, mode != "dry"))
+        shutil.rmtree(tree)
+
+        for npp in args.npp:
+            tree = os.path.join(workdir, "tree")
+            shutil.copytree(pristine, tree)
+            tree_paths = relocate(paths, pristine, tree)
+            if mode == "noop":
+                run_fixer(tree, logdir, npp, True, args.fixerargs)
+            elapsed = run_fixer(tree, logdir, npp, mode != "dry", args.fixerargs)
+            failures = check_identical(mode, tree_paths, paths, reference_data)
+            shutil.rmtree(tree)
+            for olist in os.listdir(logdir):
+                if olist.startswith("list-of-modified-files"):
+                    os.remove(os.path.join(logdir, olist))
+            result = {"mode": mode, "npp": npp, "files": len(paths), "seconds": elapsed,
+                      "files_per_second": len(paths) / elapsed, "latency": latency, "not_identical": failures}
+            results.append(result)
+            print(" %-5s npp=%-3d %8.1f files/s  %7.2f s  latency p50=%.2f p90=%.2f p99=%.2f max=%.2f ms  %s" % (
+                  mode, npp, result["files_per_second"], elapsed,
+                  *[1000 * latency[k] for k in ["p50", "p90", "p99", "max"]],
+                  "identical" if failures == 0 else "%d NOT IDENTICAL" % failures))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cmorMDfixer on a generated synthetic CMIP6 tree")
+    parser.add_argument("--nfiles", type=int, default=200, help="Number of files to generate (default: 200)")
+    parser.add_argument("--filesperdataset", type=int, default=4,
+                        help="Number of files (years) in each dataset directory (default: 4)")
+    parser.add_argument("--depth", type=int, default=0,
+                        help="Number of extra directory levels above the CMIP6 directories (default: 0)")
+    parser.add_argument("--format", type=str, default="NETCDF4_CLASSIC",
+                        choices=["NETCDF4_CLASSIC", "NETCDF4", "NETCDF3_CLASSIC", "NETCDF3_64BIT_OFFSET",
+                                 "NETCDF3_64BIT_DATA"], help="netCDF format of the generated files (default: NETCDF4_CLASSIC)")
+    parser.add_argument("--headersize", type=int, default=0,
+                        help="Size in bytes of an extra padding attribute in the header of each file (default: 0)")
+    parser.add_argument("--fixfraction", type=float, default=0.5,
+                        help="Fraction of the files which need a metadata fix (default: 0.5)")
+    parser.add_argument("--nvalues", type=int, default=64,
+                        help="Number of latitudes of the data variable, which has 12 time steps (default: 64)")
+    parser.add_argument("--npp", type=int, nargs="+", default=[1], help="The --npp values to benchmark (default: 1)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the generator (default: 1)")
+    parser.add_argument("--fixerargs", nargs=argparse.REMAINDER, default=[],
+                        help="Extra arguments passed to the cmorMDfixer, all arguments after it are taken, so it has to "
+                             "be the last option, for instance: --fixerargs --inplace-only --chunksize 64")
+    parser.add_argument("--workdir", type=str, default=None,
+                        help="Directory in which the trees are generated (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", default=False, help="Keep the generated trees")
+    parser.add_argument("--json", metavar="FILE", type=str, default=None, help="Write the results to FILE as json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="cmorMDfixer-benchmark-", dir=args.workdir)
+    try:
+        results = benchmark(args, workdir)
+    finally:
+        if args.keep:
+            print(" The generated trees are kept in %s" % workdir)
+        else:
+            shutil.rmtree(workdir)
+
+    if args.json:
+        settings = {k: v for k, v in vars(args).items() if k not in ["json", "keep", "workdir"]}
+        with open(args.json, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+    return 1 if any(result["not_identical"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
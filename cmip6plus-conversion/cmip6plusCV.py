@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# Resolve the CMIP6Plus CV items of a (source_id, experiment_id) pair, based on the CMIP6Plus_CV.json file.
+#
+# The CV file is loaded once, all items of a pair are resolved in one go and memoized per pair. The derivations which
+# only depend on the source_id (the license, the institution and the source with its newline fix-ups) are memoized per
+# source_id.
+#
+# This script reads one "source_id experiment_id" pair per line from stdin and writes for each pair and each item a
+# line: source_id experiment_id item value. The convert-cmip6-to-cmip6plus.sh script precomputes in this way the items
+# of all pairs in a tree. E.g.:
+#  printf "EC-Earth3-ESM-1 piControl\nEC-Earth3-ESM-1 esm-hist\n" | ./cmip6plusCV.py
+#
+
+import argparse
+import json
+import os
+import sys
+
+error_message   = ' \033[91m' + 'Error:'   + '\033[0m'        # Red    error   message
+
+module_dir = os.path.dirname(os.path.abspath(__file__))
+cv_file    = os.path.join(module_dir, 'resources', 'CVs', 'CMIP6Plus_CV.json')
+
+# The model components in the source attribute, in the order in which they are put on a new line:
+source_components = ['aerosol', 'atmos', 'atmosChem', 'land', 'landIce', 'ocean', 'ocnBgchem', 'seaIce']
+
+# The items which are written by the batch mode, as used by the convert-cmip6-to-cmip6plus.sh script:
+batch_items = ['cv_parent_source_id', 'cv_experiment', 'cv_description', 'cv_license', 'cv_institution_id',
+               'cv_source', 'cv_title']
+
+
+def single_line(value):
+    """Return the value on one line with single spaces, as a value which passed through an unquoted shell echo."""
+    return ' '.join('{}'.format(value).split())
+
+
+class CVResolver(object):
+    """The CV items of the (source_id, experiment_id) pairs, memoized per pair."""
+
+    def __init__(self, cv_content):
+        self.cv = cv_content['CV']
+        self.pairs = {}
+        self.sources = {}
+
+    def error(self, source_id, experiment_id):
+        """Return the error message in case the pair is not registered in the CV, otherwise None."""
+        if source_id not in self.cv['source_id']:
+            return 'ERROR: {} is not a valid ESM source_id.'.format(source_id)
+        if experiment_id not in self.cv['experiment_id']:
+            return 'ERROR: {} is not a valid experiment.'.format(experiment_id)
+        return None
+
+    def license(self, source_id):
+        source = self.cv['source_id'][source_id]
+        cv_esm_institution_id = source['institution_id'][0]
+        cv_license = self.cv['license']
+        # Manipulate the license:
+        cv_license = cv_license[0].replace("produced by .*", "produced by " + cv_esm_institution_id)
+        cv_license = cv_license[1:]
+        cv_license = cv_license.replace("Commons .*", "Commons 4.0 (" + source['license_info']['id'] + ")")
+        cv_license = cv_license.replace("creativecommons\\.org/.*)\\. *Consult", "creativecommons.org/). Consult")
+        cv_license = cv_license.replace(r"\.", ".")
+        cv_license = cv_license.replace("*", "")
+        return cv_license.replace("$", "")
+
+    @staticmethod
+    def fix_source(cv_esm_source):
+        """Return the source with each model component on a new line (as a literal \\n) like in the CMIP6Plus tables."""
+        cv_source = single_line(cv_esm_source)
+        # Stupid fixes for newline & single spaces in source text content (probably leaving this differences won't stop publishing):
+        for component in source_components:
+            cv_source = cv_source.replace(component, '\\n' + component, 1)
+        cv_source = cv_source.replace(' \\n', '\\n')
+        cv_source = cv_source.replace(':\\n', ': \\n')
+        return cv_source.replace('surroundings)\\n', 'surroundings) \\n')  # dirty adhoc fix for identical result
+
+    def source_items(self, source_id):
+        """Return the items which only depend on the source_id, memoized per source_id."""
+        if source_id not in self.sources:
+            source = self.cv['source_id'][source_id]
+            cv_esm_institution_id = source['institution_id'][0]
+            cv_esm_source = source['source'].replace("\n", "")
+            self.sources[source_id] = {
+                'cv_parent_source_id'  : source_id,
+                'cv_esm_source'        : cv_esm_source,
+                'cv_source'            : self.fix_source(cv_esm_source),
+                'cv_esm_institution_id': cv_esm_institution_id,
+                'cv_institution_id'    : self.cv['institution_id'][cv_esm_institution_id],
+                'cv_license'           : self.license(source_id),
+                # The CMIP6Plus tables have an truncation error at the end of the title, see https://github.com/PCMDI/cmor/issues/776
+                'cv_title'             : '{} output prepared for'.format(source_id)
+            }
+        return self.sources[source_id]
+
+    def items(self, source_id, experiment_id):
+        """Return a dictionary with all CV items of the pair, or with the error message for each item if the pair is
+        not registered in the CV."""
+        pair = (source_id, experiment_id)
+        if pair not in self.pairs:
+            error = self.error(source_id, experiment_id)
+            if error is not None:
+                self.pairs[pair] = {item: error for item in batch_items}
+            else:
+                experiment = self.cv['experiment_id'][experiment_id]
+                items = dict(self.source_items(source_id))
+                items.update({
+                    'cv_experiment'                         : experiment['experiment'],
+                    'cv_description'                        : experiment['description'],
+                    'cv_parent_experiment_id'               : experiment['parent_experiment_id'][0],
+                    'cv_activity_id'                        : experiment['activity_id'][0],
+                    'cv_additional_allowed_model_components': experiment['additional_allowed_model_components'][:],
+                    'cv_required_model_components'          : experiment['required_model_components'][:],
+                    'cv_parent_activity_id'                 : experiment['parent_activity_id'][0],
+                    'cv_sub_experiment_id'                  : experiment['sub_experiment_id'][0],
+                    'cv_tier'                               : experiment['tier']
+                })
+                self.pairs[pair] = items
+        return self.pairs[pair]
+
+    def item(self, source_id, experiment_id, requested_cv_item):
+        """Return one CV item of the pair, 'nomatch' for an unknown item."""
+        return self.items(source_id, experiment_id).get(requested_cv_item, 'nomatch')
+
+
+_resolvers = {}
+
+def load_cv(file_name_cv=cv_file):
+    """Return the CVResolver of the CV file, which is loaded only once within a process."""
+    if file_name_cv not in _resolvers:
+        if not os.path.isfile(file_name_cv):
+            print(error_message, ' The CV file ', file_name_cv, ' does not exist.\n')
+            sys.exit(1)
+        with open(file_name_cv) as json_file:
+            _resolvers[file_name_cv] = CVResolver(json.load(json_file))
+    return _resolvers[file_name_cv]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resolve the CMIP6Plus CV items of the source_id experiment_id pairs, read per line from stdin")
+    parser.add_argument("--cv", metavar="FILE", type=str, default=cv_file,
+                        help="The CMIP6Plus CV file (default: %s)" % os.path.relpath(cv_file))
+    parser.add_argument("--items", metavar="ITEM", type=str, nargs="+", default=batch_items,
+                        help="The items to resolve (default: %s)" % " ".join(batch_items))
+    args = parser.parse_args()
+
+    resolver = load_cv(args.cv)
+    for line in sys.stdin:
+        pair = line.split()
+        if len(pair) != 2:
+            print(error_message, ' Expected a source_id and an experiment_id, instead got: {}'.format(line.strip()), file=sys.stderr)
+            continue
+        for item in args.items:
+            print("{} {} {} {}".format(pair[0], pair[1], item, single_line(resolver.item(pair[0], pair[1], item))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# This script converts CMIP6 data to CMIP6Plus including the DRS adjustment, like the NCO based conversion of the
+# convert-cmip6-to-cmip6plus.sh script, which runs this script by default.
+#
+# Each file is duplicated (or moved) to its CMIP6Plus DRS path, by default by a copy-on-write clone if the file system
+# supports it, otherwise by a kernel side copy. After that its variable rename and all its global attribute edits are
+# applied on the duplicate within one in-place open of the file. The files are converted on the worker pool of the
+# cmorMDfixer, the converted, nomatch and unregistered files are listed in the same sorted log files as before. The
+# duplicate strategy and the bytes copied of each converted file are listed in the -transfer-sorted.log file.
+#
+# Run this script with -h for its options, e.g.:
+#  ./cmip6plusConverter.py --npp 8 -c config-files/config-EC-Earth3-ESM-1.cfg ../cmorMDfixer-test-data/test-set-02/CMIP6/
+#
+
+import argparse
+import datetime
+import errno
+import os
+import re
+import shlex
+import shutil
+import sys
+
+import netCDF4
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cmorMDfixer import dispatch, scan_files, netcdf_lock    # the worker pool and the scan of the cmorMDfixer
+from cmip6plusMapping import load_mapping                     # the table & variable mapping
+from cmip6plusCV import load_cv                               # the memoized CV resolver
+
+error_message   = ' \033[91m' + 'Error:'   + '\033[0m'        # Red    error   message
+
+# The experiment & description attributes of the fast mode, for which the CV file is not consulted:
+fast_mode_experiments = {
+    'esm-piControl': ('pre-industrial control simulation with preindustrial CO2 emissions defined (CO2 emission-driven)',
+                      'DECK: control (emission-driven)'),
+    'esm-hist'     : ('all-forcing simulation of the recent past with atmospheric CO2 concentration calculated (CO2 emission-driven)',
+                      'CMIP6 historical (CO2 emission-driven)')
+}
+
+# The attributes which have to be present in the config file in the fast mode:
+fast_mode_attributes = ['license', 'institution', 'source', 'title']
+
+# The C escape sequences which are translated in character attribute values, as ncatted does:
+escape_pattern = re.compile(r'\\([abfnrtv\\?\'"])')
+escape_characters = {'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\\': '\\',
+                     '?': '?', "'": "'", '"': '"'}
+
+
+def unescape(value):
+    return escape_pattern.sub(lambda match: escape_characters[match.group(1)], value)
+
+
+def read_config(config):
+    """Return the global attribute edits of the config file and the common CMIP6Plus updates as (name, mode, value).
+
+    The mode is one of the ncatted modes: o (overwrite), d (delete), m (modify if present) or p (prepend).
+    """
+    edits = [('mip_era', 'o', 'CMIP6Plus'), ('parent_mip_era', 'o', 'CMIP6Plus'), ('further_info_url', 'd', None)]
+    with open(config) as config_file:
+        for line in config_file:
+            # remove comments and split
+            line = line.rsplit('#', 1)[0] if '#' in line else line
+            if '=' not in line:
+                continue
+            lhs, rhs = line.split('=', 1)
+            # remove quotation marks
+            rhs = ' '.join(shlex.split(' '.join(rhs.split())))
+            edits.append((lhs.strip(), 'o', rhs))
+    return edits
+
+
+def apply_edits(attributes, edits):
+    """Apply the edits to the attributes dict and return it."""
+    for name, mode, value in edits:
+        if mode == 'd':
+            attributes.pop(name, None)
+        elif mode == 'm':
+            if name in attributes:
+                attributes[name] = unescape(value)
+        elif mode == 'p':
+            attributes[name] = unescape(value) + attributes.get(name, '')
+        else:
+            attributes[name] = unescape(value)
+    return attributes
+
+
+def drs_level(path):
+    """Return the index of the CMIP6 directory in the path split at its slashes, or None."""
+    parts = path.split('/')
+    return parts.index('CMIP6') if 'CMIP6' in parts else None
+
+
+# The ioctl request which clones a file on a copy-on-write file system (btrfs, XFS, ...), see ioctl_ficlone(2):
+FICLONE = 0x40049409
+
+# The duplicate strategies, in the order in which they are tried in the auto mode:
+duplicate_strategies = ['reflink', 'copy_file_range', 'sendfile', 'copy']
+
+# The bytes per kernel side copy call:
+copy_range_size = 1 << 30
+
+
+def clone_file(source, target):
+    """Clone source to target sharing its data blocks, no data bytes are copied. Return the bytes copied (0)."""
+    import fcntl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    return 0
+
+
+def copy_ranges(source, target, strategy):
+    """Copy source to target within the kernel with copy_file_range or sendfile in large ranges. Return the bytes copied.
+
+    An OSError raised before any byte is copied means the strategy is not supported for this pair of files. An OSError
+    is raised as well when the copy ends early, such that a truncated copy is never taken for a duplicate.
+    """
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        size, offset = os.fstat(src.fileno()).st_size, 0
+        while offset < size:
+            count = min(copy_range_size, size - offset)
+            if strategy == 'copy_file_range':
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), count, offset, offset)
+            else:
+                copied = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+            if copied == 0:
+                break
+            offset += copied
+    if offset != size:
+        raise OSError(errno.EIO, 'Short {} copy: {} of {} bytes'.format(strategy, offset, size), target)
+    return offset
+
+
+def duplicate_file(source, target, strategy='auto'):
+    """Duplicate source to target with the given strategy, or in the auto mode with the first one which works, and
+    copy its permission bits and times like rsync -a. Return the used strategy and the number of bytes copied."""
+    for candidate in (duplicate_strategies if strategy == 'auto' else [strategy]):
+        try:
+            if candidate == 'reflink':
+                copied = clone_file(source, target)
+            elif candidate == 'copy':
+                shutil.copyfile(source, target)
+                copied = os.path.getsize(target)
+            else:
+                copied = copy_ranges(source, target, candidate)
+            if os.path.getsize(target) != os.path.getsize(source):
+                raise OSError(errno.EIO, 'The {} duplicate differs in size from {}'.format(candidate, source), target)
+        except (OSError, AttributeError):
+            # Not supported by the file system, kernel or python, unless it was the last option:
+            if os.path.isfile(target):
+                os.remove(target)
+            if strategy != 'auto' or candidate == duplicate_strategies[-1]:
+                raise
+            continue
+        shutil.copystat(source, target)
+        return candidate, copied
+
+
+def transfer(source, target, duplicate, strategy='auto'):
+    """Duplicate or move source to target, in an existing directory, return the used strategy and the number of bytes copied."""
+    if duplicate:
+        # Duplicate data to CMIP6plus DRS based directory for conversion to CMIP6plus:
+        return duplicate_file(source, target, strategy)
+    # Move data to CMIP6plus DRS based directory for conversion to CMIP6plus:
+    try:
+        os.rename(source, target)
+        return 'rename', 0
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+    # Across file systems:
+    strategy, copied = duplicate_file(source, target, strategy)
+    # The source is only removed when its duplicate is complete:
+    if os.path.getsize(target) != os.path.getsize(source):
+        os.remove(target)
+        raise OSError(errno.EIO, 'The duplicate differs in size, keeping the source', source)
+    os.remove(source)
+    return 'move-' + strategy, copied
+
+
+def update_file(path, variable, converted_variable, edits):
+    """Rename the variable and apply the global attribute edits within one in-place open of the file.
+
+    The attribute edits are evaluated in memory first, so the file gets one delete per removed attribute and a single
+    setncatts call for all written attributes. Return a warning message or None.
+    """
+    warning = None
+    with netcdf_lock:
+        with netCDF4.Dataset(path, 'r+') as ds:
+            attributes = {name: ds.getncattr(name) for name in ds.ncattrs()}
+            updated = apply_edits(dict(attributes), edits)
+            for name in attributes:
+                if name not in updated:
+                    ds.delncattr(name)
+            if variable != converted_variable:
+                if variable in ds.variables:
+                    ds.renameVariable(variable, converted_variable)
+                else:
+                    warning = 'The variable {} is not present in {}, it has not been renamed'.format(variable, path)
+            ds.setncatts({name: value for name, value in updated.items()
+                          if name not in attributes or not isinstance(attributes[name], str) or attributes[name] != value})
+    return warning
+
+
+def resolve_dataset(dataset_dir, output_path=None, switch_model=None, fast_mode=False, config_edits=(), verbose=False):
+    """Resolve once for a DRS dataset (the .../table/var/grid/version directory): its mapping, CV attributes, global
+    attribute edits and CMIP6Plus target directory.
+
+    Return a dataset dict with its status (convert, nomatch, unregistered or error) and messages. Only the CMIP6,
+    source_id, table and variable components of the DRS path are rewritten, not any other occurrence of their names.
+    """
+    dataset = {'dir': dataset_dir, 'status': 'error', 'messages': []}
+    messages = dataset['messages']
+    parts = dataset_dir.split('/')
+    level = drs_level(dataset_dir)
+    if level is None or len(parts) <= level + 7:
+        messages.append('Abort: can not find CMIP6 in given path: {}'.format(dataset_dir))
+        return dataset
+    # Obtain the table and var name from the path:
+    table, variable = parts[level + 6], parts[level + 7]
+    # Find the equivalent table and variable name and the convert status:
+    converted_table, converted_variable, status = load_mapping().to_cmip6plus(table, variable)
+    if verbose:
+        messages.append('\n Lookup CMIP6Plus equivalent of the CMIP6 {} {}: {} {} {}\n'.format(
+                        table, variable, converted_table, converted_variable, status))
+    if status == 'nomatch':
+        messages.append('{} No conversion for {} {} has been taken, the convert status is: {}'.format(error_message, table, variable, status))
+        dataset['status'] = 'nomatch'
+        return dataset
+
+    # Obtain the experiment_id & source_id name from the path:
+    experiment_id, source_id = parts[level + 4], parts[level + 3]
+    cmip6_source_id = source_id
+    resolver = load_cv()
+    # Check whether a model has a CMIP6Plus registration:
+    error = resolver.error(source_id, experiment_id)
+    if error is not None and switch_model:
+        # Only allowed in case a model is not registered, to prevent other unintended cases.
+        if resolver.error(switch_model, experiment_id) is not None:
+            messages.append('{} The {} specified with the -s option is not registred, therefore reject this switch.'.format(error_message, switch_model))
+        else:
+            error = None
+            source_id = switch_model
+    if error is not None:
+        # ERROR: <message>. => <message> for CMIP6Plus.
+        messages.append('{} {} for CMIP6Plus.'.format(error_message, error[7:-1]))
+        dataset['unregistered'] = '{} for CMIP6Plus'.format(error[7:-1])
+        dataset['status'] = 'unregistered'
+        return dataset
+
+    target_parts = list(parts)
+    target_parts[level], target_parts[level + 3] = 'CMIP6Plus', source_id
+    target_parts[level + 6], target_parts[level + 7] = converted_table, converted_variable
+    if output_path:
+        if verbose and level > 0:
+            messages.append(' The pre path has been changed for the output from {} => {}'.format('/'.join(parts[:level]), output_path))
+        target_parts = [output_path.rstrip('/')] + target_parts[level:]
+    if verbose and source_id != cmip6_source_id:
+        messages.append(' Switch model name: {}'.format('/'.join(target_parts)))
+
+    edits = list(config_edits)
+    if variable != converted_variable:
+        edits.append(('variable_id', 'm', converted_variable))
+    if fast_mode:
+        if experiment_id not in fast_mode_experiments:
+            messages.append('{} Settings for experiment {} not defined yet for the fast mode.'.format(error_message, experiment_id))
+            return dataset
+        cv_experiment, cv_description = fast_mode_experiments[experiment_id]
+        items = {}
+    else:
+        items = resolver.items(source_id, experiment_id)
+        cv_experiment, cv_description = items['cv_experiment'], items['cv_description']
+    edits += [('table_id', 'o', converted_table), ('description', 'o', cv_description), ('experiment', 'o', cv_experiment)]
+    if not fast_mode:
+        edits += [('license', 'o', items['cv_license']), ('institution', 'o', items['cv_institution_id']),
+                  ('source', 'o', items['cv_source']), ('title', 'o', items['cv_title'])]
+        if switch_model:
+            edits += [('source_id', 'o', source_id), ('parent_source_id', 'o', items['cv_parent_source_id'])]
+            messages.append(' Switch model name (due to -s option) from {} to {}. Note that the parent_source_id has been set to {}.'.format(
+                            cmip6_source_id, switch_model, items['cv_parent_source_id']))
+
+    dataset.update(status='convert', target_dir='/'.join(target_parts), edits=edits,
+                   names=[(variable, converted_variable), (table, converted_table), (cmip6_source_id, source_id)])
+    return dataset
+
+
+def target_file_name(name, names):
+    """Return the CMIP6Plus file name: the variable, table and source_id fields of the CMIP6 file name are replaced."""
+    fields = name.split('_')
+    for i, (old, new) in enumerate(names[:len(fields) - 1]):
+        if fields[i] == old:
+            fields[i] = new
+    return '_'.join(fields)
+
+
+def group_datasets(paths):
+    """Return a dict with for each dataset directory the list of its (path, size) pairs."""
+    datasets = {}
+    for path in paths:
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = 0
+        datasets.setdefault(os.path.dirname(path), []).append((path, size))
+    return datasets
+
+
+def plan_tasks(datasets, files, nworkers):
+    """Split the resolved datasets into tasks and return them sorted by their number of bytes, the largest first.
+
+    A dataset is split into pieces of at most a quarter of the bytes per worker, such that a huge dataset is shared by
+    several workers. As the workers take the next task when they are done, the largest pieces are started first and
+    the idle workers take over the remaining pieces of the stragglers.
+    """
+    total = sum(size for dataset in datasets for path, size in files[dataset['dir']])
+    piece_bytes = max(total / (4. * max(nworkers, 1)), 1)
+    tasks = []
+    for dataset in datasets:
+        task = None
+        for path, size in sorted(files[dataset['dir']]):
+            if task is None or (task['bytes'] + size > piece_bytes and task['files']):
+                task = {'path': path, 'dataset': dataset, 'files': [], 'bytes': 0}
+                tasks.append(task)
+            task['files'].append(path)
+            task['bytes'] += size
+    return sorted(tasks, key=lambda task: task['bytes'], reverse=True)
+
+
+def convert_task(task, duplicate=True, overwrite=False, strategy='auto'):
+    """Convert the files of a task, all from one resolved dataset, and return a record for each file with its status
+    (converted, exists or error), target path and messages. A converted record also contains the strategy by which the
+    file has been duplicated or moved, see transfer, and the number of data bytes copied."""
+    dataset = task['dataset']
+    (variable, converted_variable) = dataset['names'][0]
+    records = []
+    for path in task['files']:
+        target = os.path.join(dataset['target_dir'], target_file_name(os.path.basename(path), dataset['names']))
+        record = {'path': path, 'target': target, 'status': 'error', 'messages': []}
+        records.append(record)
+        # check if file already exists, if it exists force cp/mv only if -o has been set
+        if os.path.isfile(target) and not overwrite:
+            record['messages'].append('{} already exists and overwrite={}'.format(target, overwrite))
+            record['status'] = 'exists'
+            continue
+        # prepend history attribute
+        edits = dataset['edits'] + [('history', 'p', '{} ; The convert-cmip6-to-cmip6plus.sh script has been applied.;\\n'.format(
+                                     datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')))]
+        try:
+            record['strategy'], record['bytes'] = transfer(path, target, duplicate, strategy)
+            warning = update_file(target, variable, converted_variable, edits)
+        except (IOError, OSError, RuntimeError) as err:
+            record['messages'].append('{} Conversion of {} to {} failed: {}'.format(error_message, path, target, err))
+            continue
+        if warning:
+            record['messages'].append(' Warning: ' + warning)
+        record['status'] = 'converted'
+    return {'path': task['path'], 'records': records}
+
+
+def write_sorted(fname, lines):
+    """Write the sorted lines to fname, return whether there were any lines (otherwise fname is removed)."""
+    if not lines:
+        if os.path.isfile(fname):
+            os.remove(fname)
+        return False
+    with open(fname, 'w') as f:
+        for line in sorted(lines):
+            f.write(line + '\n')
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert CMIP6 data to CMIP6Plus including the DRS adjustment")
+    parser.add_argument("datadir", metavar="DIR", type=str, help="path to CMIP6 directory")
+    parser.add_argument("-d", dest="duplicate", action="store_false", default=True,
+                        help="don't duplicate data (default: copy data)")
+    parser.add_argument("-v", dest="verbose", action="store_true", default=False, help="switch on verbose (default: off)")
+    parser.add_argument("-p", dest="output_path", metavar="output_path", type=str, default=None,
+                        help="specify an output path (default: the CMIP6 parent directory)")
+    parser.add_argument("-f", dest="fast_mode", action="store_true", default=False,
+                        help="faster, taking several attributes from config instead directly from the CV file (default: off)")
+    parser.add_argument("-o", dest="overwrite", action="store_true", default=False,
+                        help="overwrite existing files (default: off)")
+    parser.add_argument("-s", dest="switch_model", metavar="switch_model", type=str, default=None,
+                        help="switch to another model, only affects unregistered cases")
+    parser.add_argument("-l", dest="log_file", metavar="log_file", type=str, default="convert-cmip6-to-cmip6plus.log",
+                        help="log_file (default: %(default)s)")
+    parser.add_argument("-c", dest="config", metavar="config_file", type=str, default="config-files/convert-ecearth.cfg",
+                        help="configuration file (default: %(default)s)")
+    parser.add_argument("-i", dest="index_file", metavar="index_file", type=str, default=None,
+                        help="take the files from the tree index file (see ../cmorTreeIndex.py) instead of searching DIR")
+    parser.add_argument("--strategy", choices=["auto"] + duplicate_strategies, default="auto",
+                        help="How the files are duplicated: by a copy-on-write clone sharing the data blocks (reflink), "
+                             "by a kernel side copy (copy_file_range, sendfile) or by a plain copy. The auto mode tries "
+                             "them in this order (default: auto)")
+    parser.add_argument("--npp", type=int, default=1, help="Number of sub-processes to launch (default 1)")
+    parser.add_argument("--backend", choices=["processes", "threads", "hybrid"], default="processes",
+                        help="Convert the files on NPP sub-processes, on THREADS threads in one process, or on NPP "
+                             "sub-processes with THREADS threads each (default: processes)")
+    parser.add_argument("--threads", type=int, default=16,
+                        help="Number of threads per process of the threads and hybrid backends (default 16)")
+    args = parser.parse_args()
+
+    if args.switch_model and args.fast_mode:
+        print('\n{} Sorry option -s is not compatible with option -f\n'.format(error_message))
+        return 1
+    if drs_level(args.datadir) is None:
+        print('Abort : no path to CMIP6 directory in {}'.format(args.datadir))
+        return 1
+    config_edits = read_config(args.config)
+    if args.fast_mode:
+        configured = [name for name, mode, value in config_edits]
+        for name in fast_mode_attributes:
+            if name not in configured:
+                print('{} The {} attribute is not defined in your config file {} wich should be the case with the fast mode -f option.'.format(error_message, name, args.config))
+                return 1
+
+    # Load the mapping & the CV before the workers are forked, such that they inherit them:
+    load_mapping()
+    load_cv()
+
+    index = None
+    if args.index_file:
+        from cmorTreeIndex import TreeIndex
+        index = TreeIndex(args.index_file)
+        index.refresh(args.datadir)
+        items = index.files(args.datadir)
+    else:
+        # Like the former find -name '*.nc', the symlinks to files are included:
+        items = scan_files(args.datadir, symlinks=True)
+
+    print('\n Run with {} {}:\n  {}\n'.format(args.npp if args.backend != "threads" else args.threads,
+                                              "threads" if args.backend == "threads" else "processes", ' '.join(sys.argv)))
+    converted, nomatch, unregistered, transfers = [], [], [], []
+    strategies = {}
+
+    def add(record):
+        for message in record['messages']:
+            print(message)
+        if record['status'] == 'converted':
+            converted.append(record['target'])
+            transfers.append('{} {} {}'.format(record['target'], record['strategy'], record['bytes']))
+            counts = strategies.setdefault(record['strategy'], [0, 0])
+            counts[0] += 1
+            counts[1] += record['bytes']
+        elif record['status'] == 'exists':
+            converted.append('{} already exists and overwrite={}'.format(record['target'], args.overwrite))
+        elif record['status'] == 'nomatch':
+            nomatch.append(' No CMIP6Plus table var match for {}'.format(record['path']))
+        elif record['status'] == 'unregistered':
+            unregistered.append(record['unregistered'])
+
+    try:
+        # Each dataset is resolved once, the files of the datasets which can not be converted are reported directly:
+        files = group_datasets(items)
+        datasets = []
+        for dataset_dir in sorted(files):
+            dataset = resolve_dataset(dataset_dir, args.output_path, args.switch_model, args.fast_mode, config_edits,
+                                      args.verbose)
+            for message in dataset.pop('messages'):
+                print(message)
+            if dataset['status'] == 'convert':
+                os.makedirs(dataset['target_dir'], exist_ok=True)
+                datasets.append(dataset)
+                continue
+            for path, size in files[dataset_dir]:
+                add({'path': path, 'status': dataset['status'], 'messages': [],
+                     'unregistered': '{} for {}'.format(dataset.get('unregistered'), path)})
+
+        nworkers = args.threads if args.backend == "threads" else args.npp * (args.threads if args.backend == "hybrid" else 1)
+        tasks = plan_tasks(datasets, files, nworkers)
+        settings = dict(duplicate=args.duplicate, overwrite=args.overwrite, strategy=args.strategy)
+        for result in dispatch(tasks, args.npp, 1, settings, convert_task, backend=args.backend, nthreads=args.threads):
+            for record in result['records']:
+                add(record)
+    finally:
+        if index is not None:
+            index.close()
+
+    # Guarantee same order:
+    sorted_log_file = args.log_file.replace('.log', '-sorted.log', 1)
+    print()
+    if write_sorted(sorted_log_file, converted):
+        print(' Finished, the converted files are listed in the log file: {}'.format(sorted_log_file))
+    if write_sorted(sorted_log_file.replace('-sorted.log', '-transfer-sorted.log', 1), transfers):
+        print(' The duplicate (or move) strategy and the number of bytes copied of each converted file are listed in the log file: {}'.format(sorted_log_file.replace('-sorted.log', '-transfer-sorted.log', 1)))
+        for strategy, (nfiles, nbytes) in sorted(strategies.items()):
+            print('  {:16} {:8d} files {:16d} bytes copied'.format(strategy, nfiles, nbytes))
+    if write_sorted(sorted_log_file.replace('-sorted.log', '-nomatch-sorted.log', 1), nomatch):
+        print(' The no match encountered cases are listed in the log file: {}'.format(sorted_log_file.replace('-sorted.log', '-nomatch-sorted.log', 1)))
+    if write_sorted(sorted_log_file.replace('-sorted.log', '-unregistered-sorted.log', 1), unregistered):
+        print(' The unregistered encountered cases are listed in the log file: {}'.format(sorted_log_file.replace('-sorted.log', '-unregistered-sorted.log', 1)))
+    print()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# Mapping between the CMIP6 and CMIP6Plus table and variable names, based on the cmip6-cmip6plus-mapping-table.txt
+#
+# The table is parsed once into a dictionary for each direction. The parsed form is cached on disk next to the
+# table, keyed by the sha1 hash of the table file, so the cache is renewed automatically when the table changes. As
+# with the former line by line lookup, the last matching row of the table wins.
+#
+# This script maps many table variable pairs in one go, it reads one pair per line from stdin and writes per pair the
+# mapped table, the mapped variable and the status (converted, equal or nomatch). E.g.:
+#  printf "Amon tas\nOmon tos\n" | ./cmip6plusMapping.py
+#  printf "APmon hus19\n"        | ./cmip6plusMapping.py --reverse
+#
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+error_message   = ' \033[91m' + 'Error:'   + '\033[0m'        # Red    error   message
+
+module_dir         = os.path.dirname(os.path.abspath(__file__))
+mapping_table_file = os.path.join(module_dir, 'resources', 'map-table', 'cmip6-cmip6plus-mapping-table.txt')
+
+
+def create_mapping_table(file_name_mapping_table):
+    # Git checkout of the github wiki table of the mip-cmor-tables if not available
+    # for converting the github wiki table to an ascii file with columns:
+    #  https://github.com/PCMDI/mip-cmor-tables/wiki/Mapping-between-variables-in-CMIP6-and-CMIP6Plus
+    wiki_dir = os.path.join(module_dir, 'mip-cmor-tables.wiki')
+    wiki_table_file = os.path.join(wiki_dir, 'Mapping-between-variables-in-CMIP6-and-CMIP6Plus.md')
+    if not os.path.isfile(wiki_table_file):
+     command_1 = "git clone git@github.com:PCMDI/mip-cmor-tables.wiki " + wiki_dir
+     print(' Cloning git repo mip-cmor-tables.wiki:')
+     print('  ' + command_1 + '\n')
+     os.system(command_1)
+
+    print('\n Creating the {} neat columnwise ascii file by applying:'.format(file_name_mapping_table))
+    command_2 = "sed -e '/| CMIP6 table |/,$!d' -e 's/|/ /g' " + wiki_table_file + " | column -t > " + file_name_mapping_table
+    print('  ' + command_2)
+    os.system(command_2)
+    command_3 = "sed -i -e 's/CMIP6.*/CMIP6 table  CMIP6 variable       CMIP6Plus Table CMIP6Plus  variable   Notes/' " + file_name_mapping_table
+    print('  ' + command_3 + '\n')
+    os.system(command_3)
+
+    print(' Remove trailing spaces:')
+    command_4 = "sed -i -e 's/ *$//g' " + file_name_mapping_table
+    print('  ' + command_4 + '\n')
+    os.system(command_4)
+
+    print(' Improve readability of notes:')
+    command_5 = "sed -i -e 's/Note       Variable  name       change/Note Variable name change/' " + file_name_mapping_table
+    print('  ' + command_5)
+    os.system(command_5)
+    command_6 = "sed -i -e 's/Note       change    in         cell_methods/Note change incell_methods/' " + file_name_mapping_table
+    print('  ' + command_6 + '\n')
+    os.system(command_6)
+
+    # Clean:
+    os.system("rm -rf " + wiki_dir)
+
+
+def parse_mapping_table(content):
+    """Return the rows of the mapping table as [cmip6 table, cmip6 variable, cmip6plus table, cmip6plus variable]."""
+    rows = []
+    # The first two lines are the column header and the separator line:
+    for line in content.splitlines()[2:]:
+        columns = line.split()
+        if len(columns) >= 4:
+            rows.append(columns[:4])
+    return rows
+
+
+class Mapping(object):
+    """The CMIP6 to CMIP6Plus mapping in both directions, with for each (table, variable) the last matching row."""
+
+    def __init__(self, rows):
+        self.cmip6plus = {}
+        self.cmip6 = {}
+        for cmip6_table, cmip6_variable, cmip6plus_table, cmip6plus_variable in rows:
+            self.cmip6plus[(cmip6_table, cmip6_variable)] = (cmip6plus_table, cmip6plus_variable)
+            self.cmip6[(cmip6plus_table, cmip6plus_variable)] = (cmip6_table, cmip6_variable)
+
+    @staticmethod
+    def lookup(mapping, table, variable):
+        mapped_table, mapped_variable = mapping.get((table, variable), (None, None))
+        if mapped_table is None:
+            status = 'nomatch'
+        elif mapped_table == table and mapped_variable == variable:
+            status = 'equal'
+        else:
+            status = 'converted'
+        return mapped_table, mapped_variable, status
+
+    def to_cmip6plus(self, table, variable):
+        """Return the CMIP6Plus table, the CMIP6Plus variable and the status of the CMIP6 table and variable."""
+        return self.lookup(self.cmip6plus, table, variable)
+
+    def to_cmip6(self, table, variable):
+        """Return the CMIP6 table, the CMIP6 variable and the status of the CMIP6Plus table and variable."""
+        return self.lookup(self.cmip6, table, variable)
+
+
+_mappings = {}
+
+def load_mapping(file_name_mapping_table=mapping_table_file):
+    """Return the Mapping of the table file, which is created from the wiki if it does not exist.
+
+    The parsed rows are cached in the file .<table file name>.cache.json next to the table, which is only used when
+    its hash matches the hash of the table file. Within a process the Mapping is loaded only once.
+    """
+    if file_name_mapping_table in _mappings:
+        return _mappings[file_name_mapping_table]
+    if not os.path.isfile(file_name_mapping_table):
+        create_mapping_table(file_name_mapping_table)
+    if not os.path.isfile(file_name_mapping_table):
+        print(error_message, ' The file ', file_name_mapping_table, '  does not exist.\n')
+        sys.exit(1)
+
+    with open(file_name_mapping_table, 'rb') as table_file:
+        content = table_file.read()
+    table_hash = hashlib.sha1(content).hexdigest()
+    cache_file = os.path.join(os.path.dirname(file_name_mapping_table),
+                              '.' + os.path.basename(file_name_mapping_table) + '.cache.json')
+    rows = None
+    try:
+        with open(cache_file, 'r') as cache:
+            cached = json.load(cache)
+        if cached.get('sha1') == table_hash:
+            rows = cached['rows']
+    except (IOError, ValueError, KeyError):
+        pass
+    if rows is None:
+        rows = parse_mapping_table(content.decode('utf-8'))
+        try:
+            # Write to a temporary file first, such that concurrent processes never read a partial cache:
+            with open(cache_file + '.%d' % os.getpid(), 'w') as cache:
+                json.dump({'sha1': table_hash, 'rows': rows}, cache)
+            os.replace(cache_file + '.%d' % os.getpid(), cache_file)
+        except OSError:
+            pass  # A read-only checkout, the table is parsed each time
+    _mappings[file_name_mapping_table] = Mapping(rows)
+    return _mappings[file_name_mapping_table]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Map CMIP6 table variable pairs, read per line from stdin, to CMIP6Plus")
+    parser.add_argument("--reverse", action="store_true", default=False,
+                        help="Map CMIP6Plus table variable pairs to CMIP6 instead")
+    parser.add_argument("--table", metavar="FILE", type=str, default=mapping_table_file,
+                        help="The mapping table (default: %s)" % os.path.relpath(mapping_table_file))
+    args = parser.parse_args()
+
+    mapping = load_mapping(args.table)
+    convert = mapping.to_cmip6 if args.reverse else mapping.to_cmip6plus
+    for line in sys.stdin:
+        pair = line.split()
+        if len(pair) != 2:
+            print(error_message, ' Expected a table and a variable name, instead got: {}'.format(line.strip()), file=sys.stderr)
+            print("None None nomatch")
+            continue
+        print("{} {} {}".format(*convert(*pair)))
+
+
+if __name__ == "__main__":
+    main()
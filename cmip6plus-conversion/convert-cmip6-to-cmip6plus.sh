@@ -7,7 +7,7 @@
 #
 
 usage() {
-  echo "Usage: $0 [-h] [-d] [-v] [-p output_path] [-o] [-s switch_model] [-l log_file] [-c config_file] DIR"
+  echo "Usage: $0 [-h] [-d] [-v] [-p output_path] [-o] [-s switch_model] [-l log_file] [-c config_file] [-i index_file] [-n] [-j npp] DIR"
   echo "    -h : show help message"
   echo "    -d : don't duplicate data (default: copy data)"
   echo "    -v : switch on verbose (default: off)"
@@ -17,6 +17,9 @@ usage() {
   echo "    -s : switch to another model (default: ${switch_model}), only affects unregistered cases"
   echo "    -l : log_file (default: ${log_file})"
   echo "    -c : configuration file (default: ${config})"
+  echo "    -i : take the files from the tree index file (see ../cmorTreeIndex.py) instead of searching DIR (default: ${index_file})"
+  echo "    -n : convert with the NCO tools ncrename & ncatted instead of the python conversion engine cmip6plusConverter.py (default: ${nco})"
+  echo "    -j : number of processes of the python conversion engine (default: ${npp})"
   echo "    DIR : path to CMIP6 directory"
   exit -1
 }
@@ -30,11 +33,19 @@ export output_path=False
 export fast_mode=False
 export overwrite=False
 export switch_model=False
+export index_file=False
+export nco=False
+export npp=1
 
 option_list=""
-while getopts "hdvp:fos:l:c:" opt; do
+engine_option_list=""
+while getopts "hdvp:fos:l:c:i:nj:" opt; do
   option_list+=" -"$opt" "$OPTARG
   case $opt in
+  n|j|l) ;;
+  *) engine_option_list+=" -"$opt" "$OPTARG ;;
+  esac
+  case $opt in
   h) usage ;;
   d) duplicate_data=False ;;
   v) verbose=True ;;
@@ -44,6 +55,9 @@ while getopts "hdvp:fos:l:c:" opt; do
   s) switch_model=$OPTARG ;;
   l) log_file=$OPTARG ;;
   c) config=$OPTARG ;;
+  i) index_file=$OPTARG ;;
+  n) nco=True ;;
+  j) npp=$OPTARG ;;
   *) usage ;;
   esac
 done
@@ -58,6 +72,12 @@ fi
 
 export data_dir=$1
 
+# By default the files are converted by the python conversion engine, which renames the variable and edits the global
+# attributes within one in-place open of each file, instead of by the NCO tools:
+if [ ${nco} = False ] && [ "$#" -eq 1 ]; then
+ exec ./cmip6plusConverter.py${engine_option_list} --npp ${npp} -l ${log_file} "$@"
+fi
+
 if [ ${verbose} = True ]; then
    echo
    echo " duplicate data = $duplicate_data"
@@ -68,6 +88,7 @@ if [ ${verbose} = True ]; then
    echo " switch model = $switch_model"
    echo " log file name = $log_file"
    echo " config file name = $config"
+   echo " index file name = $index_file"
    echo " input data dir = $data_dir"
 fi
 
@@ -107,6 +128,17 @@ if [ "$#" -eq 1 ]; then
 
   export -f trim
 
+  # Look up a CV item of a source_id experiment_id pair in the precomputed cv_file, or resolve it if the pair is not in there:
+  function cv_item() {
+    local line=$(awk -v s=$1 -v e=$2 -v c=$3 '$1 == s && $2 == e && $3 == c {print; exit}' ${cv_file})
+    if [ -z "${line}" ]; then
+      line=$(echo "$1 $2" | ./cmip6plusCV.py --items $3)
+    fi
+    echo "${line}" | cut -d' ' -f 4-
+  }
+
+  export -f cv_item
+
   function get_new_attrs() {
 
     # create sequence of ncatted commands from the config file
@@ -147,8 +179,8 @@ if [ "$#" -eq 1 ]; then
       table=$(echo ${i} | cut -d/ -f $((dir_level + 6)))
       var=$(echo ${i} | cut -d/ -f $((dir_level + 7)))
 
-      # Find the equivalent table and variable name and the convert status and catch the script output in an array:
-      converted_result=($(./map-cmip6-to-cmip6plus.py ${table} ${var}))
+      # Look up the equivalent table and variable name and the convert status in the batch mapped pairs:
+      converted_result=($(grep -m 1 "^${table} ${var} " ${map_file} | cut -d' ' -f 3-))
       # Put the three returned values into three separate variables:
       converted_table=${converted_result[0]}
       converted_var=${converted_result[1]}
@@ -177,7 +209,7 @@ if [ "$#" -eq 1 ]; then
         source_id=$(echo ${i} | cut -d/ -f $((dir_level + 3)))
 
         # Check whether a model has a CMIP6Plus registration:
-        cv_experiment=$(echo $(./request-cv-item.py ${source_id} ${experiment_id} cv_experiment) | cut -d = -f 2- | trim)
+        cv_experiment=$(cv_item ${source_id} ${experiment_id} cv_experiment)
         error_in_cv_request=${cv_experiment:0:6}
 
         # Continue conversion towards CMIP6 Plus in case no error is detected or in case no error is detected after switching source_id:
@@ -189,7 +221,7 @@ if [ "$#" -eq 1 ]; then
          if [ "${switch_model}" != False ]; then
 
           # Check whether the model specified with the -s option has a CMIP6Plus registration:
-          cv_experiment_switch=$(echo $(./request-cv-item.py ${switch_model} ${experiment_id} cv_experiment) | cut -d = -f 2- | trim)
+          cv_experiment_switch=$(cv_item ${switch_model} ${experiment_id} cv_experiment)
           error_in_cv_request=${cv_experiment_switch:0:6}
           if [ "${error_in_cv_request}" = "ERROR:" ]; then
            echo -e "\e[1;31m Error:\e[0m"" The ${switch_model} specified with the -s option is not registred, therefore reject this switch."
@@ -227,21 +259,12 @@ if [ "$#" -eq 1 ]; then
 
            # add attrs to list
            if [ ${fast_mode} = False ]; then
-            cv_description=$(echo $(./request-cv-item.py ${source_id} ${experiment_id} cv_description)    | cut -d = -f 2- | trim)
-            cv_experiment=$( echo $(./request-cv-item.py ${source_id} ${experiment_id} cv_experiment)     | cut -d = -f 2- | trim)
-            cv_license=$(    echo $(./request-cv-item.py ${source_id} ${experiment_id} cv_license)        | cut -d = -f 2- | trim)
-            cv_institution=$(echo $(./request-cv-item.py ${source_id} ${experiment_id} cv_institution_id) | cut -d = -f 2- | trim)
-            cv_source=$(     echo $(./request-cv-item.py ${source_id} ${experiment_id} cv_esm_source)     | cut -d = -f 2- | trim)
-            # Stupid fixes for newline & single spaces in source text content (probably leaving this differences won't stop publishing):
-            for component in {'aerosol','atmos','atmosChem','land','landIce','ocean','ocnBgchem','seaIce'}; do 
-             cv_source=${cv_source/${component}/"\n${component}"}
-            done
-            cv_source=$(echo "${cv_source}" | sed -e 's/ \\n/\\n/g')
-            cv_source=$(echo "${cv_source}" | sed -e 's/:\\n/: \\n/g')
-            cv_source=$(echo "${cv_source}" | sed -e 's/surroundings)\\n/surroundings) \\n/g')  # dirty adhoc fix for identical result
-
-            cv_title="${source_id} output prepared for"            # The CMIP6Plus tables have an truncation error at the end of the title, see https://github.com/PCMDI/cmor/issues/776
-           #cv_title="${source_id} output prepared for CMIP6Plus"  # Actual correct case
+            cv_description=$(cv_item ${source_id} ${experiment_id} cv_description)
+            cv_experiment=$( cv_item ${source_id} ${experiment_id} cv_experiment)
+            cv_license=$(    cv_item ${source_id} ${experiment_id} cv_license)
+            cv_institution=$(cv_item ${source_id} ${experiment_id} cv_institution_id)
+            cv_source=$(     cv_item ${source_id} ${experiment_id} cv_source)
+            cv_title=$(      cv_item ${source_id} ${experiment_id} cv_title)
            else
             case $experiment_id in
             esm-piControl)
@@ -276,7 +299,7 @@ if [ "$#" -eq 1 ]; then
             if [ "${switch_model}" != False ]; then
              new_attrs_local+=" -a source_id,global,o,c,'${source_id}'"
              # Adjusting in this case the parent_source_id might be not always the preffered situation (maybe deactive again?):
-             cv_parent_source_id=$(echo $(./request-cv-item.py ${source_id} ${experiment_id} cv_parent_source_id) | cut -d = -f 2- | trim)
+             cv_parent_source_id=$(cv_item ${source_id} ${experiment_id} cv_parent_source_id)
              new_attrs_local+=" -a parent_source_id,global,o,c,'${cv_parent_source_id}'"
             #echo " Note that the parent_source_id has been set to ${cv_parent_source_id}."
              echo " Switch model name (due to -s option) from ${source_id} to ${switch_model}. Note that the parent_source_id has been set to ${cv_parent_source_id}."
@@ -344,19 +367,41 @@ if [ "$#" -eq 1 ]; then
   # load list with new attributes
   get_new_attrs
 
+  # List the files to convert, from the tree index (only the directories changed since its last refresh are listed) or by a find:
+  function list_files() {
+    if [ "${index_file}" != False ]; then
+      ../cmorTreeIndex.py --db ${index_file} list ${data_dir}
+    else
+      find ${data_dir} -name '*.nc'
+    fi
+  }
+
+  export file_list=${log_file/.log/-files.log}
+  export map_file=${log_file/.log/-map.log}
+  list_files >${file_list}
+
+  # Map all distinct table variable pairs in one go, each line of the map_file reads: table var converted_table converted_var status
+  awk -F/ '{for (i = 1; i <= NF; i++) if ($i == "CMIP6") {print $(i + 6), $(i + 7); break}}' ${file_list} | sort -u >${map_file}
+  paste -d' ' ${map_file} <(./cmip6plusMapping.py <${map_file}) >${map_file}.tmp
+  mv -f ${map_file}.tmp ${map_file}
+
+  # Resolve the CV items of all distinct source_id experiment_id pairs in one go, each line of the cv_file reads: source_id experiment_id item value
+  export cv_file=${log_file/.log/-cv.log}
+  awk -F/ -v switch_model=${switch_model} '{for (i = 1; i <= NF; i++) if ($i == "CMIP6") {print $(i + 3), $(i + 4); if (switch_model != "False") print switch_model, $(i + 4); break}}' ${file_list} | sort -u | ./cmip6plusCV.py >${cv_file}
+
   # Check whether gnu parallel is available:
   if hash parallel 2>/dev/null; then
     echo
     echo " Run in parallel mode:"
     echo "  $0$option_list $@"
     echo
-    find ${data_dir} -name '*.nc' | parallel -I% convert_cmip6_to_cmip6plus %
+    parallel -I% convert_cmip6_to_cmip6plus % <${file_list}
   else
     echo
     echo " Run in sequential mode."
     echo "  $0$option_list $@"
     echo
-    for i in $(find ${data_dir} -name '*.nc'); do
+    for i in $(cat ${file_list}); do
       convert_cmip6_to_cmip6plus $i
     done
   fi
@@ -382,7 +427,7 @@ if [ "$#" -eq 1 ]; then
    echo " The unregistered encountered cases are listed in the log file: ${unregistered_file/.log/-sorted.log}"
   fi
   echo
-  rm -f ${log_file} ${nomatch_file} ${unregistered_file}
+  rm -f ${log_file} ${nomatch_file} ${unregistered_file} ${file_list} ${map_file} ${cv_file}
 
 else
   echo
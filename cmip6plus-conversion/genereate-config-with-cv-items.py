@@ -15,6 +15,8 @@ import json
 import os.path                                                # for checking file existence with: os.path.isfile
 from os.path import expanduser                                # Enable to go to the home dir: ~
 
+from cmip6plusCV import load_cv                               # the memoized CV resolver
+
 error_message   = ' \033[91m' + 'Error:'   + '\033[0m'        # Red    error   message
 warning_message = ' \033[93m' + 'Warning:' + '\033[0m'        # Yellow warning message
 
@@ -73,20 +75,10 @@ def main():
 
        cv_esm_source = cv_content['CV']['source_id'][specified_source_id]['source'].replace("\n","\\n")
       #cv_esm_source = cv_content['CV']['source_id'][specified_source_id]['source']
-       cv_esm_institution_id = cv_content['CV']['source_id'][specified_source_id]['institution_id'][0]
-       cv_institution_id = cv_content['CV']['institution_id'][cv_esm_institution_id]
-
-       cv_esm_license = cv_content['CV']['source_id'][specified_source_id]['license_info']
-       cv_license = cv_content['CV']['license']
-       # Manipulate the license:
-       cv_license = cv_license[0].replace("produced by .*", "produced by " + cv_esm_institution_id)
-       cv_license = cv_license[1:]
-       cv_license = cv_license.replace("Commons .*", "Commons 4.0 (" + cv_esm_license['id'] + ")")
-      #cv_license = cv_license.replace("creativecommons\\.org/.*)\\. *Consult", "creativecommons.org/licenses). Consult")
-       cv_license = cv_license.replace("creativecommons\\.org/.*)\\. *Consult", "creativecommons.org/). Consult")
-       cv_license = cv_license.replace(r"\.", ".")
-       cv_license = cv_license.replace("*", "")
-       cv_license = cv_license.replace("$", "")
+       # The institution and the license as derived by the CV resolver:
+       source_items = load_cv(input_json_file).source_items(specified_source_id)
+       cv_institution_id = source_items['cv_institution_id']
+       cv_license = source_items['cv_license']
 
        created_config_file = 'config-files/config-' + specified_source_id + '.cfg'
        with open(created_config_file, 'w') as f:
@@ -11,20 +11,12 @@
 
 import sys
 import os
-import json
-import os.path                                                # for checking file existence with: os.path.isfile
-from os.path import expanduser                                # Enable to go to the home dir: ~
 
-error_message   = ' \033[91m' + 'Error:'   + '\033[0m'        # Red    error   message
-warning_message = ' \033[93m' + 'Warning:' + '\033[0m'        # Yellow warning message
+from cmip6plusCV import load_cv                               # the memoized CV resolver
 
 # Main program
 def main():
 
-    # FUNCTION DEFINITIONS:
-
-
-
     # MAIN:
 
     if len(sys.argv) == 4:
@@ -37,83 +29,15 @@ def main():
       #print('\n Running {:} with:\n  ./{:} {:} {:}\n'.format(os.path.basename(sys.argv[0]), os.path.basename(sys.argv[0]), sys.argv[1], sys.argv[2]))
 
        # Loading the CMIP6Plus CV file:
-      #input_json_file = os.path.expanduser('~/cmorize/CMIP6Plus_CVs/CVs/CMIP6Plus_CV.json')
-       input_json_file = os.path.expanduser('resources/CVs/CMIP6Plus_CV.json')
-       if os.path.isfile(input_json_file) == False:
-        print(error_message, ' The CV file ', input_json_file, ' does not exist.\n')
-        sys.exit()
-
-       with open(input_json_file) as json_file:
-        cv_content = json.load(json_file)
-       json_file.close()
-
+       resolver = load_cv()
 
        # Check whether arguments are known within the CV:
-       esms = list(cv_content['CV']['source_id'].keys())
-       if specified_source_id not in esms:
-          print('\n ERROR: {} is not a valid ESM source_id.\n'.format(specified_source_id))
-         #print('{} {} is not a valid ESM source_id.\n'.format(error_message, specified_source_id))
-          sys.exit()
-
-       experiments = list(cv_content['CV']['experiment_id'].keys())
-       if specified_experiment not in experiments:
-          print('\n ERROR: {} is not a valid experiment.\n'.format(specified_experiment))
-         #print('{} {} is not a valid experiment.\n'.format(error_message, specified_experiment))
+       error = resolver.error(specified_source_id, specified_experiment)
+       if error is not None:
+          print('\n {}\n'.format(error))
           sys.exit()
 
-
-       if requested_cv_item == 'cv_parent_source_id':
-        content_requested_cv_item = specified_source_id
-       elif requested_cv_item == 'cv_experiment':
-        content_requested_cv_item = cv_content['CV']['experiment_id'][specified_experiment]['experiment']
-       elif requested_cv_item == 'cv_description':
-        content_requested_cv_item = cv_content['CV']['experiment_id'][specified_experiment]['description']
-
-       elif requested_cv_item == 'cv_parent_experiment_id':
-        content_requested_cv_item = cv_content['CV']['experiment_id'][specified_experiment]['parent_experiment_id'][0]
-       elif requested_cv_item == 'cv_activity_id':
-        content_requested_cv_item = cv_content['CV']['experiment_id'][specified_experiment]['activity_id'][0]
-       elif requested_cv_item == 'cv_additional_allowed_model_components':
-        content_requested_cv_item = cv_content['CV']['experiment_id'][specified_experiment]['additional_allowed_model_components'][:]
-       elif requested_cv_item == 'cv_required_model_components':
-        content_requested_cv_item = cv_content['CV']['experiment_id'][specified_experiment]['required_model_components'][:]
-       elif requested_cv_item == 'cv_parent_activity_id':
-        content_requested_cv_item = cv_content['CV']['experiment_id'][specified_experiment]['parent_activity_id'][0]
-       elif requested_cv_item == 'cv_sub_experiment_id':
-        content_requested_cv_item = cv_content['CV']['experiment_id'][specified_experiment]['sub_experiment_id'][0]
-       elif requested_cv_item == 'cv_tier':
-        content_requested_cv_item = cv_content['CV']['experiment_id'][specified_experiment]['tier']
-
-       elif requested_cv_item == 'cv_esm_source':
-       #content_requested_cv_item = cv_content['CV']['source_id'][specified_source_id]['source']
-        content_requested_cv_item = cv_content['CV']['source_id'][specified_source_id]['source'].replace("\n","")
-       elif requested_cv_item == 'cv_esm_institution_id':
-        content_requested_cv_item = cv_content['CV']['source_id'][specified_source_id]['institution_id'][0]
-       elif requested_cv_item == 'cv_institution_id':
-        cv_esm_institution_id = cv_content['CV']['source_id'][specified_source_id]['institution_id'][0]
-        content_requested_cv_item = cv_content['CV']['institution_id'][cv_esm_institution_id]
-
-       elif requested_cv_item == 'cv_license':
-       #content_requested_cv_item = cv_content['CV']['license']
-        cv_esm_institution_id = cv_content['CV']['source_id'][specified_source_id]['institution_id'][0]
-        cv_esm_license = cv_content['CV']['source_id'][specified_source_id]['license_info']
-        cv_license = cv_content['CV']['license']
-        # Manipulate the license:
-        cv_license = cv_license[0].replace("produced by .*", "produced by " + cv_esm_institution_id)
-        cv_license = cv_license[1:]
-        cv_license = cv_license.replace("Commons .*", "Commons 4.0 (" + cv_esm_license['id'] + ")")
-       #cv_license = cv_license.replace("creativecommons\\.org/.*)\\. *Consult", "creativecommons.org/licenses). Consult")
-        cv_license = cv_license.replace("creativecommons\\.org/.*)\\. *Consult", "creativecommons.org/). Consult")
-        cv_license = cv_license.replace(r"\.", ".")
-        cv_license = cv_license.replace("*", "")
-        content_requested_cv_item = cv_license.replace("$", "")
-
-       else:
-        content_requested_cv_item = 'nomatch'
-       #print('\n ERROR: {} is not a valid requested_cv_item.\n'.format(requested_cv_item))
-       #print('{} {} is not a valid requested_cv_item.\n'.format(error_message, requested_cv_item))
-
-       print('{}'.format(content_requested_cv_item))
+       print('{}'.format(resolver.item(specified_source_id, specified_experiment, requested_cv_item)))
 
       # Call from bash:
       # echo
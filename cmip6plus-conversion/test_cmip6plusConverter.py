@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# Tests of the duplication and the scheduling of cmip6plusConverter.py, run with: python -m pytest -q
+#
+
+import errno
+import os
+
+import pytest
+
+import cmip6plusConverter
+
+
+def make_file(tmp_path, nbytes=100000):
+    source = str(tmp_path / "source.nc")
+    with open(source, "wb") as f:
+        f.write(os.urandom(nbytes))
+    return source, str(tmp_path / "target.nc")
+
+
+def no_reflink(source, target):
+    raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+
+def test_duplicate_falls_back_after_a_short_copy(tmp_path, monkeypatch):
+    source, target = make_file(tmp_path)
+    monkeypatch.setattr(cmip6plusConverter, "clone_file", no_reflink)
+    # A kernel side copy which stops early:
+    monkeypatch.setattr(os, "copy_file_range", lambda src, dst, count, offset_src, offset_dst: 0, raising=False)
+    strategy, copied = cmip6plusConverter.duplicate_file(source, target)
+    assert strategy == "sendfile" and copied == os.path.getsize(source)
+    with open(source, "rb") as src, open(target, "rb") as dst:
+        assert src.read() == dst.read()
+
+
+def test_duplicate_with_a_short_copy_fails(tmp_path, monkeypatch):
+    source, target = make_file(tmp_path)
+    monkeypatch.setattr(os, "sendfile", lambda dst, src, offset, count: min(count, 1000) if offset < 5000 else 0)
+    with pytest.raises(OSError):
+        cmip6plusConverter.duplicate_file(source, target, "sendfile")
+    assert not os.path.exists(target) and os.path.isfile(source)
+
+
+def test_plan_tasks_splits_the_large_datasets():
+    datasets = [{"dir": "large"}, {"dir": "small"}]
+    files = {"large": [("large/%d.nc" % i, 100) for i in range(8)], "small": [("small/0.nc", 50)]}
+    tasks = cmip6plusConverter.plan_tasks(datasets, files, 2)
+    # Pieces of at most a quarter of the bytes per worker (106 bytes), the largest first:
+    assert [task["bytes"] for task in tasks] == [100] * 8 + [50]
+    assert sorted(path for task in tasks for path in task["files"]) == sorted(path for paths in files.values()
+                                                                             for path, size in paths)
+    tasks = cmip6plusConverter.plan_tasks(datasets, files, 1)
+    assert [task["bytes"] for task in tasks] == [200] * 4 + [50]
+    assert all(task["dataset"]["dir"] == os.path.dirname(task["files"][0]) for task in tasks)
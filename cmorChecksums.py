@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# SHA256 checksum manifest of cmorised files, as needed for publication after the files have been modified.
+#
+# The files are hashed with large unbuffered reads on the worker pool of the cmorMDfixer. The checksums are cached in
+# a SQLite file, keyed by the path, inode, size and modification time of the file, so only the new and changed files are
+# read again: after a cmorMDfixer run only the modified files. The manifest is written in the sha256sum format, or as
+# an esgmapfile (as used by the ESGF publisher) if its name ends with .map. The files are taken from a list of
+# modified files, from the tree index or from a scan of the directory. E.g.:
+#  ./cmorChecksums.py --olist log-dir/list-of-modified-files-2.txt --cache log-dir/checksums.sqlite manifest.sha256
+#  ./cmorChecksums.py --cache checksums.sqlite --dir CMIP6/ CMIP6.map
+# A sha256sum manifest can be checked with: sha256sum --check manifest.sha256
+#
+
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from cmorMDfixer import dispatch, drs_facets, drs_mip_eras, parse_drs_path, scan_files
+
+log = logging.getLogger(os.path.basename(__file__))
+
+default_bufsize = 1 << 24
+
+
+def sha256_file(path, bufsize=default_bufsize):
+    """Return the hex SHA256 digest of the file, read in blocks of bufsize bytes into one reused buffer."""
+    digest = hashlib.sha256()
+    buffer = bytearray(bufsize)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            nbytes = f.readinto(buffer)
+            if not nbytes:
+                break
+            # The hashing of a large block releases the GIL, so threads hash concurrently:
+            digest.update(view[:nbytes])
+    return digest.hexdigest()
+
+
+def checksum_file(path, bufsize=default_bufsize):
+    """Return the record of the file with its checksum and stat info, or with the error if it can not be read."""
+    try:
+        st = os.stat(path)
+        checksum = sha256_file(path, bufsize)
+        if os.stat(path).st_mtime_ns != st.st_mtime_ns:
+            raise IOError("the file changed while it was hashed")
+    except (IOError, OSError) as read_err:
+        log.error("Unable to checksum %s: %s" % (path, read_err))
+        return {"path": path, "error": str(read_err)}
+    return {"path": path, "sha256": checksum, "inode": st.st_ino, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+class ChecksumCache(object):
+    """SQLite cache of the checksums, a checksum is reused as long as the inode, size and mtime of the file match."""
+
+    def __init__(self, fname, commit_every=1000):
+        self.connection = sqlite3.connect(fname, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER,"
+                                " mtime_ns INTEGER, sha256 TEXT)")
+        self.commit_every, self.pending = commit_every, 0
+
+    def lookup(self, path):
+        """Return the record of the file if its cached checksum is still valid, otherwise None."""
+        path = os.path.abspath(path)
+        with self.lock:
+            row = self.connection.execute("SELECT inode, size, mtime_ns, sha256 FROM checksums WHERE path = ?",
+                                          (path,)).fetchone()
+        if row is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if row[:3] != (st.st_ino, st.st_size, st.st_mtime_ns):
+            return None
+        return {"path": path, "sha256": row[3], "inode": row[0], "size": row[1], "mtime_ns": row[2]}
+
+    def store(self, record):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)",
+                                    (os.path.abspath(record["path"]), record["inode"], record["size"],
+                                     record["mtime_ns"], record["sha256"]))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.connection.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def checksum_files(paths, cache=None, npp=1, backend="threads", nthreads=4, bufsize=default_bufsize, counts=None):
+    """Yield the records of the paths, taken from the cache when valid and otherwise hashed on the worker pool.
+
+    The records of the files which could not be read have an error key instead of a checksum. The new checksums are
+    stored in the cache. If given, the numbers of reused and hashed files are added to the counts dict.
+    """
+    counts = counts if counts is not None else {}
+    counts.setdefault("reused", 0)
+    counts.setdefault("hashed", 0)
+    # With sub-processes the cache lookups are done in the task feeding thread of the pool:
+    cached = []
+
+    def uncached(paths):
+        for path in paths:
+            record = cache.lookup(path) if cache is not None else None
+            if record is None:
+                yield os.path.abspath(path)
+            else:
+                cached.append(record)
+
+    for record in dispatch(uncached(paths), npp, 1, dict(bufsize=bufsize), checksum_file, backend=backend, nthreads=nthreads):
+        if "sha256" in record:
+            counts["hashed"] += 1
+            if cache is not None:
+                cache.store(record)
+        yield record
+        while cached:
+            counts["reused"] += 1
+            yield cached.pop()
+    while cached:
+        counts["reused"] += 1
+        yield cached.pop()
+
+
+def dataset_id(path):
+    """Return the ESGF dataset id with version, MIP_ERA.ACTIVITY...GRID#YYYYMMDD, of a file in a DRS tree, or None."""
+    facets = parse_drs_path(path)
+    if not facets:
+        return None
+    mip_era = os.path.basename(path.rsplit(os.sep, len(drs_facets) + 1)[0])
+    if mip_era not in drs_mip_eras:
+        mip_era = drs_mip_eras[0]
+    return ".".join([mip_era] + [facets[facet] for facet in drs_facets[:-1]]) + "#" + facets["version"][1:]
+
+
+def write_manifest(fname, records):
+    """Write the manifest of the records, sorted by path, in the esgmapfile format if fname ends with .map and in the
+    sha256sum format otherwise. Returns the number of listed files."""
+    records = sorted((record for record in records if "sha256" in record), key=lambda record: record["path"])
+    with open(fname, 'w', buffering=1 << 16) as f:
+        for record in records:
+            if fname.endswith(".map"):
+                f.write("%s | %s | %d | mod_time=%.6f | checksum=%s | checksum_type=SHA256\n" %
+                        (dataset_id(record["path"]) or "", record["path"], record["size"], record["mtime_ns"] / 1e9,
+                         record["sha256"]))
+            else:
+                f.write("%s  %s\n" % (record["sha256"], record["path"]))
+    return len(records)
+
+
+def write_checksums(fname, paths, cache_fname=None, npp=1, backend="threads", nthreads=4, bufsize=default_bufsize):
+    """Checksum the paths, with the cache cache_fname if given, and write the manifest fname. Returns the numbers of
+    listed, reused, hashed and failed files."""
+    cache = ChecksumCache(cache_fname) if cache_fname else None
+    counts = {}
+    try:
+        records = list(checksum_files(paths, cache, npp, backend, nthreads, bufsize, counts))
+    finally:
+        if cache is not None:
+            cache.close()
+    counts["failed"] = sum(1 for record in records if "error" in record)
+    counts["listed"] = write_manifest(fname, records)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the SHA256 checksum manifest of cmorised files, reusing the cached "
+                                                 "checksums of the unchanged files")
+    parser.add_argument("manifest", metavar="MANIFEST", type=str,
+                        help="The manifest, in the esgmapfile format if it ends with .map, otherwise in the sha256sum format")
+    parser.add_argument("--olist", metavar="FILE", type=str, default=None,
+                        help="Checksum the files listed in FILE, e.g. the list of modified files of the cmorMDfixer")
+    parser.add_argument("--dir", metavar="DIR", type=str, default=None, help="Checksum all netcdf files below DIR")
+    parser.add_argument("--index", metavar="FILE", type=str, default=None,
+                        help="Take the files below DIR from the tree index FILE (see cmorTreeIndex.py) instead of scanning DIR")
+    parser.add_argument("--cache", metavar="FILE", type=str, default=None,
+                        help="Reuse and store the checksums in the SQLite cache FILE (default: no cache)")
+    parser.add_argument("--npp", type=int, default=1, help="Number of sub-processes to launch (default 1)")
+    parser.add_argument("--backend", choices=["processes", "threads", "hybrid"], default="threads",
+                        help="Hash the files on NPP sub-processes, on THREADS threads in one process, or on NPP "
+                             "sub-processes with THREADS threads each (default: threads)")
+    parser.add_argument("--threads", type=int, default=4, help="Number of threads per process (default 4)")
+    parser.add_argument("--bufsize", metavar="BYTES", type=int, default=default_bufsize,
+                        help="Size of the blocks read from the files (default %d)" % default_bufsize)
+    parser.add_argument("--verbose", "-v", action="store_true", default=False, help="Run verbosely (default: off)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s:%(name)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    if (args.olist is None) == (args.dir is None):
+        parser.error("either --olist or --dir must be used")
+    if args.index and not args.dir:
+        parser.error("option index requires the dir option")
+    if args.npp < 1 or args.threads < 1 or args.bufsize < 1:
+        parser.error("the number of sub-processes, the number of threads and the block size must be positive")
+    if args.dir and not os.path.isdir(args.dir):
+        log.error("The directory argument %s is not a valid directory" % args.dir)
+        return 1
+
+    index = None
+    if args.olist:
+        with open(args.olist, 'r') as f:
+            # The olist of a verified run has the status in a second, tab separated column:
+            paths = [line.rstrip('\n').split('\t')[0] for line in f if line.strip()]
+    elif args.index:
+        from cmorTreeIndex import TreeIndex
+        index = TreeIndex(args.index)
+        index.refresh(args.dir)
+        paths = index.files(args.dir)
+    else:
+        paths = scan_files(args.dir, nthreads=8)
+    try:
+        counts = write_checksums(args.manifest, paths, args.cache, args.npp, args.backend, args.threads, args.bufsize)
+    finally:
+        if index is not None:
+            index.close()
+    log.info("Wrote the checksums of %d files to %s: %d hashed, %d taken from the cache" %
+             (counts["listed"], args.manifest, counts["hashed"], counts["reused"]))
+    if counts["failed"]:
+        log.error("Unable to checksum %d files" % counts["failed"])
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,34 +9,41 @@
 # ${1} the first   argument is the number of cores (one node can be used).
 # ${2} the second  argument is path + filename of the metadata json file.
 # ${3} the third   argument is path of the directory with the cmorised data.
+# ${4} the optional fourth argument is a version vYYYYMMDD, which is set for all datasets with modified files.
 #
 # Run this script without arguments for examples how to call this script.
 #
 
-if [ "$#" -eq 3 ]; then
+if [ "$#" -eq 3 ] || [ "$#" -eq 4 ]; then
 
    number_of_cores=$1
    metadata_file=$2
-   dir_with_cmorised_data=$3
+   # Absolute, like the paths in the change plan, such that the olists of the plan and apply runs compare equal:
+   dir_with_cmorised_data=$(realpath -s -m $3)
+   new_version=$4
 
    logdir='log-dir'
    mkdir -p ${logdir}
    olist_1_filename=${logdir}/'list-of-modified-files-1.txt'
    olist_2_filename=${logdir}/'list-of-modified-files-2.txt'
    olist_3_filename=${logdir}/'list-of-modified-files-3.txt'
+   refused_filename=${logdir}/'list-of-modified-files-2-refused.txt'
    diff_olists=${logdir}/'interruption-differences-list.txt'
+   plan_filename=${logdir}/'cmorMDfixer-plan.jsonl'
 
    log_1_filename=${logdir}/'cmorMDfixer-messages-1.log'
    log_2_filename=${logdir}/'cmorMDfixer-messages-2.log'
    log_3_filename=${logdir}/'cmorMDfixer-messages-3.log'
 
-   if [[ -e ${olist_1_filename} || -e ${olist_2_filename} || -e ${olist_3_filename} || -e ${diff_olists} ]] ; then
+   if [[ -e ${olist_1_filename} || -e ${olist_2_filename} || -e ${olist_3_filename} || -e ${refused_filename} || -e ${diff_olists} || -e ${plan_filename} ]] ; then
     echo
     echo ' Aborting' $0 ' because you have to rename any of the files with the names:'
     echo ' ' ${olist_1_filename}
     echo ' ' ${olist_2_filename}
     echo ' ' ${olist_3_filename}
+    echo ' ' ${refused_filename}
     echo ' ' ${diff_olists}
+    echo ' ' ${plan_filename}
     echo
     exit 1
    fi
@@ -62,9 +69,9 @@ if [ "$#" -eq 3 ]; then
    fi
 
 
-   echo 'Step 1: Before really applying the changes, create the olist for the --forceid case.' > ${log_1_filename}
+   echo 'Step 1: Before really applying the changes, create the olist and the change plan for the --forceid case.' > ${log_1_filename}
    echo >> ${log_1_filename}
-   ./cmorMDfixer.py --dry --verbose --forceid --olist ${logdir} --npp ${number_of_cores} ${metadata_file} ${dir_with_cmorised_data} &>> ${log_1_filename}
+   ./cmorMDfixer.py --plan ${plan_filename} --verbose --forceid --olist ${logdir} --npp ${number_of_cores} ${metadata_file} ${dir_with_cmorised_data} &>> ${log_1_filename}
 
    if [[ ! -e ${olist_1_filename} ]] ; then
     echo
@@ -73,9 +80,10 @@ if [ "$#" -eq 3 ]; then
     exit 1
    fi
 
-   echo 'Step 2: Apply the changes for the files listed in the olist for the --forceid case.' > ${log_2_filename}
+   echo 'Step 2: Apply the change plan, only the files listed in the plan are opened and changed files are refused. Each written file is read back.' > ${log_2_filename}
    echo >> ${log_2_filename}
-   ./cmorMDfixer.py --verbose --forceid --olist ${logdir} --npp ${number_of_cores} ${metadata_file} ${dir_with_cmorised_data} &>> ${log_2_filename}
+   ./cmorMDfixer.py --apply-plan ${plan_filename} --verify --verbose --olist ${logdir} --npp ${number_of_cores} &>> ${log_2_filename}
+   apply_plan_status=$?
 
    if [[ ! -e ${olist_2_filename} ]] ; then
     echo
@@ -85,7 +93,14 @@ if [ "$#" -eq 3 ]; then
    fi
 
 
-   diff ${olist_2_filename} ${olist_1_filename} > ${diff_olists}
+   # The order of the olists depends on the concurrent directory scan, so compare them sorted (without the verification status):
+   diff <(cut -f 1 ${olist_2_filename} | sort) <(sort ${olist_1_filename}) > ${diff_olists}
+
+   if [[ ${apply_plan_status} -ne 0 ]]; then
+    echo
+    echo -e "\e[1;33m Warning:\e[0m"' some files changed after the plan was made and have been refused, or failed the verification, see ' ${log_2_filename}
+    echo
+   fi
 
    if [[ ! -s ${diff_olists} ]]; then
     echo
@@ -99,9 +114,10 @@ if [ "$#" -eq 3 ]; then
    fi
 
 
-   echo 'Step 3: Check whether there are still modifications detected which should have been applied already (possibly as a consequence of an earlier interruption).' > ${log_3_filename}
-   echo >> ${log_3_filename}
-   ./cmorMDfixer.py --dry --verbose --olist ${logdir} --npp ${number_of_cores} ${metadata_file} ${dir_with_cmorised_data} &>> ${log_3_filename}
+   # Step 3: Instead of rescanning the entire dataset, the modified files which are not verified and the files which
+   # are refused (and thus not corrected) are listed:
+   { grep -v $'\tverified$' ${olist_2_filename} | cut -f 1; cat ${refused_filename} 2> /dev/null; } > ${olist_3_filename}
+   echo 'Step 3: The modified files of which the verification failed and the refused files are listed in ' ${olist_3_filename} > ${log_3_filename}
 
    if [[ ! -e ${olist_3_filename} ]] ; then
     echo
@@ -110,14 +126,20 @@ if [ "$#" -eq 3 ]; then
     exit 1
    fi
 
-   if [[ ! -s ${olist_3_filename} ]]; then
+   if [[ ! -s ${olist_3_filename} ]] && [[ ${apply_plan_status} -eq 0 ]]; then
     echo
     echo ' All files in the entire dataset are correct after correcting, so ending successful!'
     echo
    else
     echo
-    echo -e "\e[1;33m Warning:\e[0m"' After correcting with cmorMDfixer, it seems there are still errors in the dataset Check the files by looking into ' ${olist_3_filename}
+    echo -e "\e[1;33m Warning:\e[0m"' After correcting with cmorMDfixer, some files are not corrected: they are refused (see ' ${refused_filename} ') or their read back attributes differ from the written ones. Check the files by looking into ' ${olist_3_filename} ' and ' ${log_2_filename}
+    echo
+   fi
+
+   if [ -n "${new_version}" ] && [ -s ${olist_2_filename} ]; then
     echo
+    echo ' Setting the version' ${new_version} 'for the datasets with modified files:'
+    ./cmorVersions.py -v ${new_version} -m --olist ${olist_2_filename} ${dir_with_cmorised_data}
    fi
 
    echo
@@ -134,8 +156,10 @@ else
     echo "   The first  argument: is the number of cores (one node can be used)."
     echo "   The second argument: is the path + filename of the metadata json file."
     echo "   The third  argument: is the path of the directory which contains the cmorised data."
+    echo "   The optional fourth argument: is a version vYYYYMMDD, which is set for all datasets with modified files."
     echo "  For instance:"
     echo "   $0 1 metadata-file.json CMIP6/"
+    echo "   $0 1 metadata-file.json CMIP6/ v20241020"
     echo "   $0 1 metadata-correction-cases/knmi-metadata-corrections-piControl.json cmorMDfixer-test-data/test-set-01/CMIP6"
     echo
 fi
@@ -1,15 +1,32 @@
 #!/usr/bin/env python
 
 import argparse
+import cProfile
+import csv
+import io
+import fnmatch
+import glob
 import os
 import json
+import re
+import struct
 import netCDF4
+import numpy
 import logging
 import uuid
 import datetime
+import hashlib
+import sqlite3
+import sys
+import time
 import multiprocessing
+import multiprocessing.util
+import pstats
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
-from functools import partial
 
 script_version         = 'v1.0'
 script_name            = 'cmorMDfixer'
@@ -19,66 +36,1117 @@ log = logging.getLogger(os.path.basename(__file__))
 
 skipped_attributes = ["source", "comment"]
 
-log_overview_modified_attributes = ''
-
-def fix_file(path, write=True, keepid=False, forceid=False, metadata=None, add_attributes=False):
-    global log_overview_modified_attributes
-    ds = netCDF4.Dataset(path, "r+" if write else "r")
-    modified = forceid
-
-    if metadata is not None:
-        for key, val in metadata.items():
-            attname, attval = str(key), val
-            if attname.startswith('#') or attname in skipped_attributes:
-                continue
-            if (not hasattr(ds, attname) and add_attributes) or \
-                    (hasattr(ds, attname) and str(getattr(ds, attname)) != str(attval)):
-                log.info("Setting metadata field %s to %s in %s" % (attname, attval, ds.filepath()))
-                log_overview_modified_attributes=log_overview_modified_attributes+'Set ' + attname + ' to ' + str(attval) + '. '
-                if write:
-                    setattr(ds, attname, attval)
-                modified = True
-    if modified and not keepid:
+chunk_cache_minimised = False
+
+# The netCDF and HDF5 libraries are not thread-safe, the tools which call them from several threads (the converter, the
+# tree index) serialise these calls with this lock. The cmorMDfixer itself processes the files on sub-processes:
+netcdf_lock = threading.Lock()
+
+def read_global_attributes(path):
+    """Return the global attributes of a netcdf file as a dict, reading the file read-only with the smallest chunk cache."""
+    global chunk_cache_minimised
+    with netcdf_lock:
+        if not chunk_cache_minimised:
+            # Only the header is read, so the per variable chunk caches are never used:
+            netCDF4.set_chunk_cache(0, 1, 0.75)
+            chunk_cache_minimised = True
+        with netCDF4.Dataset(path, "r") as ds:
+            return {attname: ds.getncattr(attname) for attname in ds.ncattrs()}
+
+
+def compare_attributes(attributes, metadata, add_attributes=False):
+    """Return the list of (name, old value, new value) changes which make the attributes agree with the metadata.
+
+    Metadata fields starting with '#' and the skipped attributes are ignored, new attributes are only added with
+    add_attributes. The old value of an added attribute is None.
+    """
+    changes = []
+    for key, val in (metadata or {}).items():
+        attname, attval = str(key), val
+        if attname.startswith('#') or attname in skipped_attributes:
+            continue
+        if attname in attributes:
+            if str(attributes[attname]) != str(attval):
+                changes.append((attname, jsonable(attributes[attname]), attval))
+        elif add_attributes:
+            changes.append((attname, None, attval))
+    return changes
+
+
+def fix_file(path, write=True, keepid=False, forceid=False, metadata=None, add_attributes=False, attributes=None,
+             max_history=None, inplace_only=False, report=None, verify=False):
+    """Fix the global attributes of the file and return whether it is modified and the list of attribute changes.
+
+    If the attributes dict of the file is passed, the file is not probed again and the dict is updated with the
+    written values. The header write mode, see header_write_mode, is added to the report dict if it is passed. With
+    inplace_only a file is skipped when its header does not fit anymore and the entire file would be rewritten. If the
+    report contains a timings dict, the wall time of each phase is added to it. With verify a written file is reopened
+    read-only to check that all written values, including the tracking_id and the history entry, are present, and the
+    outcome is added to the report dict as verified, with the names of the mismatching attributes as unverified.
+    """
+    timings = report.get("timings") if report is not None else None
+    start = time.perf_counter()
+    # Probe the file read-only first, it is only opened for writing when it has to be modified:
+    if attributes is None:
+        attributes = read_global_attributes(path)
+        start = add_timing(timings, "probe", start)
+    changes = compare_attributes(attributes, metadata, add_attributes)
+    start = add_timing(timings, "compare", start)
+    modified = forceid or len(changes) > 0
+    if not modified:
+        return modified, changes
+
+    updates = {}
+    for attname, old, attval in changes:
+        log.info("Setting metadata field %s to %s in %s" % (attname, attval, path))
+        updates[attname] = attval
+    if not keepid:
         tr_id = '/'.join(["hdl:21.14100", (str(uuid.uuid4()))])
-        log.info("Setting tracking_id to %s for %s" % (tr_id, ds.filepath()))
-        if write:
-            setattr(ds, "tracking_id", tr_id)
-    if modified:
-        history = getattr(ds, "history", "")
-        creation_date = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-        log.info("Appending message about modification to the history attribute.")
-        log.info('Set attribute %s to %s' % (latest_applied_version, script_version))
-        if write:
-            if log_overview_modified_attributes == '':
-             log_overview_modified_attributes = 'No attribute has been modified.'
-            setattr(ds, latest_applied_version, script_version)
-            setattr(ds, "history", history + '%s: Metadata update by applying the %s %s: %s \n' % (creation_date, script_name, script_version, log_overview_modified_attributes))
-    ds.close()
-    return modified
-
-
-def process_file(path, npp=1, flog=None, write=True, keepid=False, forceid=False, metadata=None, add_attributes=False):
+        log.info("Setting tracking_id to %s for %s" % (tr_id, path))
+        updates["tracking_id"] = tr_id
+    creation_date = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+    log.info("Appending message about modification to the history attribute.")
+    log.info('Set attribute %s to %s' % (latest_applied_version, script_version))
+    updates[latest_applied_version] = script_version
+    updates["history"] = append_history(attributes.get("history", ""), '%s: Metadata update by applying the %s %s: %s \n' % (creation_date, script_name, script_version, history_overview(changes)), max_history)
+
+    start = time.perf_counter()
+    header = header_write_mode(path, attributes, updates)
+    start = add_timing(timings, "header", start)
+    log.info("The header of %s will be updated %s" % (path, header))
+    if report is not None:
+        report["header"] = header
+    if header == "rewrite" and inplace_only:
+        log.warning("Skipping %s because its header does not fit anymore and the entire file would be rewritten" % path)
+        if report is not None:
+            report["skipped"] = True
+        return False, changes
+    if write:
+        ds = netCDF4.Dataset(path, "r+")
+        try:
+            start = add_timing(timings, "open", start)
+            # All at once, such that a classic format header is rewritten only once:
+            ds.setncatts(updates)
+            start = add_timing(timings, "setncatts", start)
+        finally:
+            ds.close()
+        start = add_timing(timings, "close", start)
+        if verify:
+            mismatches = [attname for attname, old, attval in compare_attributes(read_global_attributes(path), updates, True)]
+            add_timing(timings, "verify", start)
+            if mismatches:
+                log.error("Verification of %s failed, the read back values of %s differ from the written ones" %
+                          (path, ", ".join(mismatches)))
+            if report is not None:
+                report["verified"] = not mismatches
+                if mismatches:
+                    report["unverified"] = mismatches
+        attributes.update(updates)
+    return modified, changes
+
+
+def history_overview(changes):
+    """Return the overview of the attribute changes of one file for its history entry."""
+    if not changes:
+        return 'No attribute has been modified.'
+    return ''.join('Set %s to %s. ' % (attname, attval) for attname, old, attval in changes)
+
+
+def add_timing(timings, phase, start):
+    """Add the wall time since start to the phase in the timings dict, unless timings is None, and return the current time."""
+    now = time.perf_counter()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.) + now - start
+    return now
+
+
+history_entry_pattern = re.compile(r"^\S+: Metadata update by applying the %s " % script_name)
+
+
+def append_history(history, entry, max_history=None):
+    """Append the entry to the history, keeping at most max_history (including the new one) cmorMDfixer entries."""
+    if max_history is not None:
+        lines = history.splitlines(True)
+        own = [i for i, line in enumerate(lines) if history_entry_pattern.match(line)]
+        drop = set(own[:max(0, len(own) - max_history + 1)])
+        history = ''.join(line for i, line in enumerate(lines) if i not in drop)
+    return history + entry
+
+
+# Sizes of the netcdf classic format data types (nc_type 1 to 11):
+classic_type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+
+def pad4(nbytes):
+    return (nbytes + 3) & ~3
+
+
+def classic_header_layout(path):
+    """Return the netcdf classic format version, the header size and the offset of the first data of a classic
+    format (CDF-1, CDF-2 or CDF-5) file, or None for other (e.g. HDF5 based) files."""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+        if len(magic) < 4 or magic[:3] != b"CDF" or magic[3] not in (1, 2, 5):
+            return None
+        version = magic[3]
+        size_format = ">q" if version == 5 else ">i"
+        offset_format = ">i" if version == 1 else ">q"
+
+        def read(fmt):
+            return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+
+        def skip_name():
+            f.seek(pad4(read(size_format)), os.SEEK_CUR)
+
+        def skip_attributes():
+            read(">i")
+            for _ in range(read(size_format)):
+                skip_name()
+                nc_type = read(">i")
+                f.seek(pad4(read(size_format) * classic_type_sizes[nc_type]), os.SEEK_CUR)
+
+        try:
+            read(size_format)                                     # numrecs
+            read(">i")
+            for _ in range(read(size_format)):                    # dimensions
+                skip_name()
+                read(size_format)
+            skip_attributes()                                     # global attributes
+            read(">i")
+            begins = []
+            for _ in range(read(size_format)):                    # variables
+                skip_name()
+                f.seek(read(size_format) * struct.calcsize(size_format), os.SEEK_CUR)
+                skip_attributes()
+                read(">i")
+                read(size_format)
+                begins.append(read(offset_format))
+            header_size = f.tell()
+        except (struct.error, KeyError):
+            return None
+        data_begin = min(begins) if begins else os.fstat(f.fileno()).st_size
+    return version, header_size, data_begin
+
+
+def classic_attribute_size(attname, value, version):
+    """Return the number of bytes the attribute occupies in a netcdf classic format header."""
+    count_size = 8 if version == 5 else 4
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        nbytes = len(value.encode("utf-8"))
+    else:
+        values = numpy.atleast_1d(numpy.asarray(value))
+        itemsize = values.dtype.itemsize
+        if version != 5 and values.dtype.kind in "iu":
+            itemsize = min(itemsize, 4)
+        nbytes = values.size * itemsize
+    return count_size + pad4(len(attname.encode("utf-8"))) + 4 + count_size + pad4(nbytes)
+
+
+def header_write_mode(path, attributes, updates):
+    """Return how the header update is written: 'in-place' or 'rewrite'.
+
+    For a netcdf classic format file the new header size is computed from the attribute encodings. If it exceeds the
+    space before the first data, the library moves all data and the entire file is rewritten. HDF5 based files do not
+    move their data when attributes grow, the header grows in free space or at the end of the file, so these are
+    reported as in-place.
+    """
+    layout = classic_header_layout(path)
+    if layout is None:
+        return "in-place"
+    version, header_size, data_begin = layout
+    growth = sum(classic_attribute_size(attname, value, version) -
+                 classic_attribute_size(attname, attributes.get(attname), version) for attname, value in updates.items())
+    return "in-place" if header_size + growth <= data_begin else "rewrite"
+
+
+# The facets of the CMIP6 (and CMIP6Plus) DRS directory structure, the file name is the last path element:
+drs_facets = ("activity_id", "institution_id", "source_id", "experiment_id", "member_id", "table_id", "variable_id",
+              "grid_label", "version")
+drs_facet_aliases = {"activity": "activity_id", "institution": "institution_id", "source": "source_id",
+                     "experiment": "experiment_id", "member": "member_id", "variant_label": "member_id",
+                     "table": "table_id", "variable": "variable_id", "grid": "grid_label"}
+drs_version_pattern = re.compile(r"v\d{8}$")
+drs_mip_eras = ("CMIP6", "CMIP6Plus")
+time_range_pattern = re.compile(r"_(\d{4,14})-(\d{4,14})(?:-clim)?\.nc$")
+
+
+def facet_name(name):
+    facet = drs_facet_aliases.get(name, name)
+    if facet not in drs_facets:
+        raise ValueError("Unknown DRS facet %s, choose from: %s" % (name, ", ".join(drs_facets)))
+    return facet
+
+
+def parse_drs_path(path):
+    """Return a dict with the DRS facets of the path of a file in a CMIP6 DRS tree, or an empty dict if the path does
+    not end with a DRS directory structure. Only the path is used, the file is not opened."""
+    parts = path.rsplit(os.sep, len(drs_facets) + 1)
+    if len(parts) != len(drs_facets) + 2 or not drs_version_pattern.match(parts[-2]):
+        return {}
+    return dict(zip(drs_facets, parts[1:-1]))
+
+
+def time_range_bounds(start, end):
+    """Return the time range START-END (YYYY[MM[DD[hh[mm[ss]]]]]) as the comparable strings of its first and last second."""
+    return start + "0101000000"[len(start) - 4:], end + "1231235959"[len(end) - 4:]
+
+
+class PathFilter(object):
+    """Include and exclude filters on the DRS facets and the time range of a file, which only use its path.
+
+    The filters are given as FACET=VALUE[,VALUE...], in which the values may contain shell wildcards. A file is included
+    if for each facet of the include filters it matches one of their values, and it is excluded if it matches any value
+    of an exclude filter. The values of each facet are compiled into a single regular expression. Files which are not
+    in a DRS tree do not pass an include filter. With a time range START-END a file passes if the time range in its
+    name overlaps with it, files without a time range in their name (e.g. fx files) always pass.
+    """
+
+    def __init__(self, include=(), exclude=(), timerange=None):
+        self.include = self.compile(include)
+        self.exclude = self.compile(exclude)
+        self.timerange = None
+        if timerange:
+            match = re.match(r"^(\d{4,14})-(\d{4,14})$", timerange)
+            if not match:
+                raise ValueError("Invalid time range %s, expected START-END, e.g. 1850-1900 or 185001-190012" % timerange)
+            self.timerange = time_range_bounds(*match.groups())
+
+    @staticmethod
+    def compile(specs):
+        patterns = {}
+        for spec in specs:
+            name, sep, values = spec.partition("=")
+            if not sep or not values:
+                raise ValueError("Invalid filter %s, expected FACET=VALUE[,VALUE...]" % spec)
+            patterns.setdefault(facet_name(name.strip()), []).extend(value.strip() for value in values.split(","))
+        return {facet: re.compile("|".join(fnmatch.translate(value) for value in values))
+                for facet, values in patterns.items()}
+
+    def __bool__(self):
+        return bool(self.include or self.exclude or self.timerange)
+
+    def rejects(self, facet, value):
+        if facet in self.include and not self.include[facet].match(value):
+            return True
+        return facet in self.exclude and self.exclude[facet].match(value) is not None
+
+    def prune(self, dirpath):
+        """Return whether no file below the directory can pass the facet filters, which is known for a directory
+        below a mip_era (e.g. CMIP6) directory from the facets of its path."""
+        parts = dirpath.split(os.sep)
+        for i in range(len(parts) - 1, -1, -1):
+            if parts[i] in drs_mip_eras:
+                facets = parts[i + 1:]
+                if len(facets) > len(drs_facets):
+                    return False
+                return any(self.rejects(facet, value) for facet, value in zip(drs_facets, facets))
+        return False
+
+    def accept(self, path):
+        if self.include or self.exclude:
+            facets = parse_drs_path(path)
+            if not facets and self.include:
+                return False
+            if any(self.rejects(facet, value) for facet, value in facets.items()):
+                return False
+        if self.timerange:
+            match = time_range_pattern.search(path)
+            if match:
+                start, end = time_range_bounds(*match.groups())
+                return start <= self.timerange[1] and end >= self.timerange[0]
+        return True
+
+
+class RuleSet(object):
+    """Metadata corrections which apply to the files selected by their DRS facets.
+
+    A rules file contains {"rules": [{"select": {facet: value(s)}, "attributes": {...}}, ...]}, a plain metadata
+    file (a dict with the attributes only) is a single rule without selectors which applies to all files. A rule
+    applies to a file if for each selected facet its value is one of the given values. The rules are indexed per
+    combination of selected facets, such that resolving the attributes of a file takes a dict lookup per combination.
+    If several rules set the same attribute, the last one wins. Several files can be combined in the given order.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = []
+        self.index = {}
+        self.facets = ()
+        self.memo = {}
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def load(cls, fnames):
+        ruleset = cls()
+        for fname in fnames:
+            with open(fname) as jsonfile:
+                content = json.load(jsonfile)
+            if isinstance(content, dict) and "rules" in content:
+                for rule in content["rules"]:
+                    ruleset.add(rule, fname)
+            else:
+                ruleset.add({"attributes": content}, fname)
+        return ruleset
+
+    def add(self, rule, fname=None):
+        if not isinstance(rule, dict) or not isinstance(rule.get("attributes"), dict):
+            raise ValueError("Each rule in %s needs an attributes dict" % fname)
+        select = {}
+        for name, values in sorted(rule.get("select", {}).items()):
+            select[facet_name(name)] = [values] if isinstance(values, str) else list(values)
+        facets = tuple(sorted(select))
+        keys = [()]
+        for facet in facets:
+            keys = [key + (value,) for key in keys for value in select[facet]]
+        entries = self.index.setdefault(facets, {})
+        for key in keys:
+            entries.setdefault(key, []).append((len(self.rules), rule["attributes"]))
+        self.rules.append({"select": select, "attributes": rule["attributes"]})
+        self.facets = tuple(sorted(set(self.facets).union(facets)))
+        self.memo.clear()
+
+    def resolve(self, path):
+        """Return the metadata attributes which apply to the file and the hash of these attributes."""
+        facets = parse_drs_path(path)
+        key = tuple(facets.get(facet) for facet in self.facets)
+        if key not in self.memo:
+            matches = []
+            for selected, entries in self.index.items():
+                if all(facet in facets for facet in selected):
+                    matches.extend(entries.get(tuple(facets[facet] for facet in selected), []))
+            metadata = {}
+            for order, attributes in sorted(matches, key=lambda match: match[0]):
+                metadata.update(attributes)
+            self.memo[key] = metadata, run_signature(metadata=metadata)
+        return self.memo[key]
+
+    def signature(self):
+        return run_signature(rules=self.rules)
+
+
+def jsonable(value):
+    # Attribute values read by netCDF4 can be numpy scalars or arrays:
+    return value.tolist() if hasattr(value, "tolist") else value
+
+
+def file_fingerprint(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+
+def process_file(path, write=True, keepid=False, forceid=False, metadata=None, add_attributes=False, fingerprint=False,
+                 cache_state=False, max_history=None, inplace_only=False, rules=None, timings=False, verify=False):
+    """Fix a single file and return a record with its path, whether it was modified and the attribute changes.
+
+    If a RuleSet is given as rules, the metadata which applies to the file is taken from it. A file to which no rule
+    applies is not opened, unless forceid is set. With cache_state the record also contains the state of the file after
+    processing, if it complies with the metadata by then (and its written values are not unverified): its fingerprint.
+    With timings the record contains the wall time of each processing phase and the size of the file. With verify the
+    record of a written file tells whether the read back values are verified, see fix_file.
+    """
+    record = {"path": path, "modified": False}
+    start = time.perf_counter()
+    if timings:
+        record["timings"] = {}
+    if rules is not None:
+        metadata = rules.resolve(path)[0]
+        start = add_timing(record.get("timings"), "rules", start)
+        if not metadata and not forceid:
+            return record
     try:
-        modified = fix_file(path, write, keepid, forceid, metadata, add_attributes)
-        if modified:
-            if npp != 1:
-                flog.put(path)
-            elif hasattr(flog, "write"):
-                flog.write(path + '\n')
+        if fingerprint:
+            record["fingerprint"] = file_fingerprint(path)
+        if timings:
+            record["bytes"] = os.stat(path).st_size
+            start = time.perf_counter()
+        attributes = read_global_attributes(path)
+        add_timing(record.get("timings"), "probe", start)
+        record["modified"], record["changes"] = fix_file(path, write, keepid, forceid, metadata, add_attributes, attributes,
+                                                         max_history, inplace_only, record, verify)
+        # A file of which the read back values could not be verified is not cached, such that it is checked again:
+        if cache_state and (write or not record["changes"]) and not record.get("skipped") \
+                and record.get("verified") is not False:
+            record["state"] = {"fingerprint": file_fingerprint(path)}
     except IOError as io_err:
-        log.error("An IO error for file %s occurred: %s" % (path, io_err.message))
+        log.error("An IO error for file %s occurred: %s" % (path, io_err))
+        record["error"] = str(io_err)
     except AttributeError as att_err:
-        log.error("An attribute error for file %s occurred: %s" % (path, att_err.message))
+        log.error("An attribute error for file %s occurred: %s" % (path, att_err))
+        record["error"] = str(att_err)
+    return record
+
+
+def apply_plan_entry(entry, write=True, keepid=False, max_history=None, inplace_only=False, timings=False, verify=False):
+    """Apply the attribute changes of one plan entry, unless the file changed since the plan was made."""
+    path = entry["path"]
+    try:
+        current = file_fingerprint(path)
+    except OSError as os_err:
+        current = str(os_err)
+    if current != entry["fingerprint"]:
+        log.error("Refusing to apply the plan to %s: the file changed since the plan was made" % path)
+        return {"path": path, "modified": False, "refused": True}
+    metadata = {attname: new for attname, old, new in entry["changes"]}
+    return process_file(path, write, keepid, forceid=True, metadata=metadata, add_attributes=True,
+                        max_history=max_history, inplace_only=inplace_only, timings=timings, verify=verify)
+
+
+def inventory_file(path, long_value=80, timings=False):
+    """Return a record with the global attributes of the file, of which the values longer than long_value characters are
+    replaced by their sha1 hash, their length and a short preview, such that they are grouped by hash in the inventory."""
+    record = {"path": path, "modified": False, "attributes": {}}
+    start = time.perf_counter()
+    if timings:
+        record["timings"] = {}
+    try:
+        if timings:
+            record["bytes"] = os.stat(path).st_size
+        attributes = read_global_attributes(path)
+        add_timing(record.get("timings"), "probe", start)
+    except IOError as io_err:
+        log.error("An IO error for file %s occurred: %s" % (path, io_err))
+        record["error"] = str(io_err)
+        return record
+    for attname, value in attributes.items():
+        value = jsonable(value)
+        text = value if isinstance(value, str) else json.dumps(value)
+        if len(text) > long_value:
+            value = {"sha1": hashlib.sha1(text.encode("utf-8", "surrogateescape")).hexdigest(), "length": len(text),
+                     "preview": text[:long_value // 2] + "..."}
+        record["attributes"][attname] = value
+    return record
+
+
+class Inventory(object):
+    """Summary of the global attributes of a set of files: per attribute its distinct values, with for each value the
+    number of files which have it and a few example paths. The long values are grouped by their hash."""
+
+    def __init__(self, nexamples=3):
+        self.nexamples = nexamples
+        self.files = self.errors = 0
+        self.attributes = {}
+
+    def add(self, record):
+        self.files += 1
+        if "error" in record:
+            self.errors += 1
+            return
+        for attname, value in record["attributes"].items():
+            key = json.dumps(value, sort_keys=True)
+            entry = self.attributes.setdefault(attname, {}).get(key)
+            if entry is None:
+                entry = self.attributes[attname][key] = {"value": value, "files": 0, "examples": []}
+            entry["files"] += 1
+            if len(entry["examples"]) < self.nexamples:
+                entry["examples"].append(record["path"])
+
+    def summary(self):
+        attributes = {}
+        for attname in sorted(self.attributes):
+            values = sorted(self.attributes[attname].values(), key=lambda entry: -entry["files"])
+            nfiles = sum(entry["files"] for entry in values)
+            attributes[attname] = {"files": nfiles, "missing": self.files - self.errors - nfiles,
+                                   "distinct_values": len(values), "values": values}
+        return {"files": self.files, "errors": self.errors, "attributes": attributes}
+
+    def write(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def write_plan_header(pfile, **settings):
+    header = dict(plan=script_name, version=script_version,
+                  created=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"), **settings)
+    pfile.write(json.dumps(header) + '\n')
+
+
+def write_plan_entry(pfile, record):
+    entry = {key: record[key] for key in ("path", "fingerprint", "changes")}
+    # Like the datadir in the header, such that the plan can be applied from any directory:
+    entry["path"] = os.path.abspath(entry["path"])
+    pfile.write(json.dumps(entry) + '\n')
+
+
+def read_plan(fname):
+    """Return the header of the plan file and a generator over its per file entries."""
+    pfile = open(fname)
+    header = json.loads(pfile.readline())
+    if header.get("plan") != script_name:
+        pfile.close()
+        raise ValueError("%s is not a %s plan file" % (fname, script_name))
+
+    def entries():
+        with pfile:
+            for line in pfile:
+                if line.strip():
+                    yield json.loads(line)
+    return header, entries()
+
+
+# The worker function and its keyword arguments, sent once to each pool worker instead of with every task, and the
+# thread pool of a worker of the hybrid backend:
+worker_function = process_file
+worker_settings = {}
+worker_executor = None
+
+
+def init_worker(function, settings, profile=None, nthreads=1):
+    global worker_function, worker_settings, worker_executor
+    worker_function, worker_settings = function, settings
+    if nthreads > 1:
+        worker_executor = ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix="fix")
+    if profile:
+        # Each worker profiles itself and dumps its statistics when it exits after the pool is closed:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        multiprocessing.util.Finalize(None, dump_profile, args=(profiler, "%s.worker-%d" % (profile, os.getpid())),
+                                      exitpriority=10)
+
+
+def dump_profile(profiler, fname):
+    profiler.disable()
+    profiler.dump_stats(fname)
+
+
+def merge_profiles(fname):
+    """Merge the profile statistics dumped by the workers into fname and remove the per worker files."""
+    parts = sorted(glob.glob(glob.escape(fname) + ".worker-*"))
+    if not parts:
+        return 0
+    stats = pstats.Stats(*parts)
+    stats.dump_stats(fname)
+    for part in parts:
+        os.remove(part)
+    return len(parts)
+
+
+def process_chunk(items):
+    if worker_executor is not None:
+        return list(worker_executor.map(process_item, items))
+    return [worker_function(item, **worker_settings) for item in items]
+
+
+def process_item(item):
+    return worker_function(item, **worker_settings)
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
+def dispatch(items, npp=1, chunksize=16, settings=None, function=process_file, on_dispatch=None, profile=None,
+             backend="processes", nthreads=1):
+    """Apply function (default process_file) lazily to the items and yield each record as soon as it is done.
 
-def listener(q, fname):
-    with open(fname, 'w') as flog:
-        while 1:
-            elem = q.get()
-            if elem == "kill":
+    With npp > 1 the items are sent in chunks to a pool of npp workers, of which at most 2 * npp chunks are in flight.
+    The items iterable is consumed only as fast as the workers proceed, so memory use does not grow with the number of
+    files and the workers return their results directly instead of through a manager queue. If given, on_dispatch is
+    called with each chunk just before it is processed. With a profile file name each pool worker is profiled and its
+    statistics are dumped to profile.worker-PID, see merge_profiles.
+
+    With the threads backend the items are processed by a pool of nthreads threads in this process instead, of which at
+    most 2 * nthreads items are in flight. With the hybrid backend each of the npp pool workers processes its chunks with
+    its own pool of nthreads threads. The threads are meant for functions of which the work is done outside netCDF, like
+    the file copies of the converter and the hashing of the checksums, their netCDF calls have to take the netcdf_lock.
+    """
+    settings = settings or {}
+    if backend == "threads" or (backend == "hybrid" and npp == 1):
+        yield from dispatch_threads(items, nthreads, chunksize, settings, function, on_dispatch)
+        return
+    if npp == 1:
+        for chunk in chunked(items, chunksize if on_dispatch else 1):
+            if on_dispatch:
+                on_dispatch(chunk)
+            for item in chunk:
+                yield function(item, **settings)
+        return
+
+    slots = threading.BoundedSemaphore(2 * npp)
+    stop = threading.Event()
+
+    def throttled(chunks):
+        for chunk in chunks:
+            while not slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            if on_dispatch:
+                on_dispatch(chunk)
+            yield chunk
+
+    try:
+        initargs = (function, settings, profile, nthreads if backend == "hybrid" else 1)
+        with multiprocessing.Pool(processes=npp, initializer=init_worker, initargs=initargs) as pool:
+            for results in pool.imap_unordered(process_chunk, throttled(chunked(items, chunksize))):
+                slots.release()
+                yield from results
+            # Let the workers exit normally, such that their finalizers run:
+            pool.close()
+            pool.join()
+    finally:
+        stop.set()
+
+
+def dispatch_threads(items, nthreads, chunksize, settings, function, on_dispatch=None):
+    """Apply function to the items on a pool of nthreads threads and yield the records in the order they complete."""
+    inflight = set()
+    executor = ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix="fix")
+    try:
+        for chunk in chunked(items, chunksize):
+            if on_dispatch:
+                on_dispatch(chunk)
+            for item in chunk:
+                inflight.add(executor.submit(function, item, **settings))
+            while len(inflight) >= 2 * nthreads:
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while inflight:
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in inflight:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def item_path(item):
+    # The dispatched items are either paths or plan entries:
+    return item if isinstance(item, str) else item["path"]
+
+
+class Journal(object):
+    """Append-only journal of the files started and completed by a run, which allows to resume an interrupted run.
+
+    Each line is either a header line '# <signature>' written at the (re)start of a run, 'S<tab>path' when a file is
+    handed out for processing, or 'D<tab>path<tab>status' when it is done, with status m (modified), u (unmodified),
+    e (error) or r (refused). The start records are synced before the files are processed, the done records are synced
+    in batches. Files which are started but not done at the moment of an interruption are possibly partially written.
+    """
+
+    statuses = {"m": "modified", "u": "unmodified", "e": "error", "r": "refused"}
+
+    def __init__(self, fname, signature, resume=False, sync_every=256, sync_interval=5.0):
+        self.fname = fname
+        self.done, self.interrupted = {}, []
+        if resume and os.path.isfile(fname):
+            self.read(signature)
+        elif os.path.exists(fname):
+            raise ValueError("The journal %s already exists, use --resume or remove it" % fname)
+        self.sync_every, self.sync_interval = sync_every, sync_interval
+        self.pending, self.last_sync = 0, time.monotonic()
+        self.lock = threading.Lock()
+        self.jfile = open(fname, 'a', buffering=1 << 16)
+        if self.jfile.tell() > 0:
+            with open(fname, 'rb') as jfile:
+                jfile.seek(-1, os.SEEK_END)
+                if jfile.read(1) != b'\n':
+                    self.jfile.write('\n')
+        self.jfile.write("# %s\n" % signature)
+        self.sync()
+
+    def read(self, signature):
+        started, header = set(), None
+        with open(self.fname) as jfile:
+            for line in jfile:
+                if not line.endswith('\n'):
+                    continue  # A torn last line of an interrupted run
+                fields = line[:-1].split('\t')
+                if fields[0].startswith('# '):
+                    header = fields[0][2:]
+                elif fields[0] == 'S' and len(fields) == 2:
+                    started.add(fields[1])
+                elif fields[0] == 'D' and len(fields) == 3 and fields[2] in self.statuses:
+                    self.done[fields[1]] = fields[2]
+        if header != signature:
+            raise ValueError("The journal %s belongs to a run with other settings or metadata" % self.fname)
+        self.interrupted = sorted(started.difference(self.done))
+
+    def sync(self):
+        self.jfile.flush()
+        os.fsync(self.jfile.fileno())
+        self.pending, self.last_sync = 0, time.monotonic()
+
+    def started(self, items):
+        with self.lock:
+            self.jfile.write(''.join('S\t%s\n' % item_path(item) for item in items))
+            self.sync()
+
+    def completed(self, record):
+        if record.get("refused"):
+            status = "r"
+        elif "error" in record:
+            status = "e"
+        else:
+            status = "m" if record["modified"] else "u"
+        with self.lock:
+            self.jfile.write('D\t%s\t%s\n' % (record["path"], status))
+            self.pending += 1
+            if self.pending >= self.sync_every or time.monotonic() - self.last_sync > self.sync_interval:
+                self.sync()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.jfile.close()
+
+
+class ChangeLog(object):
+    """Structured log of the attribute changes, with one row per modified file, written in batches.
+
+    The format follows from the file name: a .csv file gets the columns path, written, header and changes, the latter
+    as a json list of [attribute, old value, new value] triples, any other file gets one json object per line. In a dry
+    run written is false and the rows list the changes which would have been made.
+    """
+
+    columns = ["path", "written", "header", "changes"]
+
+    def __init__(self, fname, written=True, batch_size=1000):
+        if os.path.exists(fname):
+            raise ValueError("The change log %s already exists" % fname)
+        self.csv = fname.endswith(".csv")
+        self.written, self.batch_size = written, batch_size
+        self.batch = []
+        self.cfile = open(fname, 'w', newline='' if self.csv else None)
+        if self.csv:
+            csv.writer(self.cfile).writerow(self.columns)
+
+    def add(self, record):
+        if not record["modified"]:
+            return
+        self.batch.append({"path": record["path"], "written": self.written, "header": record.get("header"),
+                           "changes": [list(change) for change in record.get("changes", [])]})
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.csv:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in self.batch:
+                writer.writerow([row["path"], row["written"], row["header"] or "", json.dumps(row["changes"], default=jsonable)])
+            self.cfile.write(buffer.getvalue())
+        else:
+            self.cfile.write(''.join(json.dumps(row, default=jsonable) + '\n' for row in self.batch))
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.cfile.close()
+
+
+class AttributeCache(object):
+    """SQLite cache of the files which complied with the metadata when they were last checked.
+
+    A file is identified by its path, inode, size and modification time. The hash of the metadata it complied with is
+    stored, so a file with an unchanged fingerprint need not be opened again when the same metadata is applied.
+    """
+
+    def __init__(self, fname, commit_every=1000):
+        # With npp > 1 the lookups are done in the task feeding thread of the pool:
+        self.connection = sqlite3.connect(fname, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER,"
+                                " mtime_ns INTEGER, metadata_hash TEXT)")
+        self.commit_every, self.pending = commit_every, 0
+
+    def complies(self, path, metadata_hash):
+        with self.lock:
+            row = self.connection.execute("SELECT inode, size, mtime_ns, metadata_hash FROM files WHERE path = ?",
+                                          (os.path.abspath(path),)).fetchone()
+        if row is None or row[3] != metadata_hash:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return row[:3] == (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def filter(self, paths, metadata_hash):
+        # The metadata_hash function returns the hash of the metadata which applies to a path:
+        self.skipped = 0
+        for path in paths:
+            if self.complies(path, metadata_hash(path)):
+                self.skipped += 1
+            else:
+                yield path
+
+    def store(self, path, state, metadata_hash):
+        fingerprint = state["fingerprint"]
+        with self.lock:
+            # With the column names, such that the cache files of earlier versions (with more columns) remain usable:
+            self.connection.execute("INSERT OR REPLACE INTO files (path, inode, size, mtime_ns, metadata_hash) VALUES (?, ?, ?, ?, ?)",
+                                    (os.path.abspath(path), fingerprint["inode"], fingerprint["size"],
+                                     fingerprint["mtime_ns"], metadata_hash))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.connection.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class RunMetrics(object):
+    """Per phase wall times, throughput and bytes of a run, aggregated from the records of all (pool worker) processes.
+
+    The time of each phase is summed over all files, in the parallel case the worker phases are thus summed over the
+    workers. For each phase a histogram of the per file times is kept, with the upper bounds in seconds given in bounds.
+    The walk phase is the time the consumer of the scan waited for the next file.
+    """
+
+    bounds = [1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.]
+
+    def __init__(self):
+        self.start = self.last_time = time.perf_counter()
+        self.files = self.last_files = 0
+        self.modified = self.errors = 0
+        self.bytes = {"probed": 0, "modified": 0}
+        self.header_modes = {"in-place": 0, "rewrite": 0}
+        self.phases = {}
+
+    def add_phase(self, phase, seconds):
+        entry = self.phases.get(phase)
+        if entry is None:
+            entry = self.phases[phase] = {"count": 0, "total": 0., "max": 0., "histogram": [0] * (len(self.bounds) + 1)}
+        entry["count"] += 1
+        entry["total"] += seconds
+        entry["max"] = max(entry["max"], seconds)
+        i = 0
+        while i < len(self.bounds) and seconds > self.bounds[i]:
+            i += 1
+        entry["histogram"][i] += 1
+
+    def add(self, record):
+        self.files += 1
+        if record["modified"]:
+            self.modified += 1
+            self.bytes["modified"] += record.get("bytes", 0)
+        if "error" in record:
+            self.errors += 1
+        self.bytes["probed"] += record.get("bytes", 0)
+        if "header" in record:
+            self.header_modes[record["header"]] += 1
+        for phase, seconds in record.get("timings", {}).items():
+            self.add_phase(phase, seconds)
+
+    def timed(self, items, phase="walk"):
+        """Yield the items, timing how long each next item takes."""
+        start = time.perf_counter()
+        for item in items:
+            self.add_phase(phase, time.perf_counter() - start)
+            yield item
+            start = time.perf_counter()
+
+    def progress(self, interval):
+        """Return a progress line if at least interval seconds passed since the last one, otherwise None."""
+        now = time.perf_counter()
+        if now - self.last_time < interval:
+            return None
+        rate = (self.files - self.last_files) / (now - self.last_time)
+        self.last_time, self.last_files = now, self.files
+        return "%s: %d files processed, %d modified, %d errors, %.1f files/s (%.1f files/s overall)" % (
+               script_name, self.files, self.modified, self.errors, rate, self.files / (now - self.start))
+
+    def summary(self, **settings):
+        elapsed = time.perf_counter() - self.start
+        return {"settings": settings, "elapsed": elapsed, "files": self.files, "modified": self.modified,
+                "errors": self.errors, "files_per_second": self.files / elapsed if elapsed > 0 else 0.,
+                "bytes": self.bytes, "header_modes": self.header_modes, "histogram_bounds": self.bounds, "phases": self.phases}
+
+    def write(self, fname, **settings):
+        with open(fname, 'w') as f:
+            json.dump(self.summary(**settings), f, indent=2)
+
+    @staticmethod
+    def merge(summaries):
+        """Merge the summaries of concurrent runs (e.g. shards), the elapsed time is the one of the slowest run."""
+        merged = {"settings": [summary["settings"] for summary in summaries],
+                  "elapsed": max(summary["elapsed"] for summary in summaries), "files": 0, "modified": 0, "errors": 0,
+                  "bytes": {"probed": 0, "modified": 0}, "header_modes": {"in-place": 0, "rewrite": 0},
+                  "histogram_bounds": RunMetrics.bounds, "phases": {}}
+        for summary in summaries:
+            for key in ["files", "modified", "errors"]:
+                merged[key] += summary[key]
+            for group in ["bytes", "header_modes"]:
+                for key, value in summary[group].items():
+                    merged[group][key] += value
+            for phase, entry in summary["phases"].items():
+                total = merged["phases"].setdefault(phase, {"count": 0, "total": 0., "max": 0.,
+                                                            "histogram": [0] * len(entry["histogram"])})
+                total["count"] += entry["count"]
+                total["total"] += entry["total"]
+                total["max"] = max(total["max"], entry["max"])
+                total["histogram"] = [a + b for a, b in zip(total["histogram"], entry["histogram"])]
+        merged["files_per_second"] = merged["files"] / merged["elapsed"] if merged["elapsed"] > 0 else 0.
+        return merged
+
+
+def parse_shard(value):
+    """Parse the shard argument I/N, with 0 <= I < N, into the tuple (I, N)."""
+    match = re.match(r"^(\d+)/(\d+)$", value)
+    if not match or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError("invalid shard %s, expected I/N with 0 <= I < N" % value)
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_of(path, root, nshards, by="file"):
+    """Return the shard of the path, from a stable hash of its path relative to the absolute root directory.
+
+    With by="dataset" the hash of the directory of the file is used instead, such that all files of a dataset (version
+    directory) end up in the same shard. The shard does not depend on the way the data directory is spelled.
+    """
+    relpath = os.path.abspath(path)[len(root):].lstrip(os.sep)
+    if by == "dataset":
+        relpath = os.path.dirname(relpath)
+    return zlib.crc32(relpath.encode("utf-8", "surrogateescape")) % nshards
+
+
+def shard_filename(fname, shard):
+    """Return the name of the output file fname of the shard (I, N): NAME-shard-I-of-N.EXT"""
+    root, ext = os.path.splitext(fname)
+    return "%s-shard-%d-of-%d%s" % (root, shard[0], shard[1], ext)
+
+
+def merge_shards(logdir, nshards, ofilename, metrics_fname=None):
+    """Merge the modified file lists of all nshards shards in logdir into the sorted list ofilename.
+
+    With metrics_fname, the metrics files of the shards are merged into metrics_fname as well. Returns the number of
+    listed files. An IOError is raised if the output of any shard is missing.
+    """
+    shards = [(i, nshards) for i in range(nshards)]
+    olists = [os.path.join(logdir, shard_filename("list-of-modified-files.txt", shard)) for shard in shards]
+    mfiles = [shard_filename(metrics_fname, shard) for shard in shards] if metrics_fname else []
+    missing = [fname for fname in olists + mfiles if not os.path.isfile(fname)]
+    if missing:
+        raise IOError("the output of %d shards is missing: %s" % (len(missing), " ".join(missing)))
+    paths = set()
+    for fname in olists:
+        with open(fname, 'r') as f:
+            paths.update(line.rstrip('\n') for line in f if line.strip())
+    with open(ofilename, 'w', buffering=1 << 16) as f:
+        for path in sorted(paths):
+            f.write(path + '\n')
+    if metrics_fname:
+        summaries = []
+        for fname in mfiles:
+            with open(fname, 'r') as f:
+                summaries.append(json.load(f))
+        with open(metrics_fname, 'w') as f:
+            json.dump(RunMetrics.merge(summaries), f, indent=2)
+    return len(paths)
+
+
+def metadata_hash(metadata_signature, add_attributes=False):
+    return run_signature(metadata=metadata_signature, add_attributes=add_attributes, skipped_attributes=skipped_attributes)
+
+
+def run_signature(**settings):
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def scan_files(odir, depth=None, nthreads=1, suffix=".nc", path_filter=None, symlinks=False):
+    """Yield all regular (non-symlink) files ending with suffix below odir, with symlinks also the symlinks to files.
+
+    With a PathFilter the directories which it prunes are not entered and only the files it accepts are yielded.
+    Symlinked directories are never entered.
+
+    Directories are only entered while their level is below depth, using the same level convention as the former
+    os.walk based loop, i.e. root[len(odir):].count(os.sep) < depth. The entry types reported by os.scandir are used,
+    so no extra stat calls are made per file. With nthreads > 1 the directory listings are spread over a thread pool
+    and the paths are yielded while the scan proceeds, so the consumer does not wait for the full enumeration.
+    """
+    def level(root):
+        return root[len(odir):].count(os.sep)
+
+    def list_dir(root):
+        files, subdirs = [], []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if (depth is None or level(entry.path) < depth) and not (path_filter and path_filter.prune(entry.path)):
+                                subdirs.append(entry.path)
+                        elif entry.name.endswith(suffix) and entry.is_file(follow_symlinks=symlinks):
+                            if not path_filter or path_filter.accept(entry.path):
+                                files.append(entry.path)
+                    except OSError as os_err:
+                        log.error("Skipping %s: %s" % (entry.path, os_err))
+        except OSError as os_err:
+            log.error("Unable to list directory %s: %s" % (root, os_err))
+        return files, subdirs
+
+    if depth is not None and depth <= 0:
+        return
+    if nthreads <= 1:
+        # Depth first, in the same order as os.walk(odir, followlinks=False):
+        stack = [odir]
+        while stack:
+            files, subdirs = list_dir(stack.pop())
+            yield from files
+            stack.extend(reversed(subdirs))
+        return
+
+    results = queue.Queue(maxsize=4 * nthreads)
+    stop = threading.Event()
+    pending = [1]
+    lock = threading.Lock()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def visit(root):
+        try:
+            if stop.is_set():
+                return
+            files, subdirs = list_dir(root)
+            with lock:
+                pending[0] += len(subdirs)
+            for subdir in subdirs:
+                executor.submit(visit, subdir)
+            if files:
+                put(files)
+        except Exception as scan_err:
+            # The futures of the visits are not inspected, so an unexpected error is reported here (unless the consumer
+            # stopped the scan, after which new visits can not be submitted anymore):
+            if not stop.is_set():
+                log.error("Unable to scan directory %s: %s" % (root, scan_err))
+        finally:
+            with lock:
+                pending[0] -= 1
+                done = pending[0] == 0
+            if done:
+                put(None)
+
+    executor = ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix="scan")
+    try:
+        executor.submit(visit, odir)
+        while True:
+            files = results.get()
+            if files is None:
                 break
-            flog.write(str(elem) + '\n')
-            flog.flush()
+            yield from files
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
 
 
 def main(args=None):
@@ -87,12 +1155,23 @@ def main(args=None):
     ofilename = "list-of-modified-files-1.txt"
     formatter = lambda prog: argparse.HelpFormatter(prog,max_help_position=30)
     parser = argparse.ArgumentParser(description="Fix meta data i.e. CMOR attributes in cmorized files", formatter_class=formatter)
-    parser.add_argument("meta", metavar="FILE.json", type=str,
+    parser.add_argument("meta", metavar="FILE.json", type=str, nargs="?",
                         help="The attribute values in this metadata file will be used to overwrite the corresponding attributes in the cmorised data. "
                              "This will apply to ALL netcdf files recursively found in your data directory. New attributes in this "
-                             "file will be skipped unless the --addatts option is used.")
-    parser.add_argument("datadir", metavar="DIR", type=str, help="Directory containing cmorized files")
+                             "file will be skipped unless the --addatts option is used. Alternatively this is a rules file, in "
+                             "which each block of attributes applies only to the files selected by their DRS facets.")
+    parser.add_argument("datadir", metavar="DIR", type=str, nargs="?", help="Directory containing cmorized files")
+    parser.add_argument("--rules", "-r", metavar="FILE.json", type=str, action="append", default=[],
+                        help="Additional metadata or rules file, applied after FILE.json (can be repeated)")
     parser.add_argument("--depth", "-d", type=int, help="Directory recursion depth (default: infinite)")
+    parser.add_argument("--include", metavar="FACET=VALUES", type=str, action="append", default=[],
+                        help="Only process the files of which the DRS facet (e.g. table, variable, experiment) matches one of "
+                             "the comma separated VALUES, which may contain wildcards, judged from the path only (can be repeated)")
+    parser.add_argument("--exclude", metavar="FACET=VALUES", type=str, action="append", default=[],
+                        help="Skip the files of which the DRS facet matches one of the comma separated VALUES (can be repeated)")
+    parser.add_argument("--timerange", metavar="START-END", type=str, default=None,
+                        help="Only process the files of which the time range in the file name overlaps with START-END, "
+                             "e.g. 1850-1900 or 185001-190012. Files without a time range are always processed.")
     parser.add_argument("--verbose", "-v", action="store_true", default=False,
                         help="Run verbosely (default: off)")
     parser.add_argument("--dry", "-s", action="store_true", default=False,
@@ -106,20 +1185,110 @@ def main(args=None):
     parser.add_argument("--addattrs", "-a", action="store_true", default=False,
                         help="Add new attributes from metadata file")
     parser.add_argument("--npp", type=int, default=1, help="Number of sub-processes to launch (default 1)")
+    parser.add_argument("--chunksize", type=int, default=16,
+                        help="Number of files sent at once to a sub-process, only used with npp > 1 (default 16)")
+    parser.add_argument("--scanthreads", type=int, default=8,
+                        help="Number of threads listing directories concurrently, 1 gives a serial scan (default 8)")
+    parser.add_argument("--index", metavar="FILE", type=str, default=None,
+                        help="Take the files from the tree index FILE (see cmorTreeIndex.py), which is refreshed first by only "
+                             "listing the changed directories, instead of scanning DIR. The files are listed with absolute paths.")
+    parser.add_argument("--plan", metavar="OUT", type=str, default=None,
+                        help="Dry run which writes the attribute changes and a fingerprint of each file to be modified to the plan file OUT")
+    parser.add_argument("--apply-plan", metavar="PLAN", type=str, default=None,
+                        help="Apply the changes listed in the PLAN file written by --plan, without scanning the data directory. "
+                             "Files which changed since the plan was made are refused, with the olist option they are listed in "
+                             "the olist file name with the suffix -refused. FILE.json and DIR are not needed.")
+    parser.add_argument("--journal", metavar="FILE", type=str, default=None,
+                        help="Keep an append-only journal of the started and completed files in FILE")
+    parser.add_argument("--cache", metavar="FILE", type=str, nargs="?", const=True, default=None,
+                        help="Skip files which complied with the same metadata at an earlier run and did not change since, "
+                             "according to the SQLite cache FILE (default FILE: cmorMDfixer-cache.sqlite in the olist LOGDIR)")
+    parser.add_argument("--maxhistory", metavar="N", type=int, default=None,
+                        help="Keep at most N cmorMDfixer entries in the history attribute, dropping the oldest ones "
+                             "(default: keep all)")
+    parser.add_argument("--inplace-only", action="store_true", default=False,
+                        help="Skip netcdf classic format files of which the header does not fit anymore, such that the "
+                             "entire file would be rewritten (default: no)")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Resume an interrupted run with the same arguments: skip the files completed in the --journal "
+                             "and reprocess the files which were interrupted (default: no)")
+    parser.add_argument("--inventory", metavar="OUT", type=str, default=None,
+                        help="Read-only inventory of the global attributes of all files in DIR: write for each attribute its "
+                             "distinct values with their file counts and example paths as json to OUT. FILE.json is not needed.")
+    parser.add_argument("--changelog", metavar="FILE", type=str, default=None,
+                        help="Write the attribute changes of each modified file, with their old and new values, to FILE "
+                             "as json lines, or as csv if FILE ends with .csv")
+    parser.add_argument("--metrics", metavar="FILE", type=str, default=None,
+                        help="Write the per phase timings, throughput and bytes of the run as json to FILE")
+    parser.add_argument("--progress", metavar="SECONDS", type=float, nargs="?", const=10., default=None,
+                        help="Print a progress and throughput line on stderr every SECONDS (default SECONDS: 10)")
+    parser.add_argument("--profile", metavar="FILE", type=str, default=None,
+                        help="Profile the run with cProfile, each worker separately, and write the merged statistics to FILE")
+    parser.add_argument("--shard", metavar="I/N", type=parse_shard, default=None,
+                        help="Only process shard I (0 <= I < N) of N disjoint shards of the files, e.g. one per SLURM array "
+                             "task. The olist, plan, journal, cache, metrics and profile files get the suffix -shard-I-of-N")
+    parser.add_argument("--shard-by", choices=["file", "dataset"], default="file",
+                        help="Assign the files to the shards by the hash of their path, or by the hash of their dataset "
+                             "(version) directory, such that each dataset is handled by one shard (default: file)")
+    parser.add_argument("--merge-shards", metavar="N", type=int, default=None,
+                        help="Merge the olists of the N shards in the olist LOGDIR into one sorted list, and with --metrics "
+                             "FILE their metrics into FILE. FILE.json and DIR are not needed.")
+    parser.add_argument("--verify", action="store_true", default=False,
+                        help="Reopen each modified file read-only after writing it, to check that the written attributes, "
+                             "tracking_id and history entry are present. The olist gets a second, tab separated column with "
+                             "the status verified or failed (unverified for files of an interrupted run) (default: no)")
+    parser.add_argument("--set-version", metavar="VERSION", type=str, default=None,
+                        help="After the run, move all files of the datasets with modified files to the version directory "
+                             "VERSION (see cmorVersions.py). In a dry run only the planned moves are printed.")
+    parser.add_argument("--checksums", metavar="MANIFEST", type=str, default=None,
+                        help="After the run, write the SHA256 checksums of the modified files to MANIFEST, as an esgmapfile "
+                             "if it ends with .map and otherwise in the sha256sum format (see cmorChecksums.py). With the olist "
+                             "option the checksums are cached in cmorChecksums-cache.sqlite in LOGDIR.")
 
-    args = parser.parse_args()
+    args = parser.parse_intermixed_args()
 
-    # Obligatory arguments:
-    metajson = args.meta
-    if not os.path.isfile(metajson):
-        log.error("The metadata json file argument %s is not a valid file: Skipping the metadata modification." % metajson)
-        return
-    with open(metajson) as jsonfile:
-        metadata = json.load(jsonfile)
-    odir = args.datadir
-    if not os.path.isdir(odir):
-        log.error("Data directory argument %s is not a valid directory: Skipping the metadata modification." % odir)
-        return
+    # Obligatory arguments, which are taken from the plan file when a plan is applied:
+    if args.merge_shards is not None:
+        if not args.olist or args.shard or args.merge_shards < 1:
+            parser.error("option merge-shards requires a positive N and the olist option, and excludes the shard option")
+    elif args.inventory:
+        if args.datadir is None:
+            args.meta, args.datadir = None, args.meta
+        if args.datadir is None:
+            parser.error("the following arguments are required: DIR")
+        if args.plan or args.apply_plan or args.cache or args.forceid:
+            parser.error("option inventory can not be combined with the plan, apply-plan, cache and forceid options")
+        metajson, odir, rules = [], args.datadir, None
+        if not os.path.isdir(odir):
+            log.error("Data directory argument %s is not a valid directory: Skipping the inventory." % odir)
+            return
+    elif args.apply_plan:
+        if args.plan:
+            log.error("Options plan and apply-plan are mutually exclusive, please choose either the one or the other.")
+            return
+        try:
+            plan_header, plan_entries = read_plan(args.apply_plan)
+        except (IOError, ValueError) as plan_err:
+            log.error("Unable to read the plan file %s: %s" % (args.apply_plan, plan_err))
+            return
+        metajson, odir, rules = plan_header["metadata"], plan_header["datadir"], None
+    else:
+        if args.meta is None or args.datadir is None:
+            parser.error("the following arguments are required: FILE.json, DIR")
+        metajson = [args.meta] + args.rules
+        for fname in metajson:
+            if not os.path.isfile(fname):
+                log.error("The metadata json file argument %s is not a valid file: Skipping the metadata modification." % fname)
+                return
+        try:
+            rules = RuleSet.load(metajson)
+        except ValueError as rules_err:
+            log.error("Invalid metadata or rules file: %s" % rules_err)
+            return
+        odir = args.datadir
+        if not os.path.isdir(odir):
+            log.error("Data directory argument %s is not a valid directory: Skipping the metadata modification." % odir)
+            return
 
     # Optional arguments:
     # depth:
@@ -135,11 +1304,70 @@ def main(args=None):
     if args.keepid and args.forceid:
         log.error("Options keepid and forceid are mutually exclusive, please choose either the one or the other.")
         return
+    # include, exclude & timerange:
+    try:
+        path_filter = PathFilter(args.include, args.exclude, args.timerange)
+    except ValueError as filter_err:
+        log.error("Invalid filter: %s" % filter_err)
+        return
+    # shard:
+    if args.shard:
+        for option in ["plan", "journal", "inventory", "changelog", "metrics", "profile", "checksums"]:
+            if getattr(args, option):
+                setattr(args, option, shard_filename(getattr(args, option), args.shard))
+        if isinstance(args.cache, str):
+            args.cache = shard_filename(args.cache, args.shard)
+        ofilename = shard_filename("list-of-modified-files.txt", args.shard)
+    # plan:
+    if args.plan and os.path.exists(args.plan):
+        log.error("Abort because the plan file %s already exists." % args.plan)
+        return
+    # maxhistory:
+    if args.maxhistory is not None and args.maxhistory < 1:
+        log.error("Invalid maximum number of history entries chosen, please pick a positive number")
+        return
+    # journal & resume:
+    if args.resume and (not args.journal or args.plan):
+        log.error("Option resume requires the journal option and can not be combined with the plan option.")
+        return
     # npp:
     npp=args.npp
     if npp < 1 or npp > 128:
         log.error("Invalid number of subprocesses chosen, please pick a number in the range: 1 - 128")
         return
+    # chunksize:
+    if args.chunksize < 1:
+        log.error("Invalid chunk size chosen, please pick a positive number")
+        return
+    # scanthreads:
+    if args.scanthreads < 1:
+        log.error("Invalid number of scan threads chosen, please pick a positive number")
+        return
+    # index:
+    if args.index and (depth is not None or args.apply_plan):
+        log.error("Option index can not be combined with the depth and apply-plan options")
+        return
+    # verify:
+    if args.verify and (args.dry or args.plan or args.inventory):
+        log.error("Option verify can not be combined with the dry, plan and inventory options")
+        return
+    # set-version:
+    if args.set_version:
+        from cmorVersions import version_pattern
+        if not version_pattern.match(args.set_version):
+            log.error("Invalid version string %s, it must match v20[0-9][0-9][01][0-9][0-9][0-9]" % args.set_version)
+            return
+        if args.inventory or (args.shard and args.shard_by != "dataset"):
+            log.error("Option set-version can not be combined with the inventory option, nor with sharding by file")
+            return
+    # checksums:
+    if args.checksums and (args.inventory or args.dry or args.plan):
+        log.error("Option checksums can not be combined with the inventory, dry and plan options")
+        return
+    # progress:
+    if args.progress is not None and args.progress <= 0:
+        log.error("Invalid progress interval chosen, please pick a positive number of seconds")
+        return
     # olist (LOGDIR/list-of-modified-files):
     logdir = getattr(args, "olist", None)
     if logdir:
@@ -153,7 +1381,12 @@ def main(args=None):
        else:
           Path(logdir).mkdir(parents=True, exist_ok=True)
        ofilename = os.path.join(logdir, ofilename)
-       if os.path.isfile(ofilename):
+       if args.shard:
+        # The olist of a shard has a fixed name, such that the shards can be merged:
+        if os.path.isfile(ofilename) and not args.resume:
+            log.error("Abort because the olist %s of this shard already exists." % ofilename)
+            return
+       elif os.path.isfile(ofilename):
         i = 1
         while os.path.isfile(ofilename):
             i += 1
@@ -161,40 +1394,244 @@ def main(args=None):
             log.warning("Output file name %s already exists, trying %s" % (ofilename, newfilename))
             ofilename = newfilename
 
-    # Sequential or parallel call:
-    if npp == 1:
-        ofile = open(ofilename, 'w') if logdir else None
-        worker = partial(process_file, npp=1, flog=ofile, write=not args.dry, keepid=args.keepid, forceid=args.forceid,
-                         metadata=metadata, add_attributes=args.addattrs)
-        for root, dirs, files in os.walk(odir, followlinks=False):
-            if depth is None or root[len(odir):].count(os.sep) < int(depth):
-                for filepath in files:
-                    fullpath = os.path.join(root, filepath)
-                    if not os.path.islink(fullpath) and filepath.endswith(".nc"):
-                        worker(fullpath)
+    # merge-shards:
+    if args.merge_shards is not None:
+        try:
+            nfiles = merge_shards(logdir, args.merge_shards, ofilename, args.metrics)
+        except (IOError, ValueError) as merge_err:
+            log.error("Unable to merge the shards: %s" % merge_err)
+            return 1
+        log.info("Merged the olists of %d shards into %s, listing %d modified files" % (args.merge_shards, ofilename, nfiles))
+        return
+
+    # metrics & progress:
+    metrics = RunMetrics() if args.metrics or args.progress else None
+    index, written, modified = None, [], []
+
+    # Sequential or parallel call, in the parallel case the list of modified files is always written:
+    if args.apply_plan:
+        items, function = plan_entries, apply_plan_entry
+        settings = dict(write=not args.dry, keepid=plan_header["keepid"], max_history=args.maxhistory,
+                        inplace_only=args.inplace_only, verify=args.verify)
     else:
-        considered_files = []
-        for root, dirs, files in os.walk(odir, followlinks=False):
-            if depth is None or root[len(odir):].count(os.sep) < int(depth):
-                for filepath in files:
-                    fullpath = os.path.join(root, filepath)
-                    if not os.path.islink(fullpath) and filepath.endswith(".nc"):
-                        considered_files.append(fullpath)
-        manager = multiprocessing.Manager()
-        fq = manager.Queue()
-        pool = multiprocessing.Pool(processes=npp)
-        watcher = pool.apply_async(func=listener, args=(fq, ofilename))
-        jobs = []
-        for f in considered_files:
-            job = pool.apply_async(func=process_file, args=(f, npp, fq, not args.dry, args.keepid, args.forceid, metadata, args.addattrs))
-            jobs.append(job)
-        for job in jobs:
-            job.get()
-        # now we are done, kill the listener
-        fq.put("kill")
-        pool.close()
-        pool.join()
+        if args.index:
+            from cmorTreeIndex import TreeIndex
+            index = TreeIndex(args.index)
+            stats = index.refresh(odir, args.scanthreads)
+            log.info("Refreshed the index %s of %s: listed %d of %d directories, added %d, removed %d and updated %d files" %
+                     (args.index, odir, stats["listed"], stats["directories"], stats["added"], stats["removed"],
+                      stats["changed"]))
+            items, function = index.files(odir, path_filter or None), process_file
+            if not (args.forceid or args.inventory):
+                # The files of which the attributes cached in the index are up to date and comply are not opened:
+                items = index.filter_compliant(items, lambda path: rules.resolve(path)[0], args.addattrs)
+        else:
+            items, function = scan_files(odir, depth, args.scanthreads, path_filter=path_filter or None), process_file
+        if metrics is not None:
+            items = metrics.timed(items)
+        settings = dict(write=not (args.dry or args.plan), keepid=args.keepid, forceid=args.forceid, rules=rules,
+                        add_attributes=args.addattrs, fingerprint=bool(args.plan), max_history=args.maxhistory,
+                        inplace_only=args.inplace_only, verify=args.verify)
+        if args.inventory:
+            function, settings = inventory_file, {}
+    if args.apply_plan and path_filter:
+        items = (item for item in items if path_filter.accept(item["path"]))
+    if args.shard:
+        shard_root = os.path.abspath(odir)
+        items = (item for item in items
+                 if shard_of(item_path(item), shard_root, args.shard[1], args.shard_by) == args.shard[0])
+    if metrics is not None:
+        settings["timings"] = True
+    # changelog:
+    changelog = None
+    if args.changelog:
+        try:
+            changelog = ChangeLog(args.changelog, written=not (args.dry or args.plan))
+        except (IOError, ValueError) as changelog_err:
+            log.error("Abort because of the change log: %s" % changelog_err)
+            return
+    # cache:
+    cache = None
+    if args.cache:
+        if args.cache is True:
+            if not logdir:
+                log.error("Option cache without a FILE requires the olist option.")
+                return
+            args.cache = os.path.join(logdir, "cmorMDfixer-cache.sqlite")
+            if args.shard:
+                args.cache = shard_filename(args.cache, args.shard)
+        if not args.apply_plan:
+            try:
+                cache = AttributeCache(args.cache)
+            except sqlite3.Error as cache_err:
+                log.error("Abort because the cache %s can not be used: %s" % (args.cache, cache_err))
+                return
+            settings["cache_state"] = True
+
+            def file_metadata_hash(path):
+                return metadata_hash(rules.resolve(path)[1], args.addattrs)
+
+            if not args.forceid:
+                items = cache.filter(items, file_metadata_hash)
+
+    journal, interrupted = None, set()
+    if args.journal:
+        signature = run_signature(rules=rules and rules.signature(), datadir=os.path.abspath(odir), depth=depth, dry=args.dry,
+                                  keepid=args.keepid, forceid=args.forceid, addattrs=args.addattrs, plan=args.plan,
+                                  apply_plan=args.apply_plan and os.path.abspath(args.apply_plan),
+                                  shard=args.shard and [args.shard, args.shard_by],
+                                  filters=[sorted(args.include), sorted(args.exclude), args.timerange],
+                                  inventory=bool(args.inventory))
+        try:
+            journal = Journal(args.journal, signature, resume=args.resume)
+        except (IOError, ValueError) as journal_err:
+            log.error("Abort because of the journal: %s" % journal_err)
+            return
+        interrupted = set(journal.interrupted)
+        for path in journal.interrupted:
+            log.warning("Processing of %s has been interrupted, it will be reprocessed and is listed as possibly modified" % path)
+        if journal.done:
+            log.warning("Resuming: skipping %d files completed according to the journal %s" % (len(journal.done), args.journal))
+            items = (item for item in items if item_path(item) not in journal.done)
+    ofile = open(ofilename, 'w', buffering=1 << 16) if logdir or npp != 1 else None
+    if ofile is not None and journal is not None:
+        # The modified files of the interrupted run(s), such that the list covers the entire resumed run:
+        for path, status in journal.done.items():
+            if status == "m":
+                ofile.write(path + ('\tunverified\n' if args.verify else '\n'))
+        for path in journal.interrupted:
+            ofile.write(path + ('\tunverified\n' if args.verify else '\n'))
+    pfile = open(args.plan, 'w', buffering=1 << 16) if args.plan else None
+    if pfile is not None:
+        write_plan_header(pfile, metadata=[os.path.abspath(fname) for fname in metajson], datadir=os.path.abspath(odir),
+                          keepid=args.keepid, forceid=args.forceid, addattrs=args.addattrs)
+    refused, unverified = [], 0
+    header_modes = {"in-place": 0, "rewrite": 0}
+    inventory = Inventory() if args.inventory else None
+    profiler = None
+    if args.profile and npp == 1:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        for record in dispatch(items, npp, args.chunksize, settings, function, journal and journal.started,
+                               args.profile if npp != 1 else None):
+            if metrics is not None:
+                metrics.add(record)
+                line = args.progress and metrics.progress(args.progress)
+                if line:
+                    print(line, file=sys.stderr, flush=True)
+            if inventory is not None:
+                inventory.add(record)
+            if journal is not None:
+                journal.completed(record)
+            if cache is not None and "state" in record:
+                cache.store(record["path"], record["state"], file_metadata_hash(record["path"]))
+            if record.get("refused"):
+                refused.append(record["path"])
+            if "header" in record:
+                header_modes[record["header"]] += 1
+            if record["modified"]:
+                if args.verify and not record.get("verified"):
+                    unverified += 1
+                if ofile is not None and record["path"] not in interrupted:
+                    if args.verify:
+                        ofile.write("%s\t%s\n" % (record["path"], "verified" if record.get("verified") else "failed"))
+                    else:
+                        ofile.write(record["path"] + '\n')
+                if pfile is not None:
+                    write_plan_entry(pfile, record)
+                if index is not None and settings.get("write"):
+                    written.append(record["path"])
+                if args.set_version or args.checksums:
+                    modified.append(record["path"])
+                if changelog is not None:
+                    changelog.add(record)
+    finally:
+        if profiler is not None:
+            dump_profile(profiler, args.profile)
+        elif args.profile:
+            log.info("Merged the profiles of %d workers into %s" % (merge_profiles(args.profile), args.profile))
+        if ofile is not None:
+            ofile.close()
+        if pfile is not None:
+            pfile.close()
+        if changelog is not None:
+            changelog.close()
+        if index is not None:
+            if hasattr(index, "skipped"):
+                log.info("Skipped %d files which comply with the metadata according to the attributes cached in the index %s" %
+                         (index.skipped, args.index))
+            # The files are modified in place, which does not change the modification time of their directory:
+            index.restat(written)
+            index.close()
+        if journal is not None:
+            journal.close()
+        if cache is not None:
+            log.info("Skipped %d files which comply with the metadata according to the cache %s" % (getattr(cache, "skipped", 0), args.cache))
+            cache.close()
+    log.info("Header updates: %d in-place, %d requiring a rewrite of the entire file%s" %
+             (header_modes["in-place"], header_modes["rewrite"], " (skipped)" if args.inplace_only else ""))
+    if inventory is not None:
+        inventory.write(args.inventory)
+        log.info("Wrote the inventory of the global attributes of %d files to %s" % (inventory.files, args.inventory))
+    if args.progress:
+        print(metrics.progress(0), file=sys.stderr, flush=True)
+    if journal is not None and (args.set_version or args.checksums):
+        # Including the files modified by the interrupted run(s):
+        modified.extend(path for path, status in journal.done.items() if status == "m")
+        modified.extend(journal.interrupted)
+    if args.set_version:
+        from cmorVersions import modified_version_dirs, set_version
+        move = not (args.dry or args.plan)
+        counts = set_version(modified_version_dirs(modified), args.set_version, move, args.scanthreads)
+        log.info("Version %s: %s %d files of %d datasets in %d version directories, %d collisions" %
+                 (args.set_version, "moved" if move else "planned to move", counts.get("moved", counts["files"]),
+                  counts["datasets"], counts["directories"], counts["collisions"]))
+        if counts["collisions"] or counts.get("failures"):
+            log.error("Setting the version %s skipped %d colliding files and failed for %d files" %
+                      (args.set_version, counts["collisions"], counts.get("failures", 0)))
+        if move:
+            def moved_path(path):
+                # The path of the file in the new version directory, if it has been moved there:
+                new_path = os.path.join(os.path.dirname(os.path.dirname(path)), args.set_version, os.path.basename(path))
+                return new_path if not os.path.exists(path) and os.path.exists(new_path) else path
 
+            modified = [moved_path(path) for path in modified]
+            refused = [moved_path(path) for path in refused]
+            if ofile is not None:
+                # The olist is rewritten with the new paths, keeping the status column of a verified run:
+                with open(ofilename, 'r') as f:
+                    lines = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+                with open(ofilename, 'w', buffering=1 << 16) as f:
+                    for fields in lines:
+                        f.write('\t'.join([moved_path(fields[0])] + fields[1:]) + '\n')
+    if args.checksums:
+        from cmorChecksums import write_checksums
+        cache_fname = os.path.join(logdir, "cmorChecksums-cache.sqlite") if logdir else None
+        if cache_fname and args.shard:
+            cache_fname = shard_filename(cache_fname, args.shard)
+        counts = write_checksums(args.checksums, sorted(set(modified)), cache_fname, npp,
+                                 "threads" if npp == 1 else "processes")
+        log.info("Wrote the checksums of %d modified files to %s: %d hashed, %d taken from the cache" %
+                 (counts["listed"], args.checksums, counts["hashed"], counts["reused"]))
+        if counts["failed"]:
+            log.error("Unable to checksum %d modified files" % counts["failed"])
+    if args.metrics:
+        metrics.write(args.metrics, npp=npp, chunksize=args.chunksize, scanthreads=args.scanthreads, dry=args.dry,
+                      plan=args.plan, apply_plan=args.apply_plan)
+    if unverified:
+        log.error("The verification of %d modified files failed, see the failed status in the olist" % unverified)
+    if args.apply_plan and logdir:
+        # The refused files are not corrected, they are listed next to the olist:
+        rfilename = os.path.splitext(ofilename)[0] + "-refused.txt"
+        with open(rfilename, 'w') as rfile:
+            for path in sorted(refused):
+                rfile.write(path + '\n')
+    if refused:
+        log.error("%d files in the plan %s changed since the plan was made and have been refused%s." %
+                  (len(refused), args.apply_plan, ", see %s" % rfilename if logdir else ""))
+    if refused or unverified:
+        return 1
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
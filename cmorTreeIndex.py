@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# SQLite index of a cmorised directory tree, shared by the cmorMDfixer, the CMIP6Plus converter and versions.sh.
+#
+# The index holds each file with its DRS facets, its stat info and optionally its global attributes. A refresh only
+# lists the directories of which the modification time changed since the last refresh, the other directories are only
+# stat-ed and their content is taken from the index. Note that the modification time of a directory changes when
+# entries are added, removed or renamed in it, but not when a file in it is modified in place (as the cmorMDfixer
+# does), so the refresh also stats the indexed files of the unchanged directories and updates their stat info. The
+# cmorMDfixer does not open the files of which the cached global attributes are up to date and already comply with
+# the metadata.
+#
+# Examples:
+#  ./cmorTreeIndex.py --db tree-index.sqlite refresh CMIP6/
+#  ./cmorTreeIndex.py --db tree-index.sqlite list --include table=Omon CMIP6/
+#  ./cmorTreeIndex.py --db tree-index.sqlite versions CMIP6/
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cmorMDfixer import drs_facets, parse_drs_path, PathFilter, read_global_attributes, jsonable, compare_attributes
+
+log = logging.getLogger(os.path.basename(__file__))
+
+default_db = "cmor-tree-index.sqlite"
+
+
+def prefix_range(root):
+    # All paths below root sort between root + '/' and root + '0', the character after '/':
+    return root.rstrip(os.sep) + os.sep, root.rstrip(os.sep) + chr(ord(os.sep) + 1)
+
+
+class TreeIndex(object):
+    """SQLite index of the files below one or more root directories, see the module description."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, "
+                        "mtime_ns INTEGER, inode INTEGER, %s, attributes TEXT, attributes_stat TEXT)" %
+                        ", ".join("%s TEXT" % facet for facet in drs_facets))
+        self.db.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def visit(path, known_mtime, suffix):
+        """Stat the directory and list it if its modification time differs from known_mtime.
+
+        Returns (mtime, files, subdirs) in which files is a list of (path, size, mtime_ns, inode) and files and subdirs
+        are None for an unchanged directory, or None if the directory does not exist anymore.
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime == known_mtime:
+            return mtime, None, None
+        files, subdirs = [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.name.endswith(suffix) and entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            files.append((entry.path, st.st_size, st.st_mtime_ns, st.st_ino))
+                    except OSError as os_err:
+                        log.warning("Skipping %s: %s" % (entry.path, os_err))
+        except OSError as os_err:
+            log.warning("Unable to list directory %s: %s" % (path, os_err))
+            return None
+        return mtime, files, subdirs
+
+    @staticmethod
+    def changed_files(known_files):
+        """Return the (path, size, mtime_ns, inode) of the known files of which the stat info changed, e.g. by an in-place
+        modification, which does not change the modification time of their directory."""
+        changed = []
+        for path, size, mtime_ns, inode in known_files:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns, st.st_ino) != (size, mtime_ns, inode):
+                changed.append((path, st.st_size, st.st_mtime_ns, st.st_ino))
+        return changed
+
+    def remove_tree(self, path):
+        """Remove the directory and everything below it from the index and return the number of removed files."""
+        low, high = prefix_range(path)
+        self.db.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high))
+        return self.db.execute("DELETE FROM files WHERE path >= ? AND path < ?", (low, high)).rowcount
+
+    def update_dir(self, path, parent, mtime, files, subdirs):
+        """Replace the content of a listed directory in the index and return the number of added and removed files."""
+        known_files = {row[0]: row[1:] for row in
+                       self.db.execute("SELECT path, size, mtime_ns, inode FROM files WHERE dir = ?", (path,))}
+        listed = {f[0] for f in files}
+        removed = [p for p in known_files if p not in listed]
+        self.db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+        added, nremoved = 0, len(removed)
+        for fpath, size, mtime_ns, inode in files:
+            known = known_files.get(fpath)
+            if known is None:
+                facets = parse_drs_path(fpath)
+                self.db.execute("INSERT INTO files (path, dir, size, mtime_ns, inode, %s) VALUES (?, ?, ?, ?, ?, %s)" %
+                                (", ".join(drs_facets), ", ".join("?" * len(drs_facets))),
+                                [fpath, path, size, mtime_ns, inode] + [facets.get(facet) for facet in drs_facets])
+                added += 1
+            elif tuple(known) != (size, mtime_ns, inode):
+                self.db.execute("UPDATE files SET size = ?, mtime_ns = ?, inode = ? WHERE path = ?",
+                                (size, mtime_ns, inode, fpath))
+        for (subdir,) in self.db.execute("SELECT path FROM dirs WHERE parent = ?", (path,)).fetchall():
+            if subdir not in subdirs:
+                nremoved += self.remove_tree(subdir)
+        self.db.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)", (path, parent, mtime))
+        return added, nremoved
+
+    def refresh(self, root, nthreads=8, suffix=".nc", restat=False):
+        """Bring the index of the tree below root up to date and return a dict with the refresh statistics.
+
+        The directories are visited level by level, each level concurrently on nthreads threads. Only the directories
+        of which the modification time changed are listed, with restat all directories are listed. The indexed files of
+        the directories which are not listed are stat-ed, to update the stat info of the files modified in place.
+        """
+        root = os.path.abspath(root)
+        low, high = prefix_range(root)
+        with self.lock:
+            known = {row[0]: row[1:] for row in self.db.execute(
+                "SELECT path, parent, mtime_ns FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (root, low, high))}
+        children = {}
+        for path, (parent, mtime) in known.items():
+            children.setdefault(parent, []).append(path)
+        stats = {"directories": 0, "listed": 0, "added": 0, "removed": 0, "changed": 0}
+
+        def visit(item):
+            result = self.visit(item[0], None if restat else known.get(item[0], (None, None))[1], suffix)
+            if result is None or result[1] is not None:
+                return result, []
+            with self.lock:
+                known_files = self.db.execute("SELECT path, size, mtime_ns, inode FROM files WHERE dir = ?",
+                                              (item[0],)).fetchall()
+            return result, self.changed_files(known_files)
+
+        level = [(root, os.path.dirname(root))]
+        with ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix="index") as executor:
+            while level:
+                # All results first, the visits take the lock themselves:
+                results = list(executor.map(visit, level))
+                next_level = []
+                with self.lock:
+                    for (path, parent), (result, changed) in zip(level, results):
+                        stats["directories"] += 1
+                        if result is None:
+                            stats["removed"] += self.remove_tree(path)
+                            continue
+                        mtime, files, subdirs = result
+                        if files is None:
+                            self.db.executemany("UPDATE files SET size = ?, mtime_ns = ?, inode = ? WHERE path = ?",
+                                                [(size, mtime_ns, inode, fpath) for fpath, size, mtime_ns, inode in changed])
+                            stats["changed"] += len(changed)
+                            next_level.extend((subdir, path) for subdir in children.get(path, []))
+                            continue
+                        stats["listed"] += 1
+                        added, removed = self.update_dir(path, parent, mtime, files, subdirs)
+                        stats["added"] += added
+                        stats["removed"] += removed
+                        next_level.extend((subdir, path) for subdir in subdirs)
+                    self.db.commit()
+                level = next_level
+        return stats
+
+    def restat(self, paths):
+        """Update the stat info of files which have been modified in place."""
+        with self.lock:
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                self.db.execute("UPDATE files SET size = ?, mtime_ns = ?, inode = ? WHERE path = ?",
+                                (st.st_size, st.st_mtime_ns, st.st_ino, os.path.abspath(path)))
+            self.db.commit()
+
+    def files(self, root, path_filter=None, batchsize=10000):
+        """Yield the (absolute) paths of the indexed files below root, which pass the PathFilter if one is given.
+
+        The rows are fetched in batches of batchsize, the lock is only held while a batch is fetched.
+        """
+        root = os.path.abspath(root)
+        low, high = prefix_range(root)
+        with self.lock:
+            cursor = self.db.execute("SELECT path FROM files WHERE path >= ? AND path < ? ORDER BY path", (low, high))
+        try:
+            while True:
+                with self.lock:
+                    rows = cursor.fetchmany(batchsize)
+                if not rows:
+                    break
+                for (path,) in rows:
+                    if not path_filter or path_filter.accept(path):
+                        yield path
+        finally:
+            with self.lock:
+                cursor.close()
+
+    def versions(self, root):
+        """Return the sorted (absolute) paths of the version directories below root, also the empty ones."""
+        root = os.path.abspath(root)
+        low, high = prefix_range(root)
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT path FROM dirs WHERE path >= ? AND path < ? AND path GLOB ? ORDER BY path",
+                (low, high, "*%sv20[0-9][0-9][01][0-9][0-9][0-9]" % os.sep))]
+
+    def cache_attributes(self, root, nthreads=8):
+        """Read and store the global attributes of the files below root of which the stat info changed since they
+        were last stored, and return the number of files read."""
+        root = os.path.abspath(root)
+        low, high = prefix_range(root)
+        with self.lock:
+            todo = [row[0] for row in self.db.execute(
+                "SELECT path FROM files WHERE path >= ? AND path < ? AND "
+                "(attributes_stat IS NULL OR attributes_stat != size || ':' || mtime_ns || ':' || inode)", (low, high))]
+
+        def read(path):
+            try:
+                st = os.stat(path)
+                attributes = {name: jsonable(value) for name, value in read_global_attributes(path).items()}
+                return path, json.dumps(attributes), "%d:%d:%d" % (st.st_size, st.st_mtime_ns, st.st_ino)
+            except (IOError, OSError) as io_err:
+                log.warning("Unable to read the attributes of %s: %s" % (path, io_err))
+                return None
+
+        with ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix="index") as executor:
+            results = [result for result in executor.map(read, todo) if result is not None]
+        with self.lock:
+            self.db.executemany("UPDATE files SET attributes = ?, attributes_stat = ? WHERE path = ?",
+                                [(attributes, stat, path) for path, attributes, stat in results])
+            self.db.commit()
+        return len(results)
+
+    def filter_compliant(self, paths, metadata_of, add_attributes=False):
+        """Yield the paths of which the cached global attributes are out of date, or do not comply with the metadata
+        which metadata_of returns for the path. The number of compliant files which are skipped is kept in skipped."""
+        self.skipped = 0
+        for path in paths:
+            attributes = self.attributes(path)
+            if attributes is not None and not compare_attributes(attributes, metadata_of(path), add_attributes):
+                self.skipped += 1
+            else:
+                yield path
+
+    def attributes(self, path):
+        """Return the cached global attributes of the file, or None if they are not cached or out of date."""
+        with self.lock:
+            row = self.db.execute("SELECT attributes, attributes_stat FROM files WHERE path = ?",
+                                  (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if row[1] != "%d:%d:%d" % (st.st_size, st.st_mtime_ns, st.st_ino):
+            return None
+        return json.loads(row[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally refreshed SQLite index of a cmorised directory tree")
+    parser.add_argument("--db", metavar="FILE", type=str, default=default_db,
+                        help="The index database (default: %s)" % default_db)
+    parser.add_argument("--threads", type=int, default=8, help="Number of threads visiting directories (default 8)")
+    parser.add_argument("--verbose", "-v", action="store_true", default=False, help="Run verbosely (default: off)")
+    parser.add_argument("--no-refresh", action="store_true", default=False,
+                        help="Query the index as it is, without refreshing it first (default: no)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    refresh = subparsers.add_parser("refresh", help="Refresh the index of DIR")
+    refresh.add_argument("--restat", action="store_true", default=False,
+                         help="List all directories, also the unchanged ones")
+    refresh.add_argument("--attributes", action="store_true", default=False,
+                         help="Also cache the global attributes of the new and changed files")
+    listing = subparsers.add_parser("list", help="Print the files below DIR")
+    listing.add_argument("--include", metavar="FACET=VALUES", type=str, action="append", default=[],
+                         help="Only list the files of which the DRS facet matches one of the VALUES (can be repeated)")
+    listing.add_argument("--exclude", metavar="FACET=VALUES", type=str, action="append", default=[],
+                         help="Skip the files of which the DRS facet matches one of the VALUES (can be repeated)")
+    listing.add_argument("--timerange", metavar="START-END", type=str, default=None,
+                         help="Only list the files of which the time range in the file name overlaps with START-END")
+    subparsers.add_parser("versions", help="Print the version directories below DIR")
+    attributes = subparsers.add_parser("attributes", help="Print the cached global attributes of the file DIR as json")
+    for subparser in [refresh, listing, subparsers.choices["versions"], attributes]:
+        subparser.add_argument("dir", metavar="DIR", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s:%(name)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    if args.threads < 1:
+        log.error("Invalid number of threads chosen, please pick a positive number")
+        return 1
+    if args.command != "attributes" and not os.path.isdir(args.dir):
+        log.error("The directory argument %s is not a valid directory" % args.dir)
+        return 1
+    try:
+        path_filter = PathFilter(args.include, args.exclude, args.timerange) if args.command == "list" else None
+    except ValueError as filter_err:
+        log.error("Invalid filter: %s" % filter_err)
+        return 1
+
+    index = TreeIndex(args.db)
+    try:
+        if args.command == "refresh" or (args.command in ["list", "versions"] and not args.no_refresh):
+            stats = index.refresh(args.dir, args.threads, restat=getattr(args, "restat", False))
+            log.info("Refreshed the index of %s: visited %d directories, listed %d, added %d, removed %d and updated %d files" %
+                     (args.dir, stats["directories"], stats["listed"], stats["added"], stats["removed"], stats["changed"]))
+            if getattr(args, "attributes", False):
+                log.info("Cached the global attributes of %d files" % index.cache_attributes(args.dir, args.threads))
+        if args.command == "list":
+            for path in index.files(args.dir, path_filter or None):
+                print(path)
+        elif args.command == "versions":
+            for path in index.versions(args.dir):
+                print(path)
+        elif args.command == "attributes":
+            attributes = index.attributes(args.dir)
+            if attributes is None:
+                log.error("No up to date attributes of %s in the index %s" % (args.dir, args.db))
+                return 1
+            print(json.dumps(attributes, indent=2))
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
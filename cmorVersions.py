@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# Set one version ("vYYYYMMDD" directory) for cmorised data, the python counterpart of versions.sh -v.
+#
+# All version directory moves are planned first. The version directories are the directories named like a version,
+# found by one scan of the directories of the tree (the files are not considered, so also the empty version
+# directories are found), taken from the tree index or derived from a list of modified files written by the
+# cmorMDfixer (only the datasets of the listed files are re-versioned, with all their files). Collisions, i.e. files
+# which already exist in the new version directory or which occur in more than one old version directory of the same
+# dataset, are detected while planning and are skipped instead of prompted. Without -m only the plan and its counts
+# are printed. With -m the datasets are moved in parallel, the files of one dataset by one thread with os.rename,
+# after which the emptied old version directories are removed.
+#
+# Examples:
+#  ./cmorVersions.py -l CMIP6/
+#  ./cmorVersions.py -v v20240920 CMIP6/
+#  ./cmorVersions.py -v v20240920 -m --olist log-dir/list-of-modified-files-2.txt
+#
+
+import argparse
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(os.path.basename(__file__))
+
+version_pattern = re.compile(r"^v20[0-9][0-9][01][0-9][0-9][0-9]$")
+
+
+def version_dirs_of(paths):
+    """Return a dict with the version directories of the file paths and their file names, the files which are not in a
+    version directory are ignored."""
+    result = {}
+    for path in paths:
+        dirname, name = os.path.split(path)
+        if version_pattern.match(os.path.basename(dirname)):
+            result.setdefault(dirname, []).append(name)
+    return result
+
+
+def list_version_dir(dirname):
+    """Return the names of the regular files in the directory dirname."""
+    try:
+        with os.scandir(dirname) as it:
+            return [entry.name for entry in it if entry.is_file(follow_symlinks=False)]
+    except OSError as os_err:
+        log.warning("Unable to list directory %s: %s" % (dirname, os_err))
+        return []
+
+
+def find_version_dirs(root, nthreads=8):
+    """Return a dict with the version directories below root and the names of their files.
+
+    The directories are listed level by level, each level concurrently on nthreads threads. The version directories
+    are recognised by their name, and are not searched for further version directories.
+    """
+    def list_dir(path):
+        try:
+            with os.scandir(path) as it:
+                return [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+        except OSError as os_err:
+            log.warning("Unable to list directory %s: %s" % (path, os_err))
+            return []
+
+    result, level = {}, [root.rstrip(os.sep) or os.sep]
+    with ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix="version") as executor:
+        while level:
+            versions = [path for path in level if version_pattern.match(os.path.basename(path))]
+            result.update(zip(versions, executor.map(list_version_dir, versions)))
+            others = [path for path in level if not version_pattern.match(os.path.basename(path))]
+            level = [subdir for subdirs in executor.map(list_dir, others) for subdir in subdirs]
+    return result
+
+
+def modified_version_dirs(paths):
+    """Return the version directories of the modified file paths with all their files, not only the modified ones."""
+    return {dirname: list_version_dir(dirname) for dirname in version_dirs_of(paths)}
+
+
+def plan_versions(version_dirs, version):
+    """Return the moves which set the version of all version directories to version, as a list with per dataset (the
+    directory which contains the version directories) a dict with the keys dataset, target and moves. Each move is a
+    dict with the old version directory as source, the names of the files to move and the names of the colliding files.
+
+    A file collides when it already exists in the target directory, or when an earlier old version directory of the
+    same dataset (in sorted order) has a file with the same name.
+    """
+    datasets = {}
+    for dirname in sorted(version_dirs):
+        if os.path.basename(dirname) != version:
+            datasets.setdefault(os.path.dirname(dirname), []).append(dirname)
+    plan = []
+    for dataset in sorted(datasets):
+        target = os.path.join(dataset, version)
+        taken = set(list_version_dir(target)) if os.path.isdir(target) else set()
+        moves = []
+        for source in datasets[dataset]:
+            files, collisions = [], []
+            for name in sorted(version_dirs[source]):
+                (collisions if name in taken else files).append(name)
+                taken.add(name)
+            moves.append({"source": source, "files": files, "collisions": collisions})
+        plan.append({"dataset": dataset, "target": target, "moves": moves})
+    return plan
+
+
+def plan_counts(plan):
+    """Return the number of datasets, old version directories, files to move and colliding files of the plan."""
+    moves = [move for entry in plan for move in entry["moves"]]
+    return {"datasets": len(plan), "directories": len(moves), "files": sum(len(move["files"]) for move in moves),
+            "collisions": sum(len(move["collisions"]) for move in moves)}
+
+
+def move_dataset(entry):
+    """Move the files of one planned dataset, return the number of moved files, collisions and failures.
+
+    The existence of each target file is checked again right before its rename, because os.rename silently replaces an
+    existing file. The old version directories are removed when they are empty afterwards.
+    """
+    moved, collisions, failures = 0, 0, 0
+    target = entry["target"]
+    try:
+        # Not for a dataset with only empty old version directories, which are just removed:
+        if any(move["files"] for move in entry["moves"]):
+            os.makedirs(target, exist_ok=True)
+    except OSError as os_err:
+        log.error("Unable to create the version directory %s: %s" % (target, os_err))
+        return 0, 0, sum(len(move["files"]) for move in entry["moves"])
+    for move in entry["moves"]:
+        for name in move["collisions"]:
+            log.warning("Not moving %s because %s already exists" % (os.path.join(move["source"], name), os.path.join(target, name)))
+        collisions += len(move["collisions"])
+        for name in move["files"]:
+            source, destination = os.path.join(move["source"], name), os.path.join(target, name)
+            if os.path.lexists(destination):
+                log.warning("Not moving %s because %s already exists" % (source, destination))
+                collisions += 1
+                continue
+            try:
+                os.rename(source, destination)
+                moved += 1
+            except OSError as os_err:
+                log.error("Unable to move %s to %s: %s" % (source, destination, os_err))
+                failures += 1
+        try:
+            os.rmdir(move["source"])
+        except OSError:
+            log.warning("Directory not empty: '%s'" % move["source"])
+    return moved, collisions, failures
+
+
+def apply_plan(plan, nthreads=8):
+    """Move the datasets of the plan in parallel, return the total number of moved files, collisions and failures."""
+    totals = [0, 0, 0]
+    with ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix="version") as executor:
+        for counts in executor.map(move_dataset, plan):
+            totals = [total + count for total, count in zip(totals, counts)]
+    return tuple(totals)
+
+
+def print_plan(plan):
+    for entry in plan:
+        for move in entry["moves"]:
+            if not move["files"] and not move["collisions"]:
+                print("Removing directory: %s" % move["source"])
+                continue
+            print("Moving %d files: %s --> %s" % (len(move["files"]), move["source"], entry["target"]))
+            for name in move["collisions"]:
+                print("Collision: %s already exists in %s" % (name, entry["target"]))
+
+
+def set_version(version_dirs, version, move=False, nthreads=8):
+    """Plan and, when move is set, apply the version moves. Returns the plan counts, with the number of moved files
+    and failures added when moved."""
+    plan = plan_versions(version_dirs, version)
+    counts = plan_counts(plan)
+    if move:
+        counts["moved"], counts["collisions"], counts["failures"] = apply_plan(plan, nthreads)
+    else:
+        print_plan(plan)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List the versions of cmorised data, or set one version by moving the "
+                                                 "files to the appropriate version directory")
+    parser.add_argument("dir", metavar="DIR", type=str, nargs="?", help="Directory containing cmorised files")
+    parser.add_argument("-l", "--list", action="store_true", default=False,
+                        help="List the versions present in DIR, with their number of datasets and files")
+    parser.add_argument("-v", "--version", metavar="VERSION", type=str, default=None,
+                        help="Set the version VERSION, which must match v20[0-9][0-9][01][0-9][0-9][0-9], for all files")
+    parser.add_argument("-m", "--move", action="store_true", default=False,
+                        help="Safety switch: actually move the files (dry-run if not set)")
+    parser.add_argument("-i", "--index", metavar="FILE", type=str, default=None,
+                        help="Take the files from the tree index FILE (see cmorTreeIndex.py) instead of scanning DIR")
+    parser.add_argument("--olist", metavar="FILE", type=str, default=None,
+                        help="Only take the datasets of the files listed in FILE, e.g. a list of modified files of the "
+                             "cmorMDfixer, instead of all datasets in DIR")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="Number of threads listing directories and moving datasets concurrently (default 8)")
+    parser.add_argument("--verbose", action="store_true", default=False, help="Run verbosely (default: off)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s:%(name)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    if args.list == (args.version is not None):
+        parser.error("either -l or -v must be used")
+    if args.version is not None and not version_pattern.match(args.version):
+        parser.error("invalid version string '%s'" % args.version)
+    if args.threads < 1:
+        parser.error("invalid number of threads, please pick a positive number")
+    if args.olist:
+        if args.index:
+            parser.error("option olist can not be combined with the index option")
+        if not os.path.isfile(args.olist):
+            log.error("The olist %s is not a valid file" % args.olist)
+            return 1
+    elif args.dir is None or not os.path.isdir(args.dir):
+        log.error("Missing or invalid directory: '%s'" % args.dir)
+        return 1
+
+    if args.olist:
+        with open(args.olist, 'r') as f:
+            # The olist of a verified run has the status in a second, tab separated column:
+            paths = [line.rstrip('\n').split('\t')[0] for line in f if line.strip()]
+        if args.dir is not None:
+            root = os.path.abspath(args.dir) + os.sep
+            paths = [path for path in paths if os.path.abspath(path).startswith(root)]
+        version_dirs = modified_version_dirs(paths)
+    elif args.index:
+        from cmorTreeIndex import TreeIndex
+        index = TreeIndex(args.index)
+        try:
+            index.refresh(args.dir, args.threads)
+            version_dirs = {dirname: list_version_dir(dirname) for dirname in index.versions(args.dir)}
+        finally:
+            index.close()
+    else:
+        version_dirs = find_version_dirs(args.dir, args.threads)
+
+    if args.list:
+        versions = {}
+        for dirname, names in version_dirs.items():
+            entry = versions.setdefault(os.path.basename(dirname), [0, 0])
+            entry[0] += 1
+            entry[1] += len(names)
+        for version in sorted(versions):
+            print("%s %d datasets %d files" % (version, versions[version][0], versions[version][1]))
+        return
+
+    if not args.move:
+        log.warning("Not moving any files (dry-run mode)")
+    counts = set_version(version_dirs, args.version, args.move, args.threads)
+    print("%s %d files of %d datasets in %d version directories, %d collisions%s" %
+          ("Moved" if args.move else "Plan: moving", counts.get("moved", counts["files"]), counts["datasets"],
+           counts["directories"], counts["collisions"], ", %d failures" % counts["failures"] if args.move else ""))
+    if counts["collisions"] or counts.get("failures"):
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
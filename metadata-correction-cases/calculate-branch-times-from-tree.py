@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# Calculate the branch times of all simulations in a cmorised tree from their time axes, and write them as a rules
+# file for the cmorMDfixer (see knmi-metadata-corrections-rules-example.json).
+#
+# For each simulation (source_id, experiment_id, member_id) only the file with the earliest and the file with the
+# latest time range in its name are opened, and of these only the time units, the calendar and the first respectively
+# the last time bound are read, the data variables are never read. The parent of a simulation is taken from its
+# parent_source_id, parent_experiment_id and parent_variant_label attributes. The branch date is the start date of the
+# child. The branch_time_in_child is this date in the time units of the child, the branch_time_in_parent is the
+# branch date in the parent in the parent_time_units, both in the calendar of the model. All dates of one units and
+# calendar combination are converted at once with cftime.
+#
+# The branch date in the parent equals the start date of the child when the parent is in the tree and its time span
+# includes that date (e.g. a scenario branching from the end of the historical run). Otherwise the branch date in the
+# parent has to be given per child experiment with --branch-date, e.g. for a historical run branching from a later
+# year in the piControl run. The branch times are written as doubles. E.g.:
+#  ./calculate-branch-times-from-tree.py --branch-date historical=2260-01-01 --branch-date piControl=2259-01-01 \
+#                                        -o knmi-metadata-corrections-branch-times.json CMIP6/
+#
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import cftime
+import netCDF4
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cmorMDfixer import dispatch, scan_files, netcdf_lock, parse_drs_path, time_range_pattern, time_range_bounds
+
+log = logging.getLogger(os.path.basename(__file__))
+
+# The facets which identify a simulation:
+simulation_facets = ("source_id", "experiment_id", "member_id")
+
+# The global attributes of the child which are read:
+parent_attributes = ["parent_source_id", "parent_experiment_id", "parent_variant_label", "parent_time_units",
+                     "branch_time_in_child", "branch_time_in_parent"]
+
+
+def select_files(paths):
+    """Return per simulation the file with the earliest and the file with the latest time range in its name."""
+    simulations = {}
+    for path in paths:
+        facets = parse_drs_path(path)
+        match = time_range_pattern.search(path)
+        if not facets or not match:
+            continue  # Not in a DRS tree, or a file without time axis (e.g. fx)
+        start, end = time_range_bounds(*match.groups())
+        key = tuple(facets[facet] for facet in simulation_facets)
+        first, last = simulations.get(key, ((start, path), (end, path)))
+        simulations[key] = (min(first, (start, path)), max(last, (end, path)))
+    return {key: (first[1], last[1]) for key, (first, last) in simulations.items()}
+
+
+def read_time_axis(item):
+    """Return the time units, the calendar and the first (or last) time bound of the file, with item a dict with the
+    path and whether the first or the last time is read. With the first time the parent attributes are read as well."""
+    record = {"path": item["path"], "key": item["key"], "first": item["first"]}
+    try:
+        with netcdf_lock:
+            with netCDF4.Dataset(item["path"], "r") as ds:
+                time = ds.variables["time"]
+                record["units"] = time.getncattr("units")
+                record["calendar"] = time.getncattr("calendar") if "calendar" in time.ncattrs() else "standard"
+                bounds = ds.variables.get(time.getncattr("bounds")) if "bounds" in time.ncattrs() else None
+                # Only one value of the time axis is read:
+                if bounds is not None:
+                    record["time"] = float(bounds[0, 0] if item["first"] else bounds[-1, 1])
+                else:
+                    record["time"] = float(time[0] if item["first"] else time[-1])
+                if item["first"]:
+                    record["attributes"] = {attname: ds.getncattr(attname) for attname in parent_attributes
+                                            if attname in ds.ncattrs()}
+    except (IOError, RuntimeError, KeyError, IndexError, AttributeError, ValueError) as read_err:
+        log.error("Unable to read the time axis of %s: %s" % (item["path"], read_err))
+        record["error"] = str(read_err)
+    return record
+
+
+def read_simulations(files, nthreads=8):
+    """Return per simulation its time units, calendar, start and end (as numbers) and the parent attributes."""
+    items = [{"path": path, "key": key, "first": first} for key, pair in files.items()
+             for path, first in zip(pair, (True, False))]
+    simulations = {}
+    for record in dispatch(items, 1, 1, {}, read_time_axis, backend="threads", nthreads=nthreads):
+        if "error" in record:
+            continue
+        simulation = simulations.setdefault(record["key"], {})
+        if record["first"]:
+            simulation.update(units=record["units"], calendar=record["calendar"], start=record["time"],
+                              path=record["path"], attributes=record["attributes"])
+        else:
+            simulation["end"] = record["time"]
+    return {key: simulation for key, simulation in simulations.items() if "start" in simulation and "end" in simulation}
+
+
+def convert_dates(values):
+    """Convert the numbers of the (units, calendar, number) tuples to dates, at once per units and calendar."""
+    return convert_grouped(values, lambda numbers, units, calendar: cftime.num2date(numbers, units, calendar))
+
+
+def convert_numbers(dates):
+    """Convert the dates of the (units, calendar, date) tuples to numbers, at once per units and calendar."""
+    return convert_grouped(dates, lambda dates, units, calendar: cftime.date2num(dates, units, calendar))
+
+
+def convert_grouped(values, convert):
+    # The values of a units and calendar combination which can not be converted are returned as None:
+    groups = {}
+    for i, (units, calendar, value) in enumerate(values):
+        groups.setdefault((units, calendar), []).append(i)
+    result = [None] * len(values)
+    for (units, calendar), indices in groups.items():
+        try:
+            converted = convert([values[i][2] for i in indices], units, calendar)
+        except ValueError as convert_err:
+            log.error("Unable to convert the times in '%s' with calendar %s: %s" % (units, calendar, convert_err))
+            continue
+        for i, value in zip(indices, converted):
+            result[i] = value
+    return result
+
+
+def in_calendar(date, calendar):
+    """Return the date (a cftime datetime) in the calendar."""
+    return cftime.datetime(date.year, date.month, date.day, date.hour, date.minute, date.second, calendar=calendar)
+
+
+def calculate_branch_times(simulations, branch_dates=None):
+    """Return per child simulation a dict with its parent, branch_time_in_child, branch_time_in_parent and the current
+    values, or with an error message if the branch time in the parent can not be determined."""
+    branch_dates = branch_dates or {}
+    keys = sorted(simulations)
+    # The start, end and branch dates of all simulations, in one conversion per units and calendar:
+    starts = convert_dates([(simulations[key]["units"], simulations[key]["calendar"], simulations[key]["start"]) for key in keys])
+    ends = convert_dates([(simulations[key]["units"], simulations[key]["calendar"], simulations[key]["end"]) for key in keys])
+    spans = {key: (start, end) for key, start, end in zip(keys, starts, ends)}
+
+    results, pending = {}, []
+    for key in keys:
+        simulation, attributes = simulations[key], simulations[key]["attributes"]
+        parent = tuple(attributes.get(attname) for attname in ["parent_source_id", "parent_experiment_id", "parent_variant_label"])
+        result = results[key] = {"parent": parent, "branch_time_in_child": simulation["start"],
+                                 "current": [attributes.get("branch_time_in_child"), attributes.get("branch_time_in_parent")]}
+        if None in parent or "no parent" in parent:
+            result["error"] = "no parent"
+            continue
+        calendar = simulations[parent]["calendar"] if parent in simulations else simulation["calendar"]
+        units = attributes.get("parent_time_units") or (simulations[parent]["units"] if parent in simulations else None)
+        if units is None:
+            result["error"] = "the parent_time_units are unknown"
+            continue
+        start = spans[key][0]
+        if start is None or (parent in spans and None in spans[parent]):
+            result["error"] = "the time axis of %s can not be converted" % " ".join(key if start is None else parent)
+            continue
+        try:
+            if key[1] in branch_dates:
+                year, month, day = branch_dates[key[1]]
+                branch_date = cftime.datetime(year, month, day, calendar=calendar)
+            elif parent in spans and spans[parent][0] <= in_calendar(start, simulations[parent]["calendar"]) <= spans[parent][1]:
+                branch_date = in_calendar(start, calendar)
+            else:
+                result["error"] = "the branch date in the parent %s is unknown, use --branch-date %s=YYYY-MM-DD" % (" ".join(parent), key[1])
+                continue
+        except ValueError as date_err:
+            # E.g. the 31st day of a month in a 360_day calendar, or the 29th of February in a noleap calendar:
+            log.error("Unable to determine the branch date of %s in the calendar %s of the parent: %s" %
+                      (" ".join(key), calendar, date_err))
+            result["error"] = "the branch date does not exist in the calendar %s of the parent" % calendar
+            continue
+        if parent in spans and not spans[parent][0] <= branch_date <= spans[parent][1]:
+            log.warning("The branch date %s of %s lies outside the parent %s" % (branch_date, " ".join(key), " ".join(parent)))
+        result["branch_date"] = branch_date
+        pending.append((key, units, calendar, branch_date))
+
+    for (key, units, calendar, branch_date), number in zip(pending, convert_numbers([entry[1:] for entry in pending])):
+        if number is None:
+            results[key]["error"] = "the branch date can not be converted to the parent_time_units '%s'" % units
+        else:
+            results[key]["branch_time_in_parent"] = float(number)
+    return results
+
+
+def write_rules(fname, results):
+    """Write the branch times as a cmorMDfixer rules file, with a rule per child simulation. Returns the number of rules."""
+    rules = []
+    for key in sorted(results):
+        if "branch_time_in_parent" not in results[key]:
+            continue
+        rules.append({"select": dict(zip(simulation_facets, key)),
+                      "attributes": {"branch_time_in_child": results[key]["branch_time_in_child"],
+                                     "branch_time_in_parent": results[key]["branch_time_in_parent"]}})
+    with open(fname, 'w') as f:
+        json.dump({"#comment": "The branch times calculated from the time axes by %s." % os.path.basename(__file__),
+                   "rules": rules}, f, indent=4)
+        f.write('\n')
+    return len(rules)
+
+
+def parse_branch_date(value):
+    try:
+        experiment, date = value.split("=")
+        year, month, day = (int(part) for part in date.split("-"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid branch date %s, expected EXPERIMENT=YYYY-MM-DD" % value)
+    return experiment, (year, month, day)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculate the branch times of all simulations in a cmorised tree from "
+                                                 "their time axes, and write them as a cmorMDfixer rules file")
+    parser.add_argument("datadir", metavar="DIR", type=str, help="Directory containing cmorised files")
+    parser.add_argument("--output", "-o", metavar="FILE.json", type=str, default=None,
+                        help="Write the branch times as a cmorMDfixer rules file FILE.json (default: only print them)")
+    parser.add_argument("--branch-date", metavar="EXPERIMENT=YYYY-MM-DD", type=parse_branch_date, action="append",
+                        default=[], help="The branch date in the parent of the simulations of the child EXPERIMENT (can "
+                                         "be repeated), by default the start date of the child when it lies within the parent")
+    parser.add_argument("--index", metavar="FILE", type=str, default=None,
+                        help="Take the files from the tree index FILE (see cmorTreeIndex.py) instead of scanning DIR")
+    parser.add_argument("--threads", type=int, default=8, help="Number of threads reading the time axes (default 8)")
+    parser.add_argument("--verbose", "-v", action="store_true", default=False, help="Run verbosely (default: off)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s:%(name)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    if not os.path.isdir(args.datadir):
+        log.error("The directory argument %s is not a valid directory" % args.datadir)
+        return 1
+    if args.threads < 1:
+        parser.error("invalid number of threads, please pick a positive number")
+
+    if args.index:
+        from cmorTreeIndex import TreeIndex
+        index = TreeIndex(args.index)
+        try:
+            index.refresh(args.datadir, args.threads)
+            files = select_files(index.files(args.datadir))
+        finally:
+            index.close()
+    else:
+        files = select_files(scan_files(args.datadir, nthreads=args.threads))
+    simulations = read_simulations(files, args.threads)
+    results = calculate_branch_times(simulations, dict(args.branch_date))
+
+    unresolved = 0
+    for key in sorted(results):
+        result = results[key]
+        if "error" in result:
+            unresolved += result["error"] != "no parent"
+            print("%-50s %s" % (" ".join(key), result["error"]))
+        else:
+            print("%-50s branch_time_in_child = %10.1f branch_time_in_parent = %10.1f (%s in %s, currently %s %s)" %
+                  (" ".join(key), result["branch_time_in_child"], result["branch_time_in_parent"],
+                   result["branch_date"].strftime("%Y-%m-%d"), " ".join(result["parent"]), *result["current"]))
+    if args.output:
+        log.info("Wrote %d rules to %s" % (write_rules(args.output, results), args.output))
+    if unresolved:
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
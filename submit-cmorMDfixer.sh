@@ -42,6 +42,28 @@
                    $METADATAFILE      \
                    $CMORISEDDIR
 
+#  # With a journal a job which is killed (e.g. by the wall clock limit) can be resubmitted with --resume added,
+#  # in which case the completed files are skipped and the interrupted files are reprocessed:
+#  ./cmorMDfixer.py --verbose         \
+#                  --forceid          \
+#                  --olist       log-dir \
+#                  --journal     cmorMDfixer-journal.txt \
+#                  --npp         64   \
+#                  $METADATAFILE      \
+#                  $CMORISEDDIR
+
+#  # Spread the files over several nodes with a SLURM array job, submitted with for instance: sbatch --array=0-7 $0
+#  # Each array task processes its own disjoint shard of the files and writes its own olist in the LOGDIR, which
+#  # are merged into one sorted olist after all tasks have finished by: ./cmorMDfixer.py --olist log-dir --merge-shards 8
+#  ./cmorMDfixer.py --verbose         \
+#                  --forceid          \
+#                  --olist       log-dir \
+#                  --shard       ${SLURM_ARRAY_TASK_ID}/${SLURM_ARRAY_TASK_COUNT} \
+#                  --shard-by    dataset \
+#                  --npp         64   \
+#                  $METADATAFILE      \
+#                  $CMORISEDDIR
+
 #  ./cmorMDfixer.py --verbose         \
 #                  --dry              \
 #                  --keepid           \
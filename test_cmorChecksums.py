@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# Tests of the checksum manifests of cmorChecksums.py, run with: python -m pytest -q
+#
+
+import hashlib
+import os
+
+from cmorChecksums import write_checksums
+
+dataset = "CMIP6/CMIP/EC-Earth-Consortium/EC-Earth3/piControl/r1i1p1f1/Eyr/cVeg/gr/v20240129"
+fname = "cVeg_Eyr_EC-Earth3_piControl_r1i1p1f1_gr_1850-1850.nc"
+
+
+def make_file(tmp_path, content=b"cmorised data"):
+    os.makedirs(str(tmp_path / dataset))
+    path = str(tmp_path / dataset / fname)
+    with open(path, "wb") as f:
+        f.write(content)
+    os.utime(path, ns=(1700000000123456789, 1700000000123456789))
+    return path
+
+
+def test_esgmapfile_line(tmp_path):
+    path = make_file(tmp_path)
+    manifest = str(tmp_path / "CMIP6.map")
+    counts = write_checksums(manifest, [path])
+    assert counts["listed"] == 1 and counts["failed"] == 0
+    with open(manifest) as f:
+        assert f.read() == ("CMIP6.CMIP.EC-Earth-Consortium.EC-Earth3.piControl.r1i1p1f1.Eyr.cVeg.gr#20240129 | %s | 13 | "
+                            "mod_time=1700000000.123457 | checksum=%s | checksum_type=SHA256\n" %
+                            (path, hashlib.sha256(b"cmorised data").hexdigest()))
+
+
+def test_sha256sum_line_and_cache(tmp_path):
+    path = make_file(tmp_path)
+    manifest, cache = str(tmp_path / "manifest.sha256"), str(tmp_path / "checksums.sqlite")
+    assert write_checksums(manifest, [path], cache)["hashed"] == 1
+    counts = write_checksums(manifest, [path], cache)
+    assert counts["hashed"] == 0 and counts["reused"] == 1
+    with open(manifest) as f:
+        assert f.read() == "%s  %s\n" % (hashlib.sha256(b"cmorised data").hexdigest(), path)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# Tests of the cmorMDfixer on a copy of the test data, run with: python -m pytest -q
+#
+
+import os
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+import cmorMDfixer
+from cmorTreeIndex import TreeIndex
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cmorMDfixer-test-data", "test-set-01")
+metadata_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "metadata-correction-cases",
+                             "knmi-metadata-corrections-piControl.json")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """A copy of the test data, returns the directory which contains the CMIP6 directory."""
+    shutil.copytree(test_data, str(tmp_path / "data"))
+    return str(tmp_path / "data")
+
+
+def run_fixer(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["cmorMDfixer.py"] + list(argv))
+    return cmorMDfixer.main()
+
+
+def test_failed_verification_is_not_cached(tree, tmp_path, monkeypatch):
+    read_global_attributes, reads = cmorMDfixer.read_global_attributes, {}
+
+    def unverifiable(path):
+        # The probe reads the real attributes, the read back after the write returns none of them:
+        reads[path] = reads.get(path, 0) + 1
+        return read_global_attributes(path) if reads[path] == 1 else {}
+
+    monkeypatch.setattr(cmorMDfixer, "read_global_attributes", unverifiable)
+    cache = str(tmp_path / "cache.sqlite")
+    assert run_fixer(monkeypatch, "--verify", "--cache", cache, metadata_file, tree) == 1
+    assert len(reads) == 2 and all(count == 2 for count in reads.values())
+    with sqlite3.connect(cache) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 0
+
+
+def test_index_refresh_detects_in_place_modifications(tree, tmp_path, monkeypatch):
+    index = TreeIndex(str(tmp_path / "index.sqlite"))
+    try:
+        assert index.refresh(tree)["added"] == 2
+        assert index.cache_attributes(tree) == 2
+        # An in-place modification does not change the modification time of the directory:
+        run_fixer(monkeypatch, metadata_file, tree)
+        stats = index.refresh(tree)
+        assert stats["listed"] == 0 and stats["changed"] == 2
+        # The attributes of the modified files are out of date until they are cached again:
+        metadata = cmorMDfixer.RuleSet.load([metadata_file])
+        assert len(list(index.filter_compliant(index.files(tree), lambda path: metadata.resolve(path)[0]))) == 2
+        assert index.cache_attributes(tree) == 2
+        assert list(index.filter_compliant(index.files(tree), lambda path: metadata.resolve(path)[0])) == []
+        assert index.skipped == 2
+    finally:
+        index.close()
+
+
+def test_apply_plan_refuses_changed_files(tree, tmp_path, monkeypatch):
+    plan, logdir = str(tmp_path / "plan.jsonl"), str(tmp_path / "log-dir")
+    assert run_fixer(monkeypatch, "--plan", plan, metadata_file, tree) is None
+    header, entries = cmorMDfixer.read_plan(plan)
+    paths = sorted(entry["path"] for entry in entries)
+    assert len(paths) == 2
+    # The first file changes after the plan is made:
+    os.utime(paths[0], ns=(0, 0))
+    changed = cmorMDfixer.file_fingerprint(paths[0])
+    assert run_fixer(monkeypatch, "--apply-plan", plan, "--olist", logdir) == 1
+    assert cmorMDfixer.file_fingerprint(paths[0]) == changed
+    with open(os.path.join(logdir, "list-of-modified-files-1-refused.txt")) as f:
+        assert f.read().splitlines() == [paths[0]]
+    with open(os.path.join(logdir, "list-of-modified-files-1.txt")) as f:
+        assert f.read().splitlines() == [paths[1]]
+
+
+def test_shards_partition_the_files(tmp_path):
+    root = str(tmp_path / "CMIP6")
+    paths = [os.path.join(root, "CMIP", "I", "M", "piControl", "r1i1p1f1", "Amon", variable, "gn", "v20240101",
+                          "%s_Amon_M_piControl_r1i1p1f1_gn_%d01-%d12.nc" % (variable, year, year))
+             for variable in ["tas", "pr", "uas", "vas", "psl"] for year in range(1850, 1870)]
+    for by in ["file", "dataset"]:
+        shards = [cmorMDfixer.shard_of(path, root, 4, by) for path in paths]
+        assert all(0 <= shard < 4 for shard in shards)
+        # The shard is stable and does not depend on the spelling of the root directory:
+        assert shards == [cmorMDfixer.shard_of(path, root + os.sep, 4, by) for path in paths]
+        assert shards == [cmorMDfixer.shard_of(os.path.join(root, "..", "CMIP6", os.path.relpath(path, root)), root, 4, by)
+                          for path in paths]
+        if by == "dataset":
+            # All files of a dataset are in the same shard:
+            assert len({(os.path.dirname(path), shard) for path, shard in zip(paths, shards)}) == 5
+        else:
+            assert len(set(shards)) == 4
+
+
+def test_sharded_runs_merge_into_one_olist(tree, tmp_path, monkeypatch):
+    logdir = str(tmp_path / "log-dir")
+    for shard in range(3):
+        assert run_fixer(monkeypatch, "--olist", logdir, "--shard", "%d/3" % shard, metadata_file, tree) is None
+    listed = []
+    for shard in range(3):
+        with open(os.path.join(logdir, "list-of-modified-files-shard-%d-of-3.txt" % shard)) as f:
+            listed.extend(f.read().splitlines())
+    assert len(listed) == 2 and len(set(listed)) == 2
+    assert run_fixer(monkeypatch, "--olist", logdir, "--merge-shards", "3") is None
+    with open(os.path.join(logdir, "list-of-modified-files-1.txt")) as f:
+        assert f.read().splitlines() == sorted(listed)
+    # A missing shard is an error:
+    os.remove(os.path.join(logdir, "list-of-modified-files-shard-2-of-3.txt"))
+    assert run_fixer(monkeypatch, "--olist", logdir, "--merge-shards", "3") == 1
+
+
+def drs_path(experiment="piControl", table="Omon", variable="tos"):
+    return os.path.join("/data", "CMIP6", "CMIP", "EC-Earth-Consortium", "EC-Earth3", experiment, "r1i1p1f1", table,
+                        variable, "gn", "v20240101", "%s_%s_EC-Earth3_%s_r1i1p1f1_gn_185001-185012.nc" %
+                        (variable, table, experiment))
+
+
+def test_rules_are_looked_up_by_facets():
+    rules = cmorMDfixer.RuleSet([
+        {"attributes": {"institution": "KNMI", "comment": "all"}},
+        {"select": {"experiment": "piControl"}, "attributes": {"branch_time_in_parent": 0.0}},
+        {"select": {"table": ["Omon", "Eyr"], "variable": "tos"}, "attributes": {"comment": "ocean", "realm": "ocean"}},
+        {"select": {"experiment": "historical", "table": "Omon"}, "attributes": {"comment": "historical ocean"}}])
+    assert rules.resolve(drs_path())[0] == {"institution": "KNMI", "comment": "ocean", "realm": "ocean",
+                                            "branch_time_in_parent": 0.0}
+    assert rules.resolve(drs_path(table="Eyr"))[0]["comment"] == "ocean"
+    assert rules.resolve(drs_path(variable="sos"))[0] == {"institution": "KNMI", "comment": "all", "branch_time_in_parent": 0.0}
+    # The later rule wins:
+    assert rules.resolve(drs_path("historical"))[0] == {"institution": "KNMI", "comment": "historical ocean", "realm": "ocean"}
+    # A file outside a DRS tree only gets the rules without selectors:
+    assert rules.resolve("/data/tos.nc")[0] == {"institution": "KNMI", "comment": "all"}
+    # The hash only depends on the resolved attributes:
+    assert rules.resolve(drs_path())[1] == rules.resolve(drs_path(experiment="piControl"))[1]
+    assert rules.resolve(drs_path())[1] != rules.resolve(drs_path(variable="sos"))[1]
+    with pytest.raises(ValueError):
+        rules.add({"select": {"realm": "ocean"}, "attributes": {}})
+
+
+def test_path_filter_uses_the_facets_and_time_range():
+    path_filter = cmorMDfixer.PathFilter(["table=Omon,E*", "experiment=piControl"], ["variable=sos"], "1800-1850")
+    assert path_filter.accept(drs_path())
+    assert path_filter.accept(drs_path(table="Eyr"))
+    assert not path_filter.accept(drs_path(table="Amon"))
+    assert not path_filter.accept(drs_path(variable="sos"))
+    assert not path_filter.accept(drs_path("historical"))
+    assert not path_filter.accept(drs_path().replace("185001-185012", "185101-185112"))
+    # Files without a time range always pass it, files outside a DRS tree never pass an include filter:
+    assert cmorMDfixer.PathFilter(timerange="1900-1950").accept(drs_path().replace("_185001-185012", ""))
+    assert not path_filter.accept("/data/tos_185001-185012.nc")
+    # The directories of which no file can pass are pruned:
+    assert path_filter.prune(os.path.dirname(drs_path(table="Amon")).rsplit(os.sep, 3)[0])
+    assert not path_filter.prune(os.path.dirname(drs_path()).rsplit(os.sep, 3)[0])
+    assert not path_filter.prune("/data")
+    with pytest.raises(ValueError):
+        cmorMDfixer.PathFilter(["realm=ocean"])
+
+
+def test_interrupted_run_resumes_from_the_journal(tree, tmp_path, monkeypatch):
+    journal, logdir = str(tmp_path / "journal.txt"), str(tmp_path / "log-dir")
+    process_file, processed = cmorMDfixer.process_file, []
+
+    def interrupted(path, **settings):
+        if processed:
+            raise KeyboardInterrupt
+        processed.append(path)
+        return process_file(path, **settings)
+
+    monkeypatch.setattr(cmorMDfixer, "process_file", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        run_fixer(monkeypatch, "--journal", journal, metadata_file, tree)
+    first = processed.pop()
+
+    def counted(path, **settings):
+        processed.append(path)
+        return process_file(path, **settings)
+
+    monkeypatch.setattr(cmorMDfixer, "process_file", counted)
+    # The settings of the run are part of the journal:
+    assert run_fixer(monkeypatch, "--journal", journal, "--resume", "--addattrs", metadata_file, tree) is None
+    assert processed == []
+    assert run_fixer(monkeypatch, "--journal", journal, "--resume", "--olist", logdir, metadata_file, tree) is None
+    # Only the interrupted file is processed again, the olist covers the entire run:
+    assert len(processed) == 1 and processed[0] != first
+    with open(os.path.join(logdir, "list-of-modified-files-1.txt")) as f:
+        assert sorted(f.read().splitlines()) == sorted([first, processed[0]])
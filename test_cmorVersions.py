@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# Thomas Reerink
+#
+# Tests of the version moves of cmorVersions.py, run with: python -m pytest -q
+#
+
+import os
+
+from cmorVersions import find_version_dirs, plan_counts, plan_versions, apply_plan
+
+
+def make_tree(tmp_path, files):
+    for name in files:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+    return str(tmp_path)
+
+
+def test_set_version(tmp_path):
+    root = make_tree(tmp_path, ["CMIP6/tas/gn/v20200101/a.nc", "CMIP6/tas/gn/v20200101/README.txt",
+                                "CMIP6/tas/gn/v20210101/a.nc", "CMIP6/tas/gn/v20210101/b.nc",
+                                "CMIP6/pr/gn/v20240101/c.nc", "CMIP6/pr/gn/v20200101/c.nc"])
+    os.makedirs(os.path.join(root, "CMIP6/uas/gn/v20190101"))
+    version_dirs = find_version_dirs(root, nthreads=2)
+    assert sorted(os.path.relpath(dirname, root) for dirname in version_dirs) == [
+        "CMIP6/pr/gn/v20200101", "CMIP6/pr/gn/v20240101", "CMIP6/tas/gn/v20200101", "CMIP6/tas/gn/v20210101",
+        "CMIP6/uas/gn/v20190101"]
+
+    plan = plan_versions(version_dirs, "v20240101")
+    # The c.nc already exists in the new version, the a.nc of the later old version collides with the earlier one:
+    assert plan_counts(plan) == {"datasets": 3, "directories": 4, "files": 3, "collisions": 2}
+    assert apply_plan(plan, nthreads=2) == (3, 2, 0)
+    listing = sorted(os.path.relpath(os.path.join(dirpath, name), root)
+                     for dirpath, dirnames, names in os.walk(root) for name in names + dirnames)
+    assert listing == ["CMIP6", "CMIP6/pr", "CMIP6/pr/gn", "CMIP6/pr/gn/v20200101", "CMIP6/pr/gn/v20200101/c.nc",
+                       "CMIP6/pr/gn/v20240101", "CMIP6/pr/gn/v20240101/c.nc", "CMIP6/tas", "CMIP6/tas/gn",
+                       "CMIP6/tas/gn/v20210101", "CMIP6/tas/gn/v20210101/a.nc", "CMIP6/tas/gn/v20240101",
+                       "CMIP6/tas/gn/v20240101/README.txt", "CMIP6/tas/gn/v20240101/a.nc",
+                       "CMIP6/tas/gn/v20240101/b.nc", "CMIP6/uas", "CMIP6/uas/gn"]
+    with open(os.path.join(root, "CMIP6/tas/gn/v20240101/a.nc")) as f:
+        assert f.read() == "CMIP6/tas/gn/v20200101/a.nc"
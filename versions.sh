@@ -8,17 +8,19 @@ $(basename $0): Get/set version ("vYYYYMMDD" string) for CMORised data by
 listing version directories (get) or moving files (set) to the appropriate
 directory.
   If needed, a new version directory is created. Empty version directories are
-removed. When moving files would overwrite existing files, the user is
-prompted.
+removed. Files which would overwrite existing files are not moved and are
+reported.
   Note that the script has a safety switch (-m)! If the switch is *not* used on
 the command line, it runs in dry-run mode (i.e. no files are moved).
 
-Usage: $(basename $0) -l | -v <version> [-m] DIR
+Usage: $(basename $0) -l | -v <version> [-m] [-i <index>] DIR
 
        -l            List versions present in DIR
        -v <version>  Set version to be used for all files
                      <version> must match: v20[0-9][0-9][01][0-9][0-9][0-9]
        -m            Safety switch: actually move files (dry-run if not set)
+       -i <index>    Take the version directories from the tree index <index>
+                     (see cmorTreeIndex.py) instead of searching DIR
 
 EOT
 }
@@ -33,7 +35,7 @@ warning() {
     echo "WARNING: $1" >&2
 }
 
-while getopts ":lmv:" opt
+while getopts ":lmv:i:" opt
 do
     case "$opt" in
     l)  list=1
@@ -42,6 +44,8 @@ do
         ;;
     v)  version=$OPTARG
         ;;
+    i)  index=$OPTARG
+        ;;
     \?) usage
         error "Invalid option: -$OPTARG" 1
         ;;
@@ -66,9 +70,19 @@ else
     directory=$1
 fi
 
+version_dirs() {
+    if [ -z ${index+x} ]
+    then
+        find $directory -type d -name "v20[0-9][0-9][01][0-9][0-9][0-9]"
+    else
+        # The index is refreshed first, which only lists the directories changed since the last refresh:
+        $(dirname $0)/cmorTreeIndex.py --db $index versions $directory
+    fi
+}
+
 if [ ! -z ${list+x} ]
 then
-    for d in $(find $directory -type d -name "v20[0-9][0-9][01][0-9][0-9][0-9]")
+    for d in $(version_dirs)
     do
         basename $d
     done | sort -u
@@ -77,33 +91,8 @@ fi
 
 if [ ! -z ${version+x} ]
 then
-    [ -z ${move+x} ] && warning "Not moving any files (dry-run mode)"
-
     [[ $version =~ v20[0-9][0-9][01][0-9]{3}$ ]] || error "Invalid version string '$version'" 5
 
-    for d in $(find $directory -type d -name "v20[0-9][0-9][01][0-9][0-9][0-9]")
-    do
-        this_version=$(basename $d)
-        if [[ ! $this_version =~ $version ]]
-        then
-            echo "Processing directory '$d'"
-            new_version_dir="$(dirname $d)/$version/"
-            for f in $d/*.nc
-            do
-                if [ -z ${move+x} ]
-                then
-                    echo "Moving: $f --> $new_version_dir"
-                else
-                    [ -d $new_version_dir ] || mkdir --verbose $new_version_dir
-                    mv --interactive --verbose $f $new_version_dir
-                fi
-            done
-            if [ -z ${move+x} ]
-            then
-                echo "Removing directory: $d"
-            else
-                rmdir --verbose $d || warning "Directory not empty: '$d'"
-            fi
-        fi
-    done
+    # All moves are planned in one pass and collisions are skipped instead of prompted, see cmorVersions.py:
+    exec $(dirname $0)/cmorVersions.py -v $version ${move+-m} ${index+-i $index} $directory
 fi